@@ -0,0 +1,464 @@
+"""
+Load generator and benchmark for the file server.
+
+Starts the real server (server.py) as a separate process on a free localhost port, in a scratch directory, and
+drives it with N concurrent scripted clients that run a random mix of cd/mkdir/rm/ul/dl/info/mv commands on files
+of the given sizes. Reports the throughput, the latency percentiles of each command and the server's memory and
+thread count as JSON, so runs with different engines, chunk sizes and protocol modes can be compared.
+
+Example:
+    python benchmark.py --clients 16 --operations 200 --engine select --sizes 1K,1M,64M --output select.json
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import client
+import protocol
+
+# modules the server process needs, copied next to it into the scratch directory it serves
+SERVER_FILES = ("server.py", "protocol.py", "delta.py", "metrics.py", "tree.py", "dedup.py", "shaping.py")
+
+DEFAULT_MIX = "ul=3,dl=3,info=2,mv=1,rm=1,mkdir=1,cd=1"
+DEFAULT_SIZES = "1K,64K,1M,16M"
+COMMANDS = ("cd", "mkdir", "rm", "ul", "dl", "info", "mv")
+
+SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+# seconds between two samples of the server's memory and threads
+SAMPLE_INTERVAL = 0.2
+
+
+def parse_size(text):
+    """
+    :param text: a size such as '512', '1K', '64M' or '2G'
+    :return: the size in bytes
+    """
+    text = text.strip().upper().rstrip("B")
+    suffix = text[-1:] if text[-1:] in SIZE_SUFFIXES else ""
+    return int(float(text[:len(text) - len(suffix)]) * SIZE_SUFFIXES[suffix])
+
+
+def parse_mix(text):
+    """
+    :param text: comma separated 'command=weight' pairs, e.g. 'ul=3,dl=3,info=1'
+    :return: dict of command to weight
+    """
+    mix = {}
+    for item in text.split(","):
+        command, _, weight = item.partition("=")
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"Unknown command '{command}', use one of {', '.join(COMMANDS)}")
+        mix[command] = float(weight or 1)
+    return mix
+
+
+def percentile(values, percent):
+    """
+    :param values: sorted list of numbers
+    :param percent: 0 to 100
+    :return: the nearest-rank percentile, None if values is empty
+    """
+    if not values:
+        return None
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def read_process_status(pid):
+    """
+    :return: tuple of (resident memory in bytes, number of threads) of a process, None where unknown.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            fields = dict(line.split(":", 1) for line in status if ":" in line)
+        return int(fields["VmRSS"].split()[0]) * 1024, int(fields["Threads"])
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None, None
+    try:
+        process = psutil.Process(pid)
+        return process.memory_info().rss, process.num_threads()
+    except psutil.Error:
+        return None, None
+
+
+class ServerProcess:
+    """
+    The server under test: a child process serving a scratch directory on 127.0.0.1, with a thread that samples its
+    memory and thread count until stop().
+    """
+
+    def __init__(self, directory, server_args):
+        self.directory = directory
+        self.port = find_free_port()
+        self.server_args = server_args
+        self.process = None
+        self.samples = []
+        self.sampling = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self, timeout=10):
+        source = os.path.dirname(os.path.abspath(__file__))
+        for name in SERVER_FILES:
+            shutil.copy(os.path.join(source, name), self.directory)
+
+        log_path = os.path.join(self.directory, "server.log")
+        with open(log_path, "wb") as log:
+            self.process = subprocess.Popen(
+                [sys.executable, "server.py", "--port", str(self.port), *self.server_args],
+                cwd=self.directory, stdout=log, stderr=subprocess.STDOUT)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {self.process.returncode}, see {log_path}")
+            with open(log_path, "rb") as log:
+                if b"Server listening" in log.read():
+                    break
+            time.sleep(0.05)
+        else:
+            raise RuntimeError(f"Server did not start within {timeout} seconds")
+
+        self.sampling.set()
+        self.sampler.start()
+
+    def sample(self):
+        while self.sampling.is_set() and self.process.poll() is None:
+            rss, threads = read_process_status(self.process.pid)
+            if rss is not None:
+                self.samples.append((rss, threads))
+            time.sleep(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self.sampling.clear()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.sampler.is_alive():
+            self.sampler.join(timeout=1)
+
+    def resources(self):
+        if not self.samples:
+            return {"samples": 0}
+        return {
+            "samples": len(self.samples),
+            "peak_rss_bytes": max(rss for rss, _ in self.samples),
+            "final_rss_bytes": self.samples[-1][0],
+            "peak_threads": max(threads for _, threads in self.samples),
+            "final_threads": self.samples[-1][1],
+        }
+
+
+class ScriptedClient(threading.Thread):
+    """
+    One benchmark client: its own connection and its own directory on the server, in which it runs `operations`
+    commands drawn from the mix. Commands that need an existing file or directory fall back to creating one first.
+    """
+
+    def __init__(self, number, port, payloads, mix, operations, seed, options):
+        threading.Thread.__init__(self, daemon=True)
+        self.number = number
+        self.port = port
+        # size -> local file of that size
+        self.payloads = payloads
+        self.mix = mix
+        self.operations = operations
+        self.random = random.Random(seed)
+        self.client = client.Client("127.0.0.1", port, listing=options.listing, verbose=False,
+                                    compression=options.compression, checksums=not options.no_checksums)
+        self.client.local_directory = os.path.dirname(next(iter(payloads.values())))
+        self.download_path = os.path.join(self.client.local_directory, f"download-{number}.bin")
+        self.client_socket = None
+        self.files = []
+        self.directories = []
+        self.counter = 0
+        # command -> list of latencies in seconds
+        self.latencies = {}
+        self.errors = {}
+        self.uploaded = 0
+        self.downloaded = 0
+        self.failure = None
+
+    def run(self):
+        try:
+            self.client_socket = self.client.initialize("127.0.0.1", self.port)[0]
+            self.command(f"mkdir bench-{self.number}", record=False)
+            self.command(f"cd bench-{self.number}", record=False)
+            commands = list(self.mix)
+            weights = [self.mix[command] for command in commands]
+            for _ in range(self.operations):
+                getattr(self, f"run_{self.random.choices(commands, weights)[0]}")()
+            self.client.send_command("exit", self.client_socket)
+        except Exception as e:
+            self.failure = f"{type(e).__name__}: {e}"
+        finally:
+            if self.client_socket is not None:
+                self.client_socket.close()
+
+    def command(self, command, record=True, file_path=None, upload=None):
+        """
+        Runs one command and records its latency, from sending it to receiving the status frame.
+        :return: True if the server answered STATUS_OK.
+        """
+        verb = command.split(" ", 1)[0]
+        started = time.perf_counter()
+        if upload is not None:
+            request_id = self.client.send_upload(command, self.client_socket, upload)
+        else:
+            request_id = self.client.send_command(command, self.client_socket)
+        reply = self.client.receive_reply(self.client_socket, request_id, file_path)
+        if record:
+            self.latencies.setdefault(verb, []).append(time.perf_counter() - started)
+            if not reply.ok:
+                self.errors[verb] = self.errors.get(verb, 0) + 1
+        return reply.ok
+
+    def new_name(self, prefix):
+        self.counter += 1
+        return f"{prefix}{self.counter}"
+
+    def run_ul(self):
+        size = self.random.choice(list(self.payloads))
+        name = self.new_name("f")
+        if self.command(f"ul {name}", upload=self.payloads[size]):
+            self.files.append((name, size))
+            self.uploaded += size
+
+    def run_dl(self):
+        if not self.files:
+            return self.run_ul()
+        name, size = self.random.choice(self.files)
+        if self.command(f"dl {name}", file_path=self.download_path):
+            self.downloaded += size
+
+    def run_info(self):
+        if not self.files:
+            return self.run_ul()
+        self.command(f"info {self.random.choice(self.files)[0]}")
+
+    def run_mv(self):
+        if not self.files:
+            return self.run_ul()
+        index = self.random.randrange(len(self.files))
+        name, size = self.files[index]
+        new_name = self.new_name("f")
+        if self.command(f"mv {name} {new_name}"):
+            self.files[index] = (new_name, size)
+
+    def run_rm(self):
+        if not self.files:
+            return self.run_ul()
+        name, _ = self.files.pop(self.random.randrange(len(self.files)))
+        self.command(f"rm {name}")
+
+    def run_mkdir(self):
+        name = self.new_name("d")
+        if self.command(f"mkdir {name}"):
+            self.directories.append(name)
+
+    def run_cd(self):
+        if not self.directories:
+            return self.run_mkdir()
+        # the way back is not timed: one cd operation is one recorded command
+        if self.command(f"cd {self.random.choice(self.directories)}"):
+            self.command("cd ..", record=False)
+
+
+def create_payloads(directory, sizes):
+    """
+    Creates one local file per size to upload. The content is one random MiB repeated, so it neither compresses
+    nor takes long to write for sizes of several GB.
+    :return: dict of size to file path
+    """
+    block = os.urandom(1024 * 1024)
+    payloads = {}
+    for size in sizes:
+        path = os.path.join(directory, f"payload-{size}.bin")
+        with open(path, "wb") as payload:
+            remaining = size
+            while remaining:
+                remaining -= payload.write(block[:min(remaining, len(block))])
+        payloads[size] = path
+    return payloads
+
+
+def summarize(clients, elapsed):
+    latencies = {}
+    errors = {}
+    for scripted in clients:
+        for verb, values in scripted.latencies.items():
+            latencies.setdefault(verb, []).extend(values)
+        for verb, count in scripted.errors.items():
+            errors[verb] = errors.get(verb, 0) + count
+
+    commands = {}
+    for verb, values in sorted(latencies.items()):
+        values.sort()
+        commands[verb] = {
+            "count": len(values),
+            "errors": errors.get(verb, 0),
+            "mean_ms": sum(values) / len(values) * 1000,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": values[-1] * 1000,
+        }
+
+    operations = sum(len(values) for values in latencies.values())
+    uploaded = sum(scripted.uploaded for scripted in clients)
+    downloaded = sum(scripted.downloaded for scripted in clients)
+    return {
+        "duration_seconds": elapsed,
+        "operations": operations,
+        "operations_per_second": operations / elapsed if elapsed else 0.0,
+        "errors": sum(errors.values()),
+        "uploaded_bytes": uploaded,
+        "downloaded_bytes": downloaded,
+        "upload_mb_per_second": uploaded / elapsed / 1e6 if elapsed else 0.0,
+        "download_mb_per_second": downloaded / elapsed / 1e6 if elapsed else 0.0,
+        "commands": commands,
+        "client_failures": [f"client {scripted.number}: {scripted.failure}" for scripted in clients if scripted.failure],
+    }
+
+
+def run_benchmark(options):
+    """
+    Runs one benchmark with the parsed command line options.
+    :return: the results as a dict, see the module docstring
+    """
+
+    mix = parse_mix(options.mix)
+    sizes = sorted({parse_size(size) for size in options.sizes.split(",")})
+    server_args = ["--engine", options.engine, "--workers", str(options.workers),
+                   "--max-connections", str(max(options.clients, options.max_connections)),
+                   "--compression", options.server_compression, "--processes", str(options.processes),
+                   "--rate-limit", str(options.rate_limit), "--session-rate-limit", str(options.session_rate_limit),
+                   "--max-transfers", str(options.max_transfers)]
+    if options.no_sendfile:
+        server_args.append("--no-sendfile")
+    if options.chunk_size:
+        server_args += ["--chunk-size", str(options.chunk_size)]
+    if options.no_checksums:
+        server_args.append("--no-checksums")
+    if options.dedup:
+        server_args.append("--dedup")
+
+    scratch = tempfile.mkdtemp(prefix="fileserver-benchmark-", dir=options.scratch)
+    server_directory = os.path.join(scratch, "server")
+    client_directory = os.path.join(scratch, "client")
+    os.makedirs(server_directory)
+    os.makedirs(client_directory)
+    server = ServerProcess(server_directory, server_args)
+    try:
+        payloads = create_payloads(client_directory, sizes)
+        server.start()
+        clients = [ScriptedClient(number, server.port, payloads, mix, options.operations, options.seed + number, options)
+                   for number in range(options.clients)]
+        started = time.perf_counter()
+        for scripted in clients:
+            scripted.start()
+        for scripted in clients:
+            scripted.join()
+        elapsed = time.perf_counter() - started
+        resources = server.resources()
+    finally:
+        server.stop()
+        if not options.keep:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    results = {
+        "config": {
+            "clients": options.clients,
+            "operations_per_client": options.operations,
+            "mix": mix,
+            "sizes": sizes,
+            "engine": options.engine,
+            "workers": options.workers,
+            "sendfile": not options.no_sendfile,
+            "chunk_size": options.chunk_size,
+            "listing": options.listing,
+            "compression": options.compression,
+            "server_compression": options.server_compression,
+            "checksums": not options.no_checksums,
+            "processes": options.processes,
+            "dedup": options.dedup,
+            "rate_limit": options.rate_limit,
+            "session_rate_limit": options.session_rate_limit,
+            "max_transfers": options.max_transfers,
+            "protocol_version": protocol.PROTOCOL_VERSION,
+            "seed": options.seed,
+        },
+        **summarize(clients, elapsed),
+        "server": resources,
+    }
+    return results
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmark the file server on localhost")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent scripted clients")
+    parser.add_argument("--operations", type=int, default=100, help="commands per client")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"command weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"file sizes to upload (default: {DEFAULT_SIZES})")
+    parser.add_argument("--engine", choices=("thread", "select"), default="thread", help="server engine")
+    parser.add_argument("--workers", type=int, default=32, help="worker threads of the select engine")
+    parser.add_argument("--max-connections", type=int, default=1000, help="maximum number of open sessions")
+    parser.add_argument("--no-sendfile", action="store_true", help="server sends downloads with buffered reads")
+    parser.add_argument("--chunk-size", type=int, default=None, help="payload bytes per data frame of downloads")
+    parser.add_argument("--listing", choices=("always", "never"), default="never",
+                        help="send the directory info after every command or not")
+    parser.add_argument("--compression", default="none", help="codecs the clients offer, 'none' to disable")
+    parser.add_argument("--server-compression", default=",".join(protocol.CODECS),
+                        help="codecs the server allows")
+    parser.add_argument("--no-checksums", action="store_true", help="transfers without checksums")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes of the server, the memory and threads reported are then those of its "
+                             "supervisor")
+    parser.add_argument("--dedup", action="store_true", help="server stores uploads in its dedup store")
+    parser.add_argument("--rate-limit", type=int, default=0,
+                        help="bytes per second of all transfers of the server, 0 for no limit")
+    parser.add_argument("--session-rate-limit", type=int, default=0,
+                        help="bytes per second of the transfers of each session, 0 for no limit")
+    parser.add_argument("--max-transfers", type=int, default=0,
+                        help="transfers the server runs at once, 0 for no limit")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random command mix")
+    parser.add_argument("--scratch", default=None, help="directory for the scratch files (default: system temp)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory and the server log")
+    parser.add_argument("--output", default=None, help="write the JSON results to this file instead of stdout")
+    options = parser.parse_args()
+
+    results = run_benchmark(options)
+    text = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+    return 1 if results["client_failures"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -1,13 +1,378 @@
+import argparse
+import heapq
+import shlex
 import socket
 import os
+import sys
 import pathlib
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock
+
+import dedup
+import delta
+import protocol
+import tree
+from protocol import (MSG_COMMAND, MSG_LISTING, MSG_TEXT, MSG_STATUS, MSG_TRANSFER, MSG_END, STATUS_OK, STATUS_ERROR,
+                      STATUS_INVALID)
+
+# length of the eof token the server sends first, including '<' and '>'
+EOF_TOKEN_LENGTH = 10
+
+# commands pipeline() sends ahead of their replies, small enough to always fit in the socket buffers
+PIPELINE_WINDOW = 64
+
+# commands whose reply is only a status (and the directory info in listing mode 'always'), pipeline() keeps them in
+# flight while an ul streams its file
+SMALL_REPLY_COMMANDS = ("cd", "mkdir", "rm", "mv", "info", "pwd", "ul")
+
+# commands execute() runs on their own instead of pipelining them, they exchange more than one message each way;
+# so do 'ul -r' and 'dl -r'
+STREAMING_COMMANDS = ("mput", "mget", "sync")
+
+# exit codes of batch mode
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_CONNECTION = 2
+
+# parallel connections mput/mget spread their files over
+DEFAULT_CONNECTIONS = 4
+
+# files (and bytes) sent in one mput/mget stream, each stream costs one command and one status round trip
+BATCH_FILES = 500
+BATCH_BYTES = 256 * 1024 * 1024
+
+# striped downloads (dl --stripes) fetch a file in ranges of this size over several connections at once; smaller
+# files than two ranges are downloaded over one connection
+STRIPE_SIZE = 8 * 1024 * 1024
+
+# connections of a striped download with --stripes=auto: it starts with INITIAL_STRIPES (or the count the previous
+# one settled on) and opens one more while the last one raised the throughput by STRIPE_GAIN, measured over at least
+# STRIPE_INTERVAL seconds, up to MAX_STRIPES
+INITIAL_STRIPES = 2
+MAX_STRIPES = 16
+STRIPE_GAIN = 1.1
+STRIPE_INTERVAL = 0.5
+
+# times a range is fetched again after it failed, e.g. because it did not match its checksum
+STRIPE_RETRIES = 2
+
+
+class Reply(namedtuple("Reply", "request_id status message listing texts")):
+    """
+    The reply to one command: the status code and message from the MSG_STATUS frame, the directory info if the
+    server sent one (None otherwise) and the list of MSG_TEXT payloads, e.g. the result of info.
+    """
+
+    @property
+    def ok(self):
+        return self.status == STATUS_OK
+
+
+class CommandResult(namedtuple("CommandResult", "command status message texts listing")):
+    """
+    The outcome of one command run by Client.execute(): the command as given, the status code and message (None and
+    'not run' if an earlier failure stopped the batch), the MSG_TEXT payloads and the directory info if any.
+    """
+
+    @property
+    def ok(self):
+        return self.status == STATUS_OK
+
+    @classmethod
+    def from_reply(cls, command, reply):
+        return cls(command, reply.status, reply.message, reply.texts, reply.listing)
+
+
+def local_failure(message):
+    """
+    :return: a Reply for a command that failed on the client, before anything was sent.
+    """
+
+    return Reply(None, STATUS_ERROR, message, None, [])
+
+
+class TransferProgress:
+    """
+    Aggregate progress of a multi-file transfer running on several connections at once. Every connection calls add()
+    after each file, a progress line is printed at most once per interval and finish() prints the totals.
+    """
+
+    def __init__(self, label, total_files, total_bytes, interval=1.0, verbose=True):
+        self.label = label
+        self.verbose = verbose
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.lock = Lock()
+        self.files = 0
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.last_report = self.started
+
+    def add(self, nbytes):
+        with self.lock:
+            self.files += 1
+            self.bytes += nbytes
+            now = time.perf_counter()
+            if self.verbose and now - self.last_report >= self.interval:
+                self.last_report = now
+                print(f"{self.label}: {self.files}/{self.total_files} files, "
+                      f"{self.bytes / 1e6:.1f}/{self.total_bytes / 1e6:.1f} MB, {self.rate() / 1e6:.1f} MB/s")
+
+    def rate(self):
+        elapsed = time.perf_counter() - self.started
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def finish(self, connections):
+        elapsed = time.perf_counter() - self.started
+        print(f"{self.label}: {self.files} files, {self.bytes / 1e6:.1f} MB in {elapsed:.2f} s "
+              f"({self.rate() / 1e6:.1f} MB/s, {self.files / elapsed if elapsed > 0 else 0:.0f} files/s) "
+              f"over {connections} connections")
+
+
+class ConnectionPool:
+    """
+    Extra connections to the server for mput/mget, opened on first use and kept until close(). They are quiet
+    sessions in listing mode 'never' with their own working directory, so each batch starts with a cd to the
+    directory of the interactive session.
+    """
+
+    def __init__(self, host, port, size=DEFAULT_CONNECTIONS, compression="none", checksums=True):
+        self.host = host
+        self.port = port
+        self.size = max(1, size)
+        self.compression = compression
+        self.checksums = checksums
+        # (Client, socket) per connection
+        self.connections = []
+
+    def get(self, count=None):
+        """
+        :param count: number of connections needed, self.size by default; more are opened if needed, e.g. for the
+            streams of a striped download
+        :return: list of (Client, socket) tuples, one per pooled connection.
+        """
+
+        count = self.size if count is None else count
+        while len(self.connections) < count:
+            client = Client(self.host, self.port, listing="never", verbose=False, compression=self.compression,
+                            checksums=self.checksums)
+            self.connections.append((client, client.initialize(self.host, self.port)[0]))
+        return self.connections[:count]
+
+    def run(self, function, jobs):
+        """
+        Runs function(client, socket, job) for each job on its own pooled connection, all at once.
+        :param function: called with a Client, its socket and one job.
+        :param jobs: at most self.size jobs.
+        :return: list of the results, in the order of jobs.
+        """
+
+        connections = self.get()
+        with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+            futures = [executor.submit(function, client, client_socket, job)
+                       for (client, client_socket), job in zip(connections, jobs)]
+            return [future.result() for future in futures]
+
+    def discard(self, connection):
+        """
+        Closes a (Client, socket) connection that failed and drops it from the pool, the next get() opens a new one.
+        """
+
+        connection[1].close()
+        self.connections.remove(connection)
+
+    def close(self):
+        for client, client_socket in self.connections:
+            try:
+                client.send_command("exit", client_socket)
+            except OSError:
+                pass
+            client_socket.close()
+        self.connections = []
+
+
+class StripedDownload:
+    """
+    Shared state of one striped download (see Client.striped_download()): the ranges of the file still to fetch,
+    handed out one at a time to the streams, which write them in place into the preallocated file, and the bytes
+    done so far, by which the throughput is measured. A range that failed goes back to the queue, so a stream that
+    is slower than the others or drops out only costs the ranges it was holding.
+    """
+
+    def __init__(self, file_name, path, size):
+        """
+        :param file_name: the name of the file on the server
+        :param path: the local file the ranges are written into, already extended to size
+        :param size: the size of the file
+        """
+        self.file_name = file_name
+        self.path = path
+        self.condition = Condition()
+        # (offset, length, attempts) of the ranges not fetched yet
+        self.ranges = deque((offset, min(STRIPE_SIZE, size - offset), 0) for offset in range(0, size, STRIPE_SIZE))
+        self.in_flight = 0
+        self.done_bytes = 0
+        self.done_ranges = 0
+        self.errors = []
+        # streams started and not ended yet
+        self.streams = 0
+
+    @property
+    def finished(self):
+        """
+        True once all ranges are in place, or the download cannot complete any more. Called with self.condition held.
+        """
+        return bool(self.errors) or not self.streams or not (self.ranges or self.in_flight)
+
+    def add_stream(self):
+        with self.condition:
+            self.streams += 1
+
+    def measure(self, streams):
+        """
+        Waits until every stream fetched at least one more range and STRIPE_INTERVAL passed.
+        :param streams: number of streams running
+        :return: the throughput over the wait in bytes per second, None if the download finished first
+        """
+        with self.condition:
+            started = time.perf_counter()
+            done_bytes, done_ranges = self.done_bytes, self.done_ranges
+            while not self.finished:
+                elapsed = time.perf_counter() - started
+                if elapsed >= STRIPE_INTERVAL and self.done_ranges - done_ranges >= streams:
+                    return (self.done_bytes - done_bytes) / elapsed
+                self.condition.wait(max(STRIPE_INTERVAL - elapsed, STRIPE_INTERVAL / 10))
+            return None
+
+    def next_range(self):
+        """
+        :return: the next (offset, length, attempts) to fetch, None once all are done or one failed for good. Waits
+            while the last ranges are in flight on other streams, they may fail and come back.
+        """
+        with self.condition:
+            while not self.ranges and self.in_flight and not self.errors:
+                self.condition.wait()
+            if self.errors or not self.ranges:
+                return None
+            self.in_flight += 1
+            return self.ranges.popleft()
+
+    def finish_range(self, entry, error=None):
+        """
+        :param entry: the (offset, length, attempts) returned by next_range()
+        :param error: why fetching it failed, None if it is in place
+        """
+        offset, length, attempts = entry
+        with self.condition:
+            self.in_flight -= 1
+            if error is None:
+                self.done_bytes += length
+                self.done_ranges += 1
+            elif attempts < STRIPE_RETRIES:
+                self.ranges.append((offset, length, attempts + 1))
+            else:
+                self.errors.append(f"bytes {offset}-{offset + length - 1}: {error}")
+            self.condition.notify_all()
+
+    def run_stream(self, client, stream_socket, directory):
+        """
+        Runs on a pooled connection: fetches ranges with 'dl --offset=N --length=N' until none are left.
+        :param directory: the working directory of the interactive session on the server
+        :return: False if the connection failed and must not be used again
+        """
+        try:
+            try:
+                client.change_directory(stream_socket, directory)
+            except (OSError, protocol.ProtocolError):
+                return False
+            while True:
+                entry = self.next_range()
+                if entry is None:
+                    return True
+                offset, length, _ = entry
+                try:
+                    request_id = client.send_command(f"dl --offset={offset} --length={length} {self.file_name}",
+                                                     stream_socket)
+                    reply = client.receive_reply(stream_socket, request_id, self.path)
+                except (OSError, protocol.ProtocolError) as e:
+                    # the other streams take over the range
+                    self.finish_range(entry, f"connection failed: {e}")
+                    return False
+                self.finish_range(entry, None if reply.ok else reply.message)
+        finally:
+            with self.condition:
+                self.streams -= 1
+                self.condition.notify_all()
+
+
+def partition_by_size(entries, parts):
+    """
+    Spreads (size, name) entries over `parts` lists with about the same total size each, largest first.
+    :return: the non-empty lists.
+    """
+
+    heap = [(0, index, []) for index in range(parts)]
+    for entry in sorted(entries, reverse=True):
+        total, index, part = heapq.heappop(heap)
+        part.append(entry)
+        heapq.heappush(heap, (total + entry[0], index, part))
+    return [part for _, _, part in sorted(heap, key=lambda item: item[1]) if part]
+
+
+def split_batches(entries):
+    """
+    Cuts (size, name) entries into batches of at most BATCH_FILES files and about BATCH_BYTES bytes.
+    """
+
+    batch, batch_bytes = [], 0
+    for entry in entries:
+        if batch and (len(batch) >= BATCH_FILES or batch_bytes + entry[0] > BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(entry)
+        batch_bytes += entry[0]
+    if batch:
+        yield batch
+
 
 class Client:
-    def __init__(self, host, port):
+    def __init__(self, host, port, listing="always", verbose=True, connections=DEFAULT_CONNECTIONS,
+                 compression=None, checksums=True, stripes=1):
         self.host = host
         self.port = port
         self.client_socket = None
         self.eof_token = None
+        self.protocol_version = None
+        # "always": the server sends the directory info after every command, "never": only on ls
+        self.listing_mode = listing
+        self.last_request_id = 0
+        # receive downloads straight into a memory-mapped, preallocated file
+        self.use_mmap = True
+        # uploads are read from and downloads written to this directory
+        self.local_directory = pathlib.Path(__file__).parent.resolve()
+        self.transfer_stats = protocol.TransferStats()
+        # codecs offered in the handshake in order of preference (all registered ones by default, 'none': no
+        # compression), and the one the server chose
+        self.compression = ",".join(protocol.CODECS) if compression is None else compression
+        self.codec = None
+        # whether to offer checksummed transfers in the handshake, and whether the server agreed: then every
+        # transfer carries the checksum of its data, and a download that does not match it is thrown away
+        self.checksums = checksums
+        self.checksum = False
+        # chunk size of the server's dedup store, 0 if it has none; uploads then send only the chunks it lacks
+        self.dedup_chunk_size = 0
+        # pooled connections do their work quietly and report to the TransferProgress of the mput/mget
+        self.verbose = verbose
+        self.progress = None
+        self.pool = ConnectionPool(host, port, connections, self.compression, checksums)
+        # connections a dl fetches a large file over (see striped_download()), 1 for one, 0 to size it by the
+        # measured throughput; dl --stripes=N|auto overrides it for one download. The count an automatically sized
+        # download settled on is where the next one starts.
+        self.stripes = stripes
+        self.stripe_hint = INITIAL_STRIPES
 
 
     def receive_message_ending_with_token(self, active_socket, buffer_size, eof_token):
@@ -15,6 +380,7 @@ class Client:
         Same implementation as in receive_message_ending_with_token() in server.py
         A helper method to receives a bytearray message of arbitrary size sent on the socket.
         This method returns the message WITHOUT the eof_token at the end of the last packet.
+        It is only used for the handshake, every message after it is a frame (see protocol.py).
         :param active_socket: a socket object that is connected to the server
         :param buffer_size: the buffer size of each recv() call
         :param eof_token: a token that denotes the end of the message.
@@ -22,186 +388,1143 @@ class Client:
         """
 
         file_content = bytearray()
+        token = eof_token.encode()
 
         while True:
-            packet = active_socket.recv(buffer_size)
-            if packet[-len(eof_token):] == eof_token.encode():
-                file_content += packet[:-len(eof_token)]
-                break
-            file_content += packet
+            # peek first, frames may follow the message and must stay in the socket
+            packet = active_socket.recv(buffer_size, socket.MSG_PEEK)
+            if not packet:
+                raise ConnectionError("Connection closed during the handshake")
+
+            # the token may start in the bytes consumed by an earlier packet
+            index = (file_content[-len(token):] + packet).find(token)
+            if index >= 0:
+                end = index + len(token) - min(len(file_content), len(token))
+                packet = bytearray(end)
+                protocol.receive_into(active_socket, packet)
+                file_content += packet
+                return file_content[:-len(token)]
+
+            file_content += active_socket.recv(len(packet))
+
+
+    def send_command(self, command_and_arg, client_socket):
+        """
+        Sends a command to the server as a MSG_COMMAND frame with a new request id.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        :return: the request id of the command, the server tags every frame of its reply with it.
+        """
+
+        self.last_request_id += 1
+        protocol.send_frame(client_socket, MSG_COMMAND, command_and_arg.encode(), self.last_request_id)
+        return self.last_request_id
+
+
+    def receive_reply(self, client_socket, request_id, file_path=None, directory=None, basis_path=None,
+                      archive_directory=None):
+        """
+        Receives the frames the server sends for one command, up to and including the status frame which always
+        comes last. A file transfer is written to file_path as it arrives.
+        :param client_socket: the active client socket object.
+        :param request_id: the request id returned by send_command().
+        :param file_path: where to store a file sent by the server, only needed for dl.
+        :param directory: where to store the files of an mget, under the relative name the server sends for each.
+        :param basis_path: for sync --pull, the local copy the delta sent by the server refers to; the rebuilt file
+            is written to file_path.
+        :param archive_directory: for dl -r, where the tar stream sent by the server is unpacked.
+        :return: the Reply to the command. A file that did not match its checksum was thrown away, the Reply then
+            says so with STATUS_ERROR, whatever the server answered.
+        """
 
-        return file_content
+        listing = None
+        texts = []
+        corrupted = []
+        while True:
+            msg_type, reply_id, payload = protocol.receive_frame(client_socket)
+            if reply_id != request_id:
+                raise protocol.ProtocolError(f"Expected a reply to request {request_id}, got {reply_id}")
+
+            if msg_type == MSG_STATUS:
+                status, message = protocol.decode_status(payload)
+                if corrupted:
+                    status = STATUS_ERROR
+                    message = "; ".join(corrupted) if message == "ok" else "; ".join([message] + corrupted)
+                return Reply(request_id, status, message, listing, texts)
+            elif msg_type == MSG_LISTING:
+                listing = payload.decode()
+            elif msg_type == MSG_TEXT:
+                texts.append(payload.decode())
+            elif msg_type == MSG_TRANSFER and archive_directory is not None:
+                try:
+                    texts.extend(self.receive_tree(client_socket, request_id, archive_directory,
+                                                   protocol.decode_options(payload)))
+                except protocol.IntegrityError as e:
+                    corrupted.append(str(e))
+            elif msg_type == MSG_TRANSFER and basis_path is not None:
+                block_size = int(protocol.decode_options(payload).get("block_size", delta.MIN_BLOCK_SIZE))
+                self.receive_delta_file(client_socket, request_id, file_path, basis_path, block_size)
+            elif msg_type == MSG_TRANSFER and file_path is not None:
+                metadata = protocol.decode_options(payload)
+                offset = int(metadata["offset"]) if "offset" in metadata else None
+                try:
+                    self.receive_file(client_socket, request_id, file_path, int(metadata.get("size", 0)), offset,
+                                      protocol.decompressor_for(metadata))
+                except protocol.IntegrityError as e:
+                    corrupted.append(f"{os.path.basename(file_path)}: {e}")
+            elif msg_type == MSG_TRANSFER and directory is not None:
+                metadata = protocol.decode_options(payload)
+                destination = os.path.join(directory, protocol.safe_relative_path(metadata.get("name", "")))
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                try:
+                    self.receive_file(client_socket, request_id, destination, int(metadata.get("size", 0)),
+                                      decompressor=protocol.decompressor_for(metadata))
+                except protocol.IntegrityError as e:
+                    corrupted.append(f"{metadata.get('name', '')}: {e}")
+            else:
+                raise protocol.ProtocolError(f"Unexpected message type {msg_type} in reply to request {request_id}")
+
+
+    def show_reply(self, reply, prefix=None):
+        """
+        Prints a reply for the user: text results, the error if the command failed and the directory info.
+        :param reply: the Reply returned by receive_reply().
+        :param prefix: printed in front of the directory info.
+        """
+
+        for text in reply.texts:
+            print(text)
+        if not reply.ok:
+            print("Error from server:", reply.message)
+        if reply.listing is not None:
+            if prefix:
+                print(prefix, reply.listing)
+            else:
+                print(reply.listing)
+
+
+    def receive_file(self, client_socket, request_id, file_path, size, offset=None, decompressor=None):
+        """
+        Receives the data frames of a file transfer into file_path. If the size is known, the destination is
+        preallocated and memory-mapped so the data is received in place, otherwise it is written chunk by chunk.
+        The throughput of both paths is recorded in self.transfer_stats, compressed transfers under their codec.
+        :param client_socket: the active client socket object.
+        :param request_id: the request id of the dl command.
+        :param file_path: where to store the file.
+        :param size: the size announced by the server in the MSG_TRANSFER frame.
+        :param offset: for a ranged transfer, where the data goes in file_path; the rest of the file is kept.
+            None replaces the whole file.
+        :param decompressor: a StreamDecompressor if the server compressed the transfer.
+        :raises protocol.IntegrityError: if the data does not match the checksum of the transfer. A whole file is
+            removed again, a range written past the old end of the file is cut off, e.g. from a resumed download.
+        """
+
+        if offset is None:
+            mode = 'wb+'
+        else:
+            mode = 'rb+' if os.path.exists(file_path) else 'wb+'
+
+        checksum = protocol.new_checksum() if self.checksum else None
+        started = time.perf_counter()
+        with open(file_path, mode) as f:
+            original_size = os.fstat(f.fileno()).st_size
+            try:
+                if self.use_mmap and size > 0:
+                    path = "mmap"
+                    received = protocol.receive_file_data_mapped(client_socket, f, size, request_id, offset or 0,
+                                                                 decompressor, checksum)
+                else:
+                    path = "buffered"
+                    f.seek(offset or 0)
+                    received = protocol.receive_file_data(client_socket, f, request_id, decompressor=decompressor,
+                                                          checksum=checksum, size=size)
+            except protocol.IntegrityError:
+                if offset is not None and original_size <= offset:
+                    f.truncate(offset)
+                elif offset is None:
+                    f.close()
+                    os.remove(file_path)
+                raise
+        wire_bytes = received
+        if decompressor is not None:
+            path = f"{path}+{decompressor.codec}"
+            wire_bytes = decompressor.wire_bytes
+        self.transfer_stats.record(path, received, time.perf_counter() - started, wire_bytes)
+
+        if self.progress is not None:
+            self.progress.add(received)
+        if self.verbose:
+            print(f"File '{os.path.basename(file_path)}' downloaded to '{file_path}' ({received} bytes, "
+                  f"{wire_bytes} on the wire, via {path}, "
+                  f"average {path} throughput: {self.transfer_stats.rate(path) / 1e6:.1f} MB/s)")
+
+
+    def receive_tree(self, client_socket, request_id, directory, metadata):
+        """
+        Unpacks the tar stream of a dl -r into directory (see tree.receive_archive()).
+        :return: the list of errors, e.g. members that were skipped
+        :raises protocol.IntegrityError: if the stream did not match its checksum; the files are unpacked by then
+        """
+
+        started = time.perf_counter()
+        files, reader, errors = tree.receive_archive(client_socket, request_id, directory,
+                                                     protocol.decompressor_for(metadata),
+                                                     protocol.new_checksum() if self.checksum else None)
+        self.transfer_stats.record("tar", reader.raw_bytes, time.perf_counter() - started, reader.wire_bytes)
+        if self.verbose:
+            print(f"Directory '{metadata.get('name', '')}' downloaded to '{directory}' ({files} files, "
+                  f"{reader.raw_bytes} bytes of archive, {reader.wire_bytes} on the wire)")
+        if reader.corrupted:
+            # the mismatch is the last error, the files unpacked before it arrived cannot be trusted
+            raise protocol.IntegrityError(f"archive of '{metadata.get('name', '')}': {errors[-1]}")
+        return errors
+
+
+    def receive_delta_file(self, client_socket, request_id, file_path, basis_path, block_size):
+        """
+        Rebuilds a file from the delta the server sends for sync --pull and the local basis.
+        :param client_socket: the active client socket object.
+        :param request_id: the request id of the sync command.
+        :param file_path: where to write the rebuilt file.
+        :param basis_path: the local copy the delta refers to.
+        :param block_size: the block size of the signature the client sent.
+        """
+
+        basis = open(basis_path, 'rb') if os.path.exists(basis_path) else None
+        try:
+            with open(file_path, 'wb') as f:
+                literal, reused = delta.receive_delta(client_socket, basis, f, request_id, block_size)
+        finally:
+            if basis is not None:
+                basis.close()
+        if self.verbose:
+            print(f"Synced '{os.path.basename(basis_path)}': {literal} bytes received, {reused} bytes reused")
 
 
     def initialize(self, host, port):
         """
         1) Creates a socket object and connects to the server.
         2) receives the random token (10 bytes) used to indicate end of messages.
-        3) Displays the current working directory returned from the server (output of get_working_directory_info() at the server).
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        3) Negotiates the protocol version, the listing mode, the compression codec and checksums, the server
+           answers 'hello versions=... listing=... compression=... checksum=...' with 'welcome version=... ...'.
+        4) Displays the current working directory returned from the server (output of get_working_directory_info() at the server).
+        Use the helper method: receive_message_ending_with_token() to receive the handshake messages from the server.
         :param host: the ip address of the server
         :param port: the port number of the server
-        :return: the created socket object
+        :return: the created socket object and the eof token
         """
 
         # print('Connected to server at IP:', host, 'and Port:', port)
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client_socket.connect((host, port))
-        print("Connected to server at IP:", host, "and Port:", port)
+        protocol.configure_socket(client_socket)
+        if self.verbose:
+            print("Connected to server at IP:", host, "and Port:", port)
 
         # print('Handshake Done. EOF is:', eof_token)
-        eof_token = client_socket.recv(1024)
+        eof_token = bytearray(EOF_TOKEN_LENGTH)
+        protocol.receive_into(client_socket, eof_token)
         eof_token = eof_token.decode()
-        print("Handshake Done. EOF is:", eof_token)
 
-        print(self.receive_message_ending_with_token(client_socket, 1024, eof_token).decode())
+        versions = ",".join(str(v) for v in protocol.SUPPORTED_VERSIONS)
+        codecs = ",".join(codec for codec in self.compression.split(",") if codec in protocol.CODECS)
+        hello = f"hello versions={versions} listing={self.listing_mode} compression={codecs}"
+        if self.checksums:
+            hello += f" checksum={protocol.CHECKSUM}"
+        client_socket.sendall(f"{hello}{eof_token}".encode())
+        reply = self.receive_message_ending_with_token(client_socket, 1024, eof_token).decode()
+        if not reply.startswith("welcome "):
+            client_socket.close()
+            raise protocol.ProtocolError(f"Server does not support this client's protocol versions: {reply}")
+        settings = protocol.decode_options(reply)
+        self.protocol_version = int(settings["version"])
+        self.listing_mode = settings.get("listing", "always")
+        self.codec = settings.get("compression") if settings.get("compression") in protocol.CODECS else None
+        self.checksum = settings.get("checksum") == protocol.CHECKSUM
+        self.dedup_chunk_size = int(settings.get("dedup", 0))
+        msg_type, _, payload = protocol.receive_frame(client_socket)
+        if msg_type != MSG_LISTING:
+            raise protocol.ProtocolError(f"Expected the directory info, got message type {msg_type}")
+        if self.verbose:
+            print("Handshake Done. EOF is:", eof_token, "Protocol version:", self.protocol_version,
+                  "Compression:", self.codec or "none", "Checksum:", protocol.CHECKSUM if self.checksum else "none")
+            print(payload.decode())
+
+        self.client_socket = client_socket
+        self.eof_token = eof_token
         return client_socket, eof_token
 
 
-    def issue_cd(self, command_and_arg, client_socket, eof_token):
+    def local_path(self, file_name):
+        """
+        :param file_name: name of a file in the client's directory
+        :return: the absolute path of the file, uploads are read from and downloads written to the client's directory.
+        """
+
+        return os.path.join(self.local_directory, file_name)
+
+
+    def send_upload(self, command_and_arg, client_socket, file_path, offset=0, length=None):
+        """
+        Sends an ul command followed by the content of the file, without waiting for the reply.
+        :param command_and_arg: full ul command (with argument), with --offset=N if offset is not 0.
+        :param client_socket: the active client socket object.
+        :param file_path: the local file to upload.
+        :param offset: first byte of the file to send.
+        :param length: number of bytes to send, None for the rest of the file.
+        :return: the request id of the command.
+        """
+
+        if self.dedup_chunk_size and not offset and length is None:
+            return self.send_chunked_upload(command_and_arg, client_socket, file_path)
+
+        request_id = self.send_command(command_and_arg, client_socket)
+        with open(file_path, 'rb') as f:
+            total = os.fstat(f.fileno()).st_size
+            size = max(0, total - offset) if length is None else max(0, min(length, total - offset))
+            f.seek(offset)
+            sent, wire_bytes, path = self.upload_file(client_socket, f, request_id, size, {"total": total})
+        if self.verbose:
+            print(f"Sent {sent} bytes of '{os.path.basename(file_path)}', {wire_bytes} on the wire, via {path}")
+        return request_id
+
+
+    def send_chunked_upload(self, command_and_arg, client_socket, file_path):
+        """
+        Uploads a whole file to a server with a dedup store: asks which of the file's chunks the server has and
+        sends those as references only (see dedup.send_chunks()). Waits for the 'have' replies, but not for the
+        reply to the ul.
+        :return: the request id of the ul command.
+        """
+
+        with open(file_path, 'rb') as f:
+            started = time.perf_counter()
+            checksum = protocol.new_checksum() if self.checksum else None
+            digests = dedup.file_digests(f, self.dedup_chunk_size, checksum)
+            known = self.known_chunks([digest for digest, _ in digests], client_socket)
+            verb, _, rest = command_and_arg.partition(" ")
+            request_id = self.send_command(f"{verb} --dedup {rest}", client_socket)
+            compressor = protocol.StreamCompressor(self.codec) if self.codec else None
+            literal, reused = dedup.send_chunks(client_socket, f, request_id, digests, known, self.dedup_chunk_size,
+                                                compressor, checksum.hexdigest() if checksum is not None else None)
+        if compressor is not None and compressor.enabled and literal:
+            path, wire_bytes = compressor.codec, compressor.wire_bytes
+        else:
+            path, wire_bytes = "buffered", literal
+        self.transfer_stats.record(path, literal + reused, time.perf_counter() - started, wire_bytes)
+        if self.verbose:
+            print(f"Sent {literal} bytes of '{os.path.basename(file_path)}', {wire_bytes} on the wire, via {path}; "
+                  f"{reused} bytes the server already had")
+        return request_id
+
+
+    def known_chunks(self, digests, client_socket):
+        """
+        Asks the server which of the chunks it has, with one 'have' command per dedup.HAVE_BATCH digests.
+        :param digests: list of the hex digests of the chunks
+        :return: the set of the digests the server has
+        """
+
+        known = set()
+        for start in range(0, len(digests), dedup.HAVE_BATCH):
+            batch = digests[start:start + dedup.HAVE_BATCH]
+            reply = self.receive_reply(client_socket, self.send_command(f"have {' '.join(batch)}", client_socket))
+            if reply.ok and reply.texts:
+                known.update(digest for digest, flag in zip(batch, reply.texts[0]) if flag == "1")
+        return known
+
+
+    def upload_file(self, client_socket, file, request_id, size, metadata):
+        """
+        Sends the frames of one file, compressed with the session's codec unless the data does not compress and
+        with its checksum if the session negotiated checksums, and records the transfer in self.transfer_stats.
+        :return: tuple of (bytes sent, bytes on the wire, 'buffered' or the codec)
+        """
+
+        compressor = protocol.StreamCompressor(self.codec) if self.codec else None
+        started = time.perf_counter()
+        sent = protocol.send_file(client_socket, file, request_id, size, metadata=metadata, compressor=compressor,
+                                  checksum=protocol.new_checksum() if self.checksum else None)
+        if compressor is not None and compressor.enabled:
+            path, wire_bytes = compressor.codec, compressor.wire_bytes
+        else:
+            path, wire_bytes = "buffered", sent
+        self.transfer_stats.record(path, sent, time.perf_counter() - started, wire_bytes)
+        return sent, wire_bytes, path
+
+
+    def partial_upload_size(self, file_name, client_socket):
+        """
+        Asks the server how much of an interrupted upload of file_name it already has ('info --partial').
+        :return: the number of bytes, 0 if there is no partial upload.
+        """
+
+        request_id = self.send_command(f"info --partial {file_name}", client_socket)
+        reply = self.receive_reply(client_socket, request_id)
+        if not reply.ok or not reply.texts:
+            return 0
+        # 'Partial upload of <name>: <size> bytes'
+        return int(reply.texts[0].rsplit(": ", 1)[1].split()[0])
+
+
+    def pipeline(self, commands, client_socket, window=PIPELINE_WINDOW, stop_on_error=False):
+        """
+        Sends a batch of commands back to back instead of waiting for each reply, so a batch costs about one round
+        trip instead of one per command. Up to `window` commands are in flight, the replies are matched to the
+        commands by request id and returned in order. Before an ul streams its file, earlier replies that may be
+        large (file data, listings) are read, so neither side can block on a full socket buffer while the other one
+        is sending too.
+        With stop_on_error no command is sent once a failed reply was read; commands already in flight still run,
+        except after a cd, which is always awaited so that nothing runs in the wrong directory.
+        :param commands: list of full commands (with arguments), e.g. ['mkdir a', 'mv a b', 'rm b'].
+        :param client_socket: the active client socket object.
+        :param window: maximum number of commands sent ahead of their replies.
+        :param stop_on_error: stop sending commands after the first failure.
+        :return: list with the Reply to each command that was run, None for an ul whose file does not exist.
+        """
+
+        # (request id, destination of a dl, verb) of the commands whose reply has not been read yet, request id None
+        # for an ul that was not sent
+        in_flight = deque()
+        replies = []
+        failed = False
+
+        def read_reply():
+            nonlocal failed
+            request_id, file_path, _ = in_flight.popleft()
+            reply = self.receive_reply(client_socket, request_id, file_path) if request_id is not None else None
+            failed = failed or reply is None or not reply.ok
+            replies.append(reply)
+
+        for command in commands:
+            if stop_on_error and failed:
+                break
+            verb, _, argument = protocol.parse_command(command)
+            if verb == "ul":
+                # the chunk check of a deduplicated upload is a round trip of its own
+                while in_flight and (self.listing_mode == "always" or len(in_flight) >= window or self.dedup_chunk_size
+                                     or any(entry[2] not in SMALL_REPLY_COMMANDS for entry in in_flight)):
+                    read_reply()
+
+                file_path = self.local_path(argument)
+                if not os.path.exists(file_path):
+                    if self.verbose:
+                        print("File does not exist on the client!", argument)
+                    in_flight.append((None, None, verb))
+                    continue
+                in_flight.append((self.send_upload(command, client_socket, file_path), None, verb))
+            else:
+                if len(in_flight) >= window:
+                    read_reply()
+
+                file_path = self.local_path(argument) if verb == "dl" else None
+                in_flight.append((self.send_command(command, client_socket), file_path, verb))
+
+            if stop_on_error and verb == "cd":
+                while in_flight:
+                    read_reply()
+
+        while in_flight:
+            read_reply()
+        return replies
+
+
+    def is_streaming(self, command):
+        """
+        :return: True if execute() has to run the command on its own, see STREAMING_COMMANDS.
+        """
+
+        verb, options, argument = protocol.parse_command(command)
+        if verb in ("ul", "dl") and protocol.split_recursive(options, argument)[0]:
+            return True
+        return verb in STREAMING_COMMANDS or (verb == "dl" and self.is_striped(options))
+
+
+    def is_striped(self, options):
+        """
+        :param options: the options of a dl command
+        :return: True if the download goes through striped_download(): it asks for stripes, or the client stripes
+            downloads by default; a ranged dl never is.
+        """
+
+        if "offset" in options or "length" in options:
+            return False
+        return "stripes" in options or self.stripes != 1
+
+
+    def stripe_setting(self, options):
+        """
+        :param options: the options of a dl command
+        :return: the number of connections to download over, 0 to size it automatically
+        :raises ValueError: if --stripes is neither a positive number nor 'auto'
+        """
+
+        value = options.get("stripes", self.stripes)
+        if value == "auto":
+            return 0
+        stripes = int(value)
+        if stripes < 0 or (stripes == 0 and "stripes" in options):
+            raise ValueError(value)
+        return stripes
+
+
+    def execute(self, commands, stop_on_error=False):
+        """
+        Runs a list of commands on the session opened by connect() and returns their results instead of printing
+        them, e.g. execute(['mkdir logs', 'cd logs', 'ul app.log', 'info app.log']). Runs of ordinary commands are
+        pipelined (see pipeline()), mput, mget, sync and striped downloads run on their own.
+        :param commands: list of full commands (with arguments); an 'exit' ends the list.
+        :param stop_on_error: stop at the first failed command, the rest are returned as not run.
+        :return: list with a CommandResult for each command.
+        """
+
+        commands = list(commands)
+        verbs = [protocol.parse_command(command)[0].lower() for command in commands]
+        if "exit" in verbs:
+            commands = commands[:verbs.index("exit")]
+
+        results = []
+        start = 0
+        while start < len(commands):
+            end = start
+            while end < len(commands) and not self.is_streaming(commands[end]):
+                end += 1
+
+            if end > start:
+                replies = self.pipeline(commands[start:end], self.client_socket, stop_on_error=stop_on_error)
+                for command, reply in zip(commands[start:end], replies):
+                    if reply is None:
+                        reply = local_failure("File does not exist on the client")
+                    results.append(CommandResult.from_reply(command, reply))
+            else:
+                command = commands[start]
+                verb, options, argument = protocol.parse_command(command)
+                if verb in ("ul", "dl") and protocol.split_recursive(options, argument)[0]:
+                    reply = self.transfer_tree(command, self.client_socket)
+                elif verb == "dl":
+                    reply = self.striped_download(command, self.client_socket)
+                elif verb == "mput":
+                    reply = self.put_files(command, self.client_socket)
+                elif verb == "mget":
+                    reply = self.get_files(command, self.client_socket)
+                else:
+                    reply = self.sync_file(command, self.client_socket)
+                results.append(CommandResult.from_reply(command, reply))
+                end = start + 1
+
+            if stop_on_error and not all(result.ok for result in results):
+                break
+            start = end
+
+        results.extend(CommandResult(command, None, "not run", [], None) for command in commands[len(results):])
+        return results
+
+
+    def remote_working_directory(self, client_socket):
+        """
+        :param client_socket: the active client socket object.
+        :return: the absolute path of the session's working directory on the server.
+        """
+
+        request_id = self.send_command("pwd", client_socket)
+        reply = self.receive_reply(client_socket, request_id)
+        if not reply.ok:
+            raise protocol.ProtocolError(f"pwd failed: {reply.message}")
+        return reply.texts[0]
+
+
+    def change_directory(self, client_socket, directory):
+        request_id = self.send_command(f"cd {directory}", client_socket)
+        reply = self.receive_reply(client_socket, request_id)
+        if not reply.ok:
+            raise protocol.ProtocolError(f"cd failed: {reply.message}")
+
+
+    def get_batches(self, client_socket, directory, entries, base_directory):
+        """
+        Runs on a pooled connection: downloads (size, name) entries in mget streams of up to BATCH_FILES files.
+        :return: list of the error messages of failed batches.
+        """
+
+        self.change_directory(client_socket, directory)
+        errors = []
+        for batch in split_batches(entries):
+            names = " ".join(shlex.quote(name) for _, name in batch)
+            request_id = self.send_command(f"mget --exact {names}", client_socket)
+            reply = self.receive_reply(client_socket, request_id, directory=base_directory)
+            if not reply.ok:
+                errors.append(reply.message)
+        return errors
+
+
+    def put_batches(self, client_socket, directory, entries, base_directory):
+        """
+        Runs on a pooled connection: uploads (size, name) entries in mput streams of up to BATCH_FILES files. The
+        whole stream is sent before the reply is read, the server only answers at its end.
+        :return: list of the error messages of failed batches and of local files that could not be read.
+        """
+
+        self.change_directory(client_socket, directory)
+        errors = []
+        for batch in split_batches(entries):
+            request_id = self.send_command("mput", client_socket)
+            for _, name in batch:
+                try:
+                    file = open(os.path.join(base_directory, name), 'rb')
+                except OSError as e:
+                    errors.append(f"{name}: {e.strerror}")
+                    continue
+                with file:
+                    sent = self.upload_file(client_socket, file, request_id, os.fstat(file.fileno()).st_size,
+                                            {"name": name})[0]
+                self.progress.add(sent)
+            protocol.send_frame(client_socket, MSG_END, b"", request_id)
+
+            reply = self.receive_reply(client_socket, request_id)
+            if not reply.ok:
+                errors.extend(reply.texts)
+                errors.append(reply.message)
+        return errors
+
+
+    def run_on_pool(self, label, function, client_socket, entries, base_directory):
+        """
+        Spreads (size, name) entries over the connection pool by size and runs function on each connection.
+        :return: the TransferProgress with the totals, and the list of error messages
+        """
+
+        directory = self.remote_working_directory(client_socket)
+        parts = partition_by_size(entries, self.pool.size)
+        progress = TransferProgress(label, len(entries), sum(size for size, _ in entries), verbose=self.verbose)
+
+        def run_part(client, pooled_socket, part):
+            client.progress = progress
+            try:
+                return function(client, pooled_socket, directory, part, base_directory)
+            finally:
+                client.progress = None
+
+        errors = [error for part_errors in self.pool.run(run_part, parts) for error in part_errors]
+        if self.verbose:
+            progress.finish(len(parts))
+        return progress, errors
+
+
+    def put_files(self, command_and_arg, client_socket):
+        """
+        Runs an mput (see issue_mput()) without printing anything but the progress.
+        :return: a Reply summarising the transfer, its texts are the errors of single files.
+        """
+
+        base_directory = self.local_path("")
+        try:
+            names, unmatched = protocol.expand_paths(base_directory, shlex.split(protocol.parse_command(command_and_arg)[2]))
+        except ValueError as e:
+            return local_failure(f"Invalid arguments: {e}")
+        errors = [f"{pattern}: no such file on the client" for pattern in unmatched]
+
+        progress = None
+        if names:
+            entries = [(os.path.getsize(os.path.join(base_directory, name)), name) for name in names]
+            progress, pool_errors = self.run_on_pool("mput", Client.put_batches, client_socket, entries, base_directory)
+            errors.extend(pool_errors)
+        return self.transfer_reply("Sent", progress, errors)
+
+
+    def transfer_reply(self, verb, progress, errors):
+        """
+        :return: the Reply of an mput/mget: its totals, and the errors as texts.
+        """
+
+        summary = f"{verb} {progress.files if progress else 0} files ({progress.bytes if progress else 0} bytes)"
+        if errors:
+            return Reply(None, STATUS_ERROR, f"{summary}, {len(errors)} errors", None, errors)
+        return Reply(None, STATUS_OK, summary, None, [])
+
+
+    def issue_mput(self, command_and_arg, client_socket):
+        """
+        Uploads several files at once, e.g. 'mput data/ *.csv "my file.txt"'. Directories are uploaded with everything
+        below them and patterns are expanded in the client's directory ('**' matches sub directories). The files are
+        spread over the connection pool and each connection sends them in batches, one framed stream per batch.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        """
+
+        for error in self.put_files(command_and_arg, client_socket).texts:
+            print("Error:", error)
+
+
+    def issue_mget(self, command_and_arg, client_socket):
+        """
+        Downloads several files at once, e.g. 'mget logs/ **/*.csv'. The server expands the names and patterns and
+        returns a manifest first ('mget --list'), then the files are spread over the connection pool by size and each
+        connection fetches its share in batches with 'mget --exact'. Files keep their relative paths.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        """
+
+        for error in self.get_files(command_and_arg, client_socket).texts:
+            print("Error:", error)
+
+
+    def get_files(self, command_and_arg, client_socket):
+        """
+        Runs an mget (see issue_mget()) without printing anything but the progress.
+        :return: a Reply summarising the transfer, its texts are the errors.
+        """
+
+        patterns = protocol.parse_command(command_and_arg)[2]
+        request_id = self.send_command(f"mget --list {patterns}", client_socket)
+        reply = self.receive_reply(client_socket, request_id)
+        errors = [] if reply.ok else [reply.message]
+
+        entries = []
+        for text in reply.texts:
+            for line in text.splitlines():
+                size, _, name = line.partition(" ")
+                entries.append((int(size), name))
+        progress = None
+        if entries:
+            progress, pool_errors = self.run_on_pool("mget", Client.get_batches, client_socket, entries,
+                                                     self.local_path(""))
+            errors.extend(pool_errors)
+        return self.transfer_reply("Received", progress, errors)
+
+
+    def issue_sync(self, command_and_arg, client_socket):
+        """
+        Sends the full sync command entered by the user to the server. Like ul ('sync <file>') or dl
+        ('sync --pull <file>'), but only the blocks that differ from the other side's copy of the file are sent:
+        the side with the old copy sends block checksums, the other side answers with a delta (see delta.py).
+        Use the helper method: receive_reply() to receive the reply from the server.
+        :param command_and_arg: full command (with argument) provided by the user.
+        :param client_socket: the active client socket object.
+        """
+
+        self.show_reply(self.sync_file(command_and_arg, client_socket))
+
+
+    def sync_file(self, command_and_arg, client_socket):
+        """
+        Runs a sync (see issue_sync()) and returns its Reply instead of printing it.
+        """
+
+        _, options, file_name = protocol.parse_command(command_and_arg)
+        file_path = self.local_path(file_name)
+
+        if "pull" in options:
+            if os.path.exists(file_path):
+                with open(file_path, 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    block_size = delta.choose_block_size(size)
+                    signature = delta.file_signature(f, block_size)
+            else:
+                size, block_size, signature = 0, delta.MIN_BLOCK_SIZE, []
+
+            part_path = protocol.partial_path(file_path)
+            request_id = self.send_command(command_and_arg, client_socket)
+            delta.send_signature(client_socket, request_id, signature, block_size, size)
+            reply = self.receive_reply(client_socket, request_id, part_path, basis_path=file_path)
+            if reply.ok and os.path.exists(part_path):
+                os.replace(part_path, file_path)
+            return reply
+
+        if not os.path.exists(file_path):
+            return local_failure("File does not exist on the client!")
+
+        request_id = self.send_command(command_and_arg, client_socket)
+        block_size, basis_size, signature = delta.receive_signature(client_socket, request_id)
+        with open(file_path, 'rb') as f:
+            delta.send_delta(client_socket, f, request_id, signature, block_size, basis_size)
+        return self.receive_reply(client_socket, request_id)
+
+
+    def issue_cd(self, command_and_arg, client_socket):
         """
         Sends the full cd command entered by the user to the server. The server changes its cwd accordingly and sends back
         the new cwd info.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the reply from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
-        :param eof_token: a token to indicate the end of the message.
         """
 
-        command = command_and_arg + eof_token
-        client_socket.sendall(command.encode())
-        print(self.receive_message_ending_with_token(client_socket, 1024, eof_token).decode())
+        request_id = self.send_command(command_and_arg, client_socket)
+        self.show_reply(self.receive_reply(client_socket, request_id))
 
 
-    def issue_mkdir(self, command_and_arg, client_socket, eof_token):
+    def issue_mkdir(self, command_and_arg, client_socket):
         """
         Sends the full mkdir command entered by the user to the server. The server creates the sub directory and sends back
         the new cwd info.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the reply from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
-        :param eof_token: a token to indicate the end of the message.
         """
 
-        command = command_and_arg + eof_token
-        client_socket.sendall(str.encode(command))
+        request_id = self.send_command(command_and_arg, client_socket)
 
-        response = self.receive_message_ending_with_token(client_socket, 1024, eof_token)
-        print("Received response from server:", response.decode())
+        response = self.receive_reply(client_socket, request_id)
+        self.show_reply(response, "Received response from server:")
 
-    def issue_rm(self, command_and_arg, client_socket, eof_token):
+    def issue_rm(self, command_and_arg, client_socket):
         """
         Sends the full rm command entered by the user to the server. The server removes the file or directory and sends back
         the new cwd info.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the reply from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
-        :param eof_token: a token to indicate the end of the message.
         """
 
-        command = command_and_arg + eof_token
-        client_socket.sendall(str.encode(command))
-        print(self.receive_message_ending_with_token(client_socket, 1024, eof_token).decode())
+        request_id = self.send_command(command_and_arg, client_socket)
+        self.show_reply(self.receive_reply(client_socket, request_id))
 
 
-    def issue_ul(self, command_and_arg, client_socket, eof_token):
+    def issue_ul(self, command_and_arg, client_socket):
         """
         Sends the full ul command entered by the user to the server. Then, it reads the file to be uploaded as binary
         and sends it to the server. The server creates the file on its end and sends back the new cwd info.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        If an earlier upload of the file was interrupted, only the part the server does not have yet is sent. A
+        range can also be given explicitly, e.g. 'ul --offset=1000 --length=500 data.bin'.
+        Use the helper method: receive_reply() to receive the reply from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
-        :param eof_token: a token to indicate the end of the message.
         """
 
-        file_name = command_and_arg.split("ul ")[1]
-        file_path = os.path.join(pathlib.Path(__file__).parent.resolve(), file_name)
-
-        if os.path.exists(file_path):
-            client_socket.sendall(str.encode(command_and_arg + eof_token))
-
-            with open(file_path, 'rb') as f:
-                file = f.read() + eof_token.encode()
-                client_socket.sendall(file)
-            print(self.receive_message_ending_with_token(client_socket, 1024, eof_token).decode())
+        _, options, file_name = protocol.parse_command(command_and_arg)
+        if protocol.split_recursive(options, file_name)[0]:
+            self.show_reply(self.transfer_tree(command_and_arg, client_socket))
+            return
+        file_path = self.local_path(file_name)
 
-        else:
+        if not os.path.exists(file_path):
             print("File does not exist on the client!")
+            return
 
+        try:
+            length = int(options["length"]) if "length" in options else None
+            if "offset" in options:
+                offset = int(options["offset"])
+            else:
+                offset = self.partial_upload_size(file_name, client_socket)
+                # a partial upload larger than the file belongs to another version of it, start over
+                if offset > os.path.getsize(file_path):
+                    offset = 0
+                if offset:
+                    print(f"Resuming the upload of '{file_name}' at byte {offset}")
+        except ValueError:
+            print("--offset and --length must be numbers")
+            return
 
+        command = f"ul --offset={offset} {file_name}" if offset else f"ul {file_name}"
+        request_id = self.send_upload(command, client_socket, file_path, offset, length)
+        self.show_reply(self.receive_reply(client_socket, request_id))
 
 
-    def issue_dl(self, command_and_arg, client_socket, eof_token):
+    def issue_dl(self, command_and_arg, client_socket):
         """
         Sends the full dl command entered by the user to the server. Then, it receives the content of the file via the
         socket and re-creates the file in the local directory of the client. Finally, it receives the latest cwd info from
-        the server.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        the server. If the file does not exist on the server, the server replies with an error instead of the file.
+        The file is received into a hidden partial file first and renamed when it is complete; if a download was
+        interrupted, the next dl of the file continues where it stopped. With --offset=N and/or --length=N only that
+        range is downloaded and written in place into the local file. With --stripes=N|auto a large file is fetched
+        over several connections at once, see striped_download().
+        Use the helper method: receive_reply() to receive the reply from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
-        :param eof_token: a token to indicate the end of the message.
         :return:
         """
 
-        file_name = command_and_arg.split("dl ")[1]
-        file_path = os.path.join(pathlib.Path(__file__).parent.resolve(), file_name)
+        _, options, file_name = protocol.parse_command(command_and_arg)
+        if protocol.split_recursive(options, file_name)[0]:
+            self.show_reply(self.transfer_tree(command_and_arg, client_socket))
+        elif self.is_striped(options):
+            self.show_reply(self.striped_download(command_and_arg, client_socket))
+        else:
+            self.show_reply(self.download_file(command_and_arg, client_socket))
+
+
+    def download_file(self, command_and_arg, client_socket):
+        """
+        Downloads one file over client_socket for issue_dl(): staged in a partial file and resumed, or a range.
+        :param command_and_arg: the dl command, without -r
+        :param client_socket: the active client socket object.
+        :return: the Reply to the dl
+        """
+
+        _, options, file_name = protocol.parse_command(command_and_arg)
+        file_path = self.local_path(file_name)
         # file_path -> assignment_folder\client\file_name
+        if not os.path.isdir(os.path.dirname(file_path)):
+            return local_failure(f"The directory of '{file_name}' does not exist on the client")
 
-        client_folder_path = os.path.join(pathlib.Path(__file__).parent.resolve())
-        # client folder path -> assignment_folder\client
-        print("Client path ->", client_folder_path)
-        # change given directory one level above
-        #assignment_folder = os.path.split(client_folder_path)[0]
-        # assignment_folder -> assignment_folder
-        #print("Assignment folder ->", assignment_folder)
-        server_path = (os.path.join(client_folder_path, 'server'))
-        # server_path -> assignment_folder\server
-        print("Server path ->", server_path)
-
-        print("File Path ->",os.path.join(server_path, file_name))
-        # Check in the server folder if the file exists or not and if it exists then only add in the client folder
-        if os.path.exists(os.path.join(server_path, file_name)):
-            client_socket.sendall(str.encode(command_and_arg + eof_token))
-
-            file = self.receive_message_ending_with_token(client_socket, 1024, eof_token)
-            with open(file_path, 'wb') as f:
-                f.write(file)
+        if "offset" in options or "length" in options:
+            request_id = self.send_command(command_and_arg, client_socket)
+            return self.receive_reply(client_socket, request_id, file_path)
 
-            print(f"File '{file_name}' downloaded to '{file_path}'")
-            print(self.receive_message_ending_with_token(client_socket, 1024, eof_token).decode())
+        part_path = protocol.partial_path(file_path)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            print(f"Resuming the download of '{file_name}' at byte {offset}")
+            request_id = self.send_command(f"dl --offset={offset} {file_name}", client_socket)
+            reply = self.receive_reply(client_socket, request_id, part_path)
+            if reply.status == STATUS_INVALID:
+                # the file on the server is shorter than the partial download now, start over
+                offset = 0
+        if not offset:
+            request_id = self.send_command(command_and_arg, client_socket)
+            reply = self.receive_reply(client_socket, request_id, part_path)
 
-        else:
-            print("File does not exist in server!")
+        if reply.ok and os.path.exists(part_path):
+            os.replace(part_path, file_path)
+        return reply
+
+
+    def striped_download(self, command_and_arg, client_socket):
+        """
+        Downloads a large file over several connections of the pool at once, each fetching ranges of STRIPE_SIZE
+        bytes with 'dl --offset=N --length=N' and writing them in place into a preallocated hidden file, which is
+        renamed once every range is there and the file is verified. Each range is checked against its own checksum
+        if the session negotiated checksums, and fetched again if it does not match; the whole file is checked
+        against the checksum the server has for it, which the server is asked to compute if it has none cached.
+        With --stripes=auto the download starts with self.stripe_hint connections and adds one while that still
+        raises the throughput. Files smaller than two ranges, and --stripes=1, go through download_file(). A striped
+        download starts over instead of resuming.
+        :param command_and_arg: the dl command, without -r, --offset or --length
+        :param client_socket: the active client socket object.
+        :return: the Reply to the dl
+        """
+
+        _, options, file_name = protocol.parse_command(command_and_arg)
+        try:
+            stripes = self.stripe_setting(options)
+        except ValueError:
+            return local_failure("--stripes must be a positive number or 'auto'")
+        if stripes == 1:
+            return self.download_file(f"dl {file_name}", client_socket)
+
+        request_id = self.send_command(f"info {file_name}", client_socket)
+        info = self.receive_reply(client_socket, request_id)
+        size, digest = self.remote_file_info(info)
+        if size is None or size < 2 * STRIPE_SIZE:
+            return self.download_file(f"dl {file_name}", client_socket)
+
+        file_path = self.local_path(file_name)
+        directory, name = os.path.split(file_path)
+        stripe_path = os.path.join(directory, f".{name}.stripes")
+        try:
+            f = open(stripe_path, "wb")
+        except OSError as e:
+            return local_failure(f"Cannot create '{file_name}' on the client: {e.strerror}")
+        with f:
+            f.truncate(size)
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, size)
+                except OSError:
+                    # not supported by the file system; the ranges then allocate the file as they arrive
+                    pass
+
+        download = StripedDownload(file_name, stripe_path, size)
+        started = time.perf_counter()
+        try:
+            streams = self.run_stripes(download, self.remote_working_directory(client_socket), stripes)
+            if download.errors or download.ranges or download.in_flight:
+                errors = download.errors or ["no stream could fetch the rest of the file"]
+                return local_failure(f"'{file_name}' was not downloaded: {'; '.join(errors)}")
+            if digest is None:
+                request_id = self.send_command(f"info --checksum {file_name}", client_socket)
+                digest = self.remote_file_info(self.receive_reply(client_socket, request_id))[1]
+            if digest is not None:
+                with open(stripe_path, "rb") as f:
+                    received = protocol.file_checksum(f)
+                if received != digest:
+                    return local_failure(f"'{file_name}' was not downloaded: the file did not match its checksum "
+                                         f"(expected {digest}, received {received}), it may have changed on the "
+                                         f"server during the download")
+            os.replace(stripe_path, file_path)
+        finally:
+            if os.path.exists(stripe_path):
+                os.remove(stripe_path)
+        seconds = time.perf_counter() - started
+        self.transfer_stats.record("striped", size, seconds)
 
+        if self.progress is not None:
+            self.progress.add(size)
+        if self.verbose:
+            print(f"File '{file_name}' downloaded to '{file_path}' ({size} bytes over {streams} connections, "
+                  f"{size / max(seconds, 1e-9) / 1e6:.1f} MB/s, "
+                  f"{'verified' if digest is not None else 'not verified'})")
+        return Reply(info.request_id, STATUS_OK, "ok", info.listing, [])
 
 
-    def issue_info(self, command_and_arg, client_socket, eof_token):
+    def remote_file_info(self, reply):
+        """
+        :param reply: the Reply to an info command
+        :return: tuple of (size, checksum) of the file, None for what the reply does not tell
+        """
+
+        size = digest = None
+        if reply.ok:
+            for text in reply.texts:
+                label, _, value = text.rpartition(": ")
+                if label.startswith("Size of "):
+                    size = int(value.split()[0])
+                elif label.startswith("Checksum of "):
+                    algorithm, _, value = value.partition(" ")
+                    digest = value if algorithm == protocol.CHECKSUM else None
+        return size, digest
+
+
+    def run_stripes(self, download, directory, stripes):
+        """
+        Runs the streams of a striped download on the pool until it finished, see striped_download().
+        :param download: the StripedDownload
+        :param directory: the working directory of the session on the server, the streams change to it
+        :param stripes: number of streams, 0 to add them while they raise the throughput
+        :return: the number of streams that were started
+        """
+
+        limit = stripes or MAX_STRIPES
+        connections = {}
+        with ThreadPoolExecutor(max_workers=limit) as executor:
+            def add_stream():
+                index = len(connections)
+                try:
+                    connection = self.pool.get(index + 1)[index]
+                except (OSError, protocol.ProtocolError):
+                    return False
+                download.add_stream()
+                connections[executor.submit(download.run_stream, *connection, directory)] = connection
+                return True
+
+            for _ in range(stripes or min(self.stripe_hint, limit)):
+                if not add_stream():
+                    break
+            if not stripes:
+                settled = len(connections)
+                rate = download.measure(len(connections))
+                while rate is not None and len(connections) < limit and add_stream():
+                    faster = download.measure(len(connections))
+                    if faster is None or faster < rate * STRIPE_GAIN:
+                        break
+                    settled = len(connections)
+                    rate = faster
+                self.stripe_hint = max(settled, 1)
+
+        for future, connection in connections.items():
+            if not future.result():
+                self.pool.discard(connection)
+        return len(connections)
+
+
+
+    def transfer_tree(self, command_and_arg, client_socket):
+        """
+        Runs an 'ul -r <directory>' or 'dl -r <directory>': the whole tree travels as one tar stream in a single
+        request, e.g. 'dl -r logs' creates ./logs with everything below it. The sending side walks the tree on a
+        thread pool (see tree.py).
+        :return: the Reply to the command.
+        """
+
+        verb, options, argument = protocol.parse_command(command_and_arg)
+        name = protocol.split_recursive(options, argument)[1]
+        if verb == "dl":
+            request_id = self.send_command(command_and_arg, client_socket)
+            return self.receive_reply(client_socket, request_id, archive_directory=self.local_path(""))
+
+        path = self.local_path(name)
+        if not os.path.isdir(path):
+            return local_failure(f"'{name}' is not a directory on the client")
+        compressor = protocol.StreamCompressor(self.codec) if self.codec else None
+        request_id = self.send_command(command_and_arg, client_socket)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=tree.WORKERS, thread_name_prefix="tree-worker") as executor:
+            files, writer, errors = tree.send_archive(client_socket, path, os.path.basename(os.path.normpath(path)),
+                                                      request_id, executor, compressor,
+                                                      protocol.new_checksum() if self.checksum else None)
+        self.transfer_stats.record("tar", writer.raw_bytes, time.perf_counter() - started, writer.wire_bytes)
+        if self.verbose:
+            print(f"Sent {files} files of '{name}' ({writer.raw_bytes} bytes of archive, {writer.wire_bytes} on the "
+                  f"wire)")
+        reply = self.receive_reply(client_socket, request_id)
+        return reply._replace(texts=errors + reply.texts) if errors else reply
+
+
+    def issue_info(self, command_and_arg, client_socket):
         """
         Sends the full info command entered by the user to the server. The server reads the file and sends back the size of
         the file.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the reply from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
-        :param eof_token: a token to indicate the end of the message.
         :return: the size of file in string
         """
-        command = command_and_arg + eof_token
-        client_socket.sendall(command.encode())
-        print(self.receive_message_ending_with_token(client_socket, 1024, eof_token).decode())
+        request_id = self.send_command(command_and_arg, client_socket)
+        self.show_reply(self.receive_reply(client_socket, request_id))
 
 
-    def issue_mv(self, command_and_arg, client_socket, eof_token):
+    def issue_tree_command(self, command_and_arg, client_socket):
+        """
+        Sends a du, find or cp command entered by the user to the server, which handles the whole directory tree in
+        one request, e.g. 'du logs', 'find --name=*.csv --type=f data' or 'cp -r data backup'.
+        Use the helper method: receive_reply() to receive the reply from the server.
+        :param command_and_arg: full command (with options and arguments) provided by the user.
+        :param client_socket: the active client socket object.
+        """
+        request_id = self.send_command(command_and_arg, client_socket)
+        self.show_reply(self.receive_reply(client_socket, request_id))
+
+
+    def issue_mv(self, command_and_arg, client_socket):
         """
         Sends the full mv command entered by the user to the server. The server moves the file to the specified directory and sends back
         the updated. This command can also act as renaming the file in the same directory.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the server.
+        Use the helper method: receive_reply() to receive the reply from the server.
         :param command_and_arg: full command (with argument) provided by the user.
         :param client_socket: the active client socket object.
-        :param eof_token: a token to indicate the end of the message.
         """
-        command = command_and_arg + eof_token
-        client_socket.sendall(command.encode())
-        print(self.receive_message_ending_with_token(client_socket, 1024, eof_token).decode())
+        request_id = self.send_command(command_and_arg, client_socket)
+        self.show_reply(self.receive_reply(client_socket, request_id))
+
+
+    def issue_ls(self, command_and_arg, client_socket):
+        """
+        Sends the full ls command entered by the user to the server. The server sends back one page of the directory
+        info, e.g. 'ls --offset=100 --limit=50 *.csv'. This is how a session in listing mode 'never' sees the
+        directory contents.
+        Use the helper method: receive_reply() to receive the reply from the server.
+        :param command_and_arg: full command (with optional options and pattern) provided by the user.
+        :param client_socket: the active client socket object.
+        """
+        request_id = self.send_command(command_and_arg, client_socket)
+        self.show_reply(self.receive_reply(client_socket, request_id))
+
+
+    def issue_stats(self, command_and_arg, client_socket):
+        """
+        Sends the stats command entered by the user to the server. The server sends back its command counts and
+        latencies, bytes in and out, sessions and transfer throughput; 'stats --format=prometheus' asks for the
+        Prometheus text format instead of the table.
+        Use the helper method: receive_reply() to receive the reply from the server.
+        :param command_and_arg: full command (with optional options) provided by the user.
+        :param client_socket: the active client socket object.
+        """
+        request_id = self.send_command(command_and_arg, client_socket)
+        self.show_reply(self.receive_reply(client_socket, request_id))
+
+
+    def issue_limits(self, command_and_arg, client_socket):
+        """
+        Sends the limits command entered by the user to the server, e.g. 'limits --rate=10000000 --transfers=8'. The
+        server changes the bandwidth limits and the transfer cap that are given and sends back the limits in force.
+        Use the helper method: receive_reply() to receive the reply from the server.
+        :param command_and_arg: full command (with optional options) provided by the user.
+        :param client_socket: the active client socket object.
+        """
+        request_id = self.send_command(command_and_arg, client_socket)
+        self.show_reply(self.receive_reply(client_socket, request_id))
 
 
     def start(self):
@@ -210,7 +1533,7 @@ class Client:
         2) Accepts user input and issue commands until exit.
         """
         # initialize
-        client_socket, eof_token = self.initialize(self.host, self.port)
+        client_socket, _ = self.initialize(self.host, self.port)
 
 
         # while True:
@@ -223,31 +1546,162 @@ class Client:
                 break
 
             if user_input.startswith("cd "):
-                self.issue_cd(user_input, client_socket, eof_token)
+                self.issue_cd(user_input, client_socket)
             elif user_input.startswith("mkdir "):
-                self.issue_mkdir(user_input, client_socket, eof_token)
+                self.issue_mkdir(user_input, client_socket)
             elif user_input.startswith("rm "):
-                self.issue_rm(user_input, client_socket, eof_token)
+                self.issue_rm(user_input, client_socket)
             elif user_input.startswith("ul "):
-                self.issue_ul(user_input, client_socket, eof_token)
+                self.issue_ul(user_input, client_socket)
             elif user_input.startswith("dl "):
-                self.issue_dl(user_input, client_socket, eof_token)
+                self.issue_dl(user_input, client_socket)
+            elif user_input.startswith("mput "):
+                self.issue_mput(user_input, client_socket)
+            elif user_input.startswith("mget "):
+                self.issue_mget(user_input, client_socket)
+            elif user_input.startswith("sync "):
+                self.issue_sync(user_input, client_socket)
             elif user_input.startswith("info "):
-                self.issue_info(user_input, client_socket, eof_token)
+                self.issue_info(user_input, client_socket)
+            elif user_input.split(" ", 1)[0] in ("du", "find", "cp"):
+                self.issue_tree_command(user_input, client_socket)
             elif user_input.startswith("mv "):
-                self.issue_mv(user_input, client_socket, eof_token)
+                self.issue_mv(user_input, client_socket)
+            elif user_input == "ls" or user_input.startswith("ls "):
+                self.issue_ls(user_input, client_socket)
+            elif user_input == "stats" or user_input.startswith("stats "):
+                self.issue_stats(user_input, client_socket)
+            elif user_input == "limits" or user_input.startswith("limits "):
+                self.issue_limits(user_input, client_socket)
             else:
-                print("Invalid command. Supported commands: cd, mkdir, rm, ul, dl, info, mv, exit")
+                print("Invalid command. Supported commands: cd, mkdir, rm, ul, dl, mput, mget, sync, info, du, find, cp, "
+                      "mv, ls, stats, limits, exit")
+
+        self.close()
 
         # print('Exiting the application.')
         print("Exiting the application.")
 
 
+    def connect(self):
+        """
+        Opens the session for execute() and run_batch(). A Client is also a context manager that connects and closes.
+        :return: the Client
+        """
+
+        self.initialize(self.host, self.port)
+        return self
+
+
+    def close(self):
+        """
+        Lets the server end the session, then closes the connection and the connection pool.
+        """
+
+        self.pool.close()
+        if self.client_socket is not None:
+            try:
+                self.send_command("exit", self.client_socket)
+            except OSError:
+                pass
+            self.client_socket.close()
+            self.client_socket = None
+
+
+    def __enter__(self):
+        return self.connect()
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def run_batch(self, lines, stop_on_error=False):
+        """
+        Batch mode: runs the commands read from a script (one per line, blank lines and '#' comments are skipped)
+        over one session with execute(). Text results go to stdout, failures to stderr with their line number.
+        :param lines: iterable of lines, e.g. an open file or sys.stdin.
+        :param stop_on_error: stop at the first failed command.
+        :return: EXIT_OK if all commands succeeded, EXIT_FAILED if some failed, EXIT_CONNECTION if the server could
+            not be reached or the connection broke.
+        """
+
+        numbered = [(number, line.strip()) for number, line in enumerate(lines, 1)]
+        numbered = [(number, line) for number, line in numbered if line and not line.startswith("#")]
+
+        started = time.perf_counter()
+        try:
+            with self:
+                results = self.execute([line for _, line in numbered], stop_on_error)
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"Connection to {self.host}:{self.port} failed: {e}", file=sys.stderr)
+            return EXIT_CONNECTION
+
+        failed = 0
+        for (number, _), result in zip(numbered, results):
+            if result.ok:
+                for text in result.texts:
+                    print(text)
+                if result.listing is not None:
+                    print(result.listing)
+            elif result.status is not None:
+                failed += 1
+                print(f"line {number}: {result.command}: {result.message}", file=sys.stderr)
+                for text in result.texts:
+                    print(f"line {number}: {text}", file=sys.stderr)
+        skipped = sum(result.status is None for result in results)
+        print(f"{len(results) - skipped} commands, {failed} failed, {skipped} not run in "
+              f"{time.perf_counter() - started:.2f} s", file=sys.stderr)
+        return EXIT_FAILED if failed else EXIT_OK
+
+
+def stripe_count(value):
+    """
+    Parses the --stripes argument: a positive number of connections or 'auto' (returned as 0).
+    """
+
+    if value == "auto":
+        return 0
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError("must be a positive number or 'auto'")
+    return int(value)
+
+
 def run_client():
     HOST = "127.0.0.1"  # The server's hostname or IP address
     PORT = 65432  # The port used by the server
 
-    client = Client(HOST, PORT)
+    parser = argparse.ArgumentParser(description="File client")
+    parser.add_argument("--port", type=int, default=PORT, help="port of the server")
+    parser.add_argument("--listing", choices=("always", "never"), default=None,
+                        help="always: show the directory after every command, never: only on ls "
+                             "(default: always, never in batch mode)")
+    parser.add_argument("--connections", type=int, default=DEFAULT_CONNECTIONS,
+                        help="parallel connections used by mput and mget")
+    parser.add_argument("--compression", default=",".join(protocol.CODECS),
+                        help="comma separated codecs to offer in order of preference, 'none' to disable compression "
+                             f"(available: {', '.join(protocol.CODECS)})")
+    parser.add_argument("--no-checksums", action="store_true",
+                        help="do not ask for checksummed transfers, downloads are then not verified")
+    parser.add_argument("--stripes", type=stripe_count, default=1,
+                        help="connections a dl fetches a large file over at once, 'auto' to add them while the "
+                             "throughput rises (default: 1)")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="run the commands in FILE ('-' for stdin) without prompting, pipelined over one "
+                             "connection; exits with 1 if a command failed, 2 if the connection failed")
+    parser.add_argument("--stop-on-error", action="store_true", help="in batch mode, stop at the first failure")
+    args = parser.parse_args()
+
+    if args.batch is not None:
+        client = Client(HOST, args.port, listing=args.listing or "never", verbose=False, connections=args.connections,
+                        compression=args.compression, checksums=not args.no_checksums, stripes=args.stripes)
+        if args.batch == "-":
+            sys.exit(client.run_batch(sys.stdin, args.stop_on_error))
+        with open(args.batch) as script:
+            sys.exit(client.run_batch(script, args.stop_on_error))
+
+    client = Client(HOST, args.port, listing=args.listing or "always", connections=args.connections,
+                    compression=args.compression, checksums=not args.no_checksums, stripes=args.stripes)
     client.start()
 
 if __name__ == '__main__':
@@ -0,0 +1,351 @@
+"""
+Content-addressed storage for uploads, enabled with the server's --dedup option.
+
+Every stored file is an object named after the hash of its content, and the visible directory entries are hard
+links to the objects, so an artifact uploaded into many directories takes the disk space of one copy. The objects
+are cut into fixed size chunks whose hashes are kept in an sqlite index together with where they are stored. Before
+an upload, the client asks which of its chunks the server already has ('have') and sends only the others; the known
+ones are copied from the objects that hold them.
+
+Objects are read-only: every command that changes a file writes a new one and renames it into place, which leaves
+the object and its other links as they were.
+Removing a file removes one link; objects without any other link than the store's own are deleted when the server
+starts (see ChunkStore.collect_garbage()).
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+import protocol
+from protocol import MSG_TRANSFER, MSG_DATA, MSG_END, MSG_CHUNK
+
+# size of the chunks uploads are hashed and deduplicated in, the server announces it in the handshake
+CHUNK_SIZE = 1024 * 1024
+
+# bytes of a chunk or object digest
+DIGEST_SIZE = 32
+
+# digests per 'have' command, keeps the command well below protocol.MAX_MESSAGE_SIZE
+HAVE_BATCH = 65536
+
+# digests per sqlite query, below its limit of host parameters
+QUERY_BATCH = 500
+
+
+def chunk_digest(data):
+    """
+    :return: the hex digest a chunk is known by
+    """
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest()
+
+
+def file_digests(file, chunk_size=CHUNK_SIZE, checksum=None):
+    """
+    Reads a file from its current position to the end.
+    :param checksum: a hash object (see protocol.new_checksum()) to feed with the whole content on the way
+    :return: list of (chunk digest, chunk length)
+    """
+    digests = []
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return digests
+        digests.append((chunk_digest(chunk), len(chunk)))
+        if checksum is not None:
+            checksum.update(chunk)
+
+
+def send_chunks(active_socket, file, request_id, digests, known, chunk_size=CHUNK_SIZE, compressor=None,
+                content_digest=None):
+    """
+    Sends a file as a MSG_TRANSFER frame with its 'total' size and 'chunk_size', one frame per chunk and a MSG_END
+    frame. A chunk the server has, or one that came earlier in the same file, is sent as a MSG_CHUNK frame holding
+    its digest; any other chunk as a MSG_DATA frame holding its (possibly compressed) content.
+    :param file: a file object opened in binary read mode
+    :param digests: list of (chunk digest, chunk length) of the file, see file_digests()
+    :param known: set of the digests the server has, see ChunkStore.known()
+    :param compressor: a StreamCompressor for the MSG_DATA frames, decided on the first chunk that is sent as data
+    :param content_digest: the hex checksum of the whole content for the MSG_END frame, or None
+    :return: tuple of (bytes sent as data, bytes sent as references)
+    """
+    seen = set(known)
+    literal_chunks = []
+    for digest, _ in digests:
+        literal_chunks.append(digest not in seen)
+        seen.add(digest)
+
+    options = {"total": sum(length for _, length in digests), "chunk_size": chunk_size}
+    first = literal_chunks.index(True) if True in literal_chunks else None
+    first_payload = None
+    if compressor is not None and first is not None:
+        file.seek(first * chunk_size)
+        first_payload = compressor.start(file.read(digests[first][1]))
+        if compressor.enabled:
+            options["codec"] = compressor.codec
+    protocol.send_frame(active_socket, MSG_TRANSFER, protocol.encode_options(options), request_id)
+
+    literal = reused = 0
+    for index, (digest, length) in enumerate(digests):
+        if not literal_chunks[index]:
+            protocol.send_frame(active_socket, MSG_CHUNK, bytes.fromhex(digest), request_id)
+            reused += length
+            continue
+        if index == first and first_payload is not None:
+            payload = first_payload
+        else:
+            file.seek(index * chunk_size)
+            payload = file.read(length)
+            if compressor is not None:
+                payload = compressor.process(payload)
+        protocol.send_frame(active_socket, MSG_DATA, payload, request_id)
+        literal += length
+    protocol.send_frame(active_socket, MSG_END, protocol.end_payload(digest=content_digest), request_id)
+    return literal, reused
+
+
+def receive_chunks(active_socket, request_id, file, reader, decompressor=None, checksum=False):
+    """
+    Receives the frames sent by send_chunks() up to the MSG_END frame and writes the file they describe, taking the
+    referenced chunks from the store (or from the part of the file already written). The MSG_TRANSFER frame must
+    already have been read by the caller.
+    :param file: a file object opened in binary read/write mode ('wb+'), or None to discard the data
+    :param reader: a ChunkReader of the store
+    :param decompressor: a StreamDecompressor if the MSG_TRANSFER frame named a codec
+    :param checksum: True if the session negotiated checksums, the MSG_END frame must then carry the checksum of the
+        content
+    :return: tuple of (list of (chunk digest, chunk length), digest of the whole content, bytes received on the wire,
+        bytes taken from the store, number of referenced chunks the store no longer has)
+    :raises protocol.IntegrityError: if the file was written completely but its content does not match the checksum
+        in the MSG_END frame
+    """
+    chunks = []
+    written = {}
+    content = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    wire_bytes = reused = missing = 0
+    while True:
+        msg_type, frame_request_id, payload = protocol.receive_frame(active_socket)
+        if frame_request_id != request_id:
+            raise protocol.ProtocolError(f"Expected a frame for request {request_id}, got {frame_request_id}")
+        if msg_type == MSG_END:
+            if file is not None and not missing:
+                protocol.verify_end(payload, content if checksum else None)
+            return chunks, content.hexdigest(), wire_bytes, reused, missing
+        wire_bytes += len(payload)
+        if msg_type == MSG_DATA:
+            data = decompressor.process(payload) if decompressor is not None else payload
+            if file is None:
+                continue
+            digest = chunk_digest(data)
+        elif msg_type == MSG_CHUNK:
+            if file is None:
+                continue
+            digest = payload.hex()
+            if digest in written:
+                file.flush()
+                data = os.pread(file.fileno(), written[digest][1], written[digest][0])
+            else:
+                data = reader.read(digest)
+            if data is None:
+                missing += 1
+                continue
+            reused += len(data)
+        else:
+            raise protocol.ProtocolError(f"Unexpected message type {msg_type} during a deduplicated upload")
+        written.setdefault(digest, (file.tell(), len(data)))
+        file.write(data)
+        content.update(data)
+        chunks.append((digest, len(data)))
+
+
+class ChunkReader:
+    """
+    Reads known chunks out of the objects that hold them, keeping the objects open until close().
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.files = {}
+
+    def read(self, digest):
+        """
+        :return: the content of the chunk, None if the store does not know it or its object is gone
+        """
+        location = self.store.locate(digest)
+        if location is None:
+            return None
+        object_digest, offset, length = location
+        file = self.files.get(object_digest)
+        try:
+            if file is None:
+                file = self.files[object_digest] = open(self.store.object_path(object_digest), 'rb')
+            data = os.pread(file.fileno(), length, offset)
+        except OSError:
+            return None
+        return data if len(data) == length else None
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ChunkStore:
+    """
+    The objects (root/objects/<2 hex digits>/<rest of the digest>) and the chunk index (root/index.sqlite) of one
+    server. Thread safe, every session uses the same store; the processes of server.Supervisor each open their own
+    ChunkStore on the same directory.
+    """
+
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.index = sqlite3.connect(os.path.join(root, "index.sqlite"), check_same_thread=False,
+                                     isolation_level=None)
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute("PRAGMA synchronous=NORMAL")
+        self.index.execute("CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER)")
+        self.index.execute("CREATE TABLE IF NOT EXISTS chunks "
+                           "(digest TEXT PRIMARY KEY, object TEXT, offset INTEGER, length INTEGER)")
+        self.index.execute("CREATE INDEX IF NOT EXISTS chunks_by_object ON chunks (object)")
+
+    def object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest[2:])
+
+    def known(self, digests):
+        """
+        :param digests: list of chunk digests
+        :return: the set of those the store has
+        """
+        found = set()
+        with self.lock:
+            for start in range(0, len(digests), QUERY_BATCH):
+                batch = digests[start:start + QUERY_BATCH]
+                rows = self.index.execute(
+                    f"SELECT digest FROM chunks WHERE digest IN ({','.join('?' * len(batch))})", batch)
+                found.update(digest for digest, in rows)
+        return found
+
+    def locate(self, digest):
+        """
+        :return: tuple of (object digest, offset, length) of a known chunk, None for an unknown one
+        """
+        with self.lock:
+            return self.index.execute("SELECT object, offset, length FROM chunks WHERE digest = ?",
+                                      (digest,)).fetchone()
+
+    def reader(self):
+        return ChunkReader(self)
+
+    def commit(self, staged_path, path, object_digest, chunks):
+        """
+        Stores a complete file and makes path a link to its object. If the object exists already, the staged copy
+        is dropped; otherwise the staged file becomes the object and its chunks are indexed. An object whose size
+        differs from the staged file or from its entry in the index was changed behind the store's back and counts
+        as missing.
+        :param staged_path: the complete file, e.g. the partial file of an upload; it is renamed or removed
+        :param path: where the file is visible
+        :param object_digest: the digest of the whole content
+        :param chunks: list of (chunk digest, chunk length) in file order
+        """
+        object_path = self.object_path(object_digest)
+        size = os.path.getsize(staged_path)
+        with self.lock:
+            if not self.holds(object_digest, size):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.chmod(staged_path, 0o444)
+                try:
+                    os.remove(object_path)
+                except FileNotFoundError:
+                    pass
+                try:
+                    os.link(staged_path, object_path)
+                except FileExistsError:
+                    # stored by another server process (see server.Supervisor) in the meantime
+                    pass
+                else:
+                    self.add_to_index(object_digest, chunks)
+                    os.replace(staged_path, path)
+                    return
+            os.remove(staged_path)
+            # renaming a link over another link to the same inode does nothing and would leave the staged link
+            # behind, so a path that already is the object keeps its link
+            if os.path.exists(path) and os.path.samefile(path, object_path):
+                return
+            os.link(object_path, staged_path)
+            os.replace(staged_path, path)
+
+    def holds(self, object_digest, size):
+        # called with self.lock held
+        try:
+            object_size = os.stat(self.object_path(object_digest)).st_size
+        except FileNotFoundError:
+            return False
+        row = self.index.execute("SELECT size FROM objects WHERE digest = ?", (object_digest,)).fetchone()
+        # no row: stored by another server process that has not indexed it yet
+        return object_size == size and (row is None or row[0] == size)
+
+    def add_to_index(self, object_digest, chunks):
+        # called with self.lock held
+        offsets = []
+        offset = 0
+        for digest, length in chunks:
+            offsets.append((digest, object_digest, offset, length))
+            offset += length
+        self.index.execute("BEGIN")
+        self.index.execute("INSERT OR REPLACE INTO objects VALUES (?, ?)", (object_digest, offset))
+        self.index.executemany("INSERT OR IGNORE INTO chunks VALUES (?, ?, ?, ?)", offsets)
+        self.index.execute("COMMIT")
+
+    def ingest(self, staged_path, path):
+        """
+        Same as commit() for a file that was received without the chunk protocol (a plain ul, mput or sync): its
+        digests are computed here.
+        """
+        with open(staged_path, 'rb') as file:
+            chunks = []
+            content = hashlib.blake2b(digest_size=DIGEST_SIZE)
+            while True:
+                chunk = file.read(self.chunk_size)
+                if not chunk:
+                    break
+                content.update(chunk)
+                chunks.append((chunk_digest(chunk), len(chunk)))
+        self.commit(staged_path, path, content.hexdigest(), chunks)
+
+    def collect_garbage(self):
+        """
+        Removes the objects no visible file links to any more, and forgets their chunks.
+        :return: the number of objects removed
+        """
+        with self.lock:
+            digests = [digest for digest, in self.index.execute("SELECT digest FROM objects")]
+        removed = 0
+        for digest in digests:
+            object_path = self.object_path(digest)
+            try:
+                if os.stat(object_path).st_nlink > 1:
+                    continue
+                os.remove(object_path)
+            except FileNotFoundError:
+                pass
+            with self.lock:
+                self.index.execute("BEGIN")
+                self.index.execute("DELETE FROM chunks WHERE object = ?", (digest,))
+                self.index.execute("DELETE FROM objects WHERE digest = ?", (digest,))
+                self.index.execute("COMMIT")
+            removed += 1
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.index.close()
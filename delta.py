@@ -0,0 +1,303 @@
+"""
+rsync-style delta transfer used by the sync command.
+
+The side that has the old copy of a file (the basis) sends its signature: a weak and a strong checksum of every
+block of block_size bytes. The side that has the new copy slides a window over it and looks the weak checksum of
+every position up in the signature, which costs O(1) per byte because the checksum rolls. Only when the weak
+checksum matches, the strong checksum is compared. Matching windows are sent as MSG_COPY frames (a run of basis
+blocks), everything else as MSG_DATA frames, so a file that differs in a few places costs a few blocks on the wire.
+
+Frames of a signature: MSG_TRANSFER (size, block_size, blocks), MSG_SIGNATURE frames of packed entries, MSG_END.
+Frames of a delta: MSG_TRANSFER (size of the new file, block_size), MSG_COPY and MSG_DATA frames in file order,
+MSG_END.
+"""
+
+import hashlib
+import math
+import os
+import struct
+import zlib
+
+import protocol
+from protocol import MSG_TRANSFER, MSG_DATA, MSG_END, MSG_SIGNATURE, MSG_COPY, CHUNK_SIZE
+
+# weak checksum (adler32) and strong checksum (16 byte blake2b) of one block
+SIGNATURE_ENTRY = struct.Struct("!I16s")
+SIGNATURE_ENTRIES_PER_FRAME = 4096
+
+# MSG_COPY payload: index of the first basis block and the number of consecutive blocks
+COPY = struct.Struct("!QQ")
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+
+# the modulus of adler32
+ADLER_MOD = 65521
+
+# bytes read from the new file at a time while computing a delta
+READ_SIZE = 1024 * 1024
+
+
+def choose_block_size(size):
+    """
+    Picks the block size for a basis of the given size: about its square root, so the signature and the expected
+    number of unmatched bytes per change grow at the same rate, rounded to KiB.
+    :param size: size of the basis in bytes
+    :return: the block size in bytes
+    """
+    block_size = int(math.sqrt(size)) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def strong_checksum(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def file_signature(file, block_size):
+    """
+    Reads a file from its current position to the end and checksums it block by block.
+    :param file: a file object opened in binary read mode
+    :param block_size: the block size, see choose_block_size()
+    :return: list of (weak checksum, strong checksum) tuples, one per block, the last block may be shorter
+    """
+    signature = []
+    while True:
+        block = file.read(block_size)
+        if not block:
+            return signature
+        signature.append((zlib.adler32(block), strong_checksum(block)))
+
+
+def send_signature(active_socket, request_id, signature, block_size, size):
+    """
+    Sends a signature as a MSG_TRANSFER frame, MSG_SIGNATURE frames and a MSG_END frame.
+    :param active_socket: a connected socket object
+    :param request_id: id of the sync request
+    :param signature: the list returned by file_signature(), empty if there is no basis
+    :param block_size: the block size the signature was computed with
+    :param size: size of the basis in bytes
+    """
+    options = {"size": size, "block_size": block_size, "blocks": len(signature)}
+    protocol.send_frame(active_socket, MSG_TRANSFER, protocol.encode_options(options), request_id)
+    for start in range(0, len(signature), SIGNATURE_ENTRIES_PER_FRAME):
+        entries = signature[start:start + SIGNATURE_ENTRIES_PER_FRAME]
+        payload = b"".join(SIGNATURE_ENTRY.pack(weak, strong) for weak, strong in entries)
+        protocol.send_frame(active_socket, MSG_SIGNATURE, payload, request_id)
+    protocol.send_frame(active_socket, MSG_END, b"", request_id)
+
+
+def receive_signature(active_socket, request_id):
+    """
+    Receives the frames sent by send_signature().
+    :param active_socket: a connected socket object
+    :param request_id: id of the sync request
+    :return: tuple of (block size, size of the basis, list of (weak, strong) tuples)
+    """
+    msg_type, frame_request_id, payload = protocol.receive_frame(active_socket)
+    if msg_type != MSG_TRANSFER or frame_request_id != request_id:
+        raise protocol.ProtocolError(f"Expected a signature for request {request_id}, got message type {msg_type}")
+    try:
+        options = protocol.decode_options(payload)
+        block_size = int(options["block_size"])
+        size = int(options["size"])
+    except (KeyError, ValueError):
+        raise protocol.ProtocolError("Invalid signature metadata")
+    if block_size <= 0:
+        raise protocol.ProtocolError(f"Invalid block size {block_size}")
+
+    signature = []
+    while True:
+        msg_type, frame_request_id, payload = protocol.receive_frame(active_socket)
+        if frame_request_id != request_id:
+            raise protocol.ProtocolError(f"Expected a frame for request {request_id}, got {frame_request_id}")
+        if msg_type == MSG_END:
+            return block_size, size, signature
+        if msg_type != MSG_SIGNATURE or len(payload) % SIGNATURE_ENTRY.size:
+            raise protocol.ProtocolError(f"Unexpected message type {msg_type} in a signature")
+        signature.extend(SIGNATURE_ENTRY.iter_unpack(payload))
+
+
+def compute_delta(file, signature, block_size, size, literal_limit=CHUNK_SIZE):
+    """
+    Compares a file with the signature of the basis and yields the operations that rebuild the file from the basis,
+    in file order: ('copy', first block, number of blocks) and ('data', bytes) of at most literal_limit bytes.
+    The file is read sequentially, only the current window and the pending literal bytes are held in memory.
+    :param file: the new file, opened in binary read mode
+    :param signature: the signature of the basis
+    :param block_size: the block size of the signature
+    :param size: size of the basis in bytes, tells whether its last block is a short one
+    :param literal_limit: maximum size of one 'data' operation
+    """
+
+    # weak checksum -> {strong checksum: block index}, full blocks only
+    blocks = {}
+    tail = None
+    for index, (weak, strong) in enumerate(signature):
+        if index == len(signature) - 1 and size - index * block_size < block_size:
+            # the short last block of the basis can only match the end of the file
+            tail = (size - index * block_size, weak, strong, index)
+        else:
+            blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    buffer = bytearray()
+    start = 0  # start of the window in buffer
+    literal_start = 0  # first byte in buffer that is neither sent nor matched yet
+    copy = None  # [first block, count] of the run of matches not yielded yet
+    weak = None
+    end_of_file = False
+
+    while True:
+        if len(buffer) - start <= block_size and not end_of_file:
+            # keep the window and the pending literal bytes, drop everything before them
+            drop = min(start, literal_start)
+            if drop:
+                del buffer[:drop]
+                start -= drop
+                literal_start -= drop
+            chunk = file.read(READ_SIZE)
+            if chunk:
+                buffer += chunk
+                continue
+            end_of_file = True
+
+        available = len(buffer) - start
+        if available < block_size or not blocks:
+            break
+
+        if weak is None:
+            weak = zlib.adler32(buffer[start:start + block_size])
+        matches = blocks.get(weak)
+        if matches is not None:
+            index = matches.get(strong_checksum(buffer[start:start + block_size]))
+            if index is not None:
+                if literal_start < start:
+                    if copy:
+                        yield ("copy", *copy)
+                        copy = None
+                    yield ("data", bytes(buffer[literal_start:start]))
+                if copy and copy[0] + copy[1] == index:
+                    copy[1] += 1
+                else:
+                    if copy:
+                        yield ("copy", *copy)
+                    copy = [index, 1]
+                start += block_size
+                literal_start = start
+                weak = None
+                continue
+
+        if available == block_size:
+            break
+
+        # roll the window one byte forward
+        out_byte = buffer[start]
+        in_byte = buffer[start + block_size]
+        a = ((weak & 0xffff) - out_byte + in_byte) % ADLER_MOD
+        b = ((weak >> 16) - block_size * out_byte + a - 1) % ADLER_MOD
+        weak = (b << 16) | a
+        start += 1
+
+        if start - literal_start >= literal_limit:
+            if copy:
+                yield ("copy", *copy)
+                copy = None
+            yield ("data", bytes(buffer[literal_start:start]))
+            literal_start = start
+
+    # less than a block is left, or there are no full blocks to match against and the rest is streamed below
+    rest = bytes(buffer[start:])
+    if (end_of_file and tail is not None and len(rest) == tail[0] and zlib.adler32(rest) == tail[1]
+            and strong_checksum(rest) == tail[2]):
+        if literal_start < start:
+            if copy:
+                yield ("copy", *copy)
+                copy = None
+            yield ("data", bytes(buffer[literal_start:start]))
+        if copy and copy[0] + copy[1] == tail[3]:
+            copy[1] += 1
+        else:
+            if copy:
+                yield ("copy", *copy)
+            copy = [tail[3], 1]
+        rest = b""
+    else:
+        rest = bytes(buffer[literal_start:start]) + rest
+
+    if copy:
+        yield ("copy", *copy)
+    for offset in range(0, len(rest), literal_limit):
+        yield ("data", rest[offset:offset + literal_limit])
+    if not end_of_file:
+        while True:
+            chunk = file.read(literal_limit)
+            if not chunk:
+                break
+            yield ("data", chunk)
+
+
+def send_delta(active_socket, file, request_id, signature, block_size, basis_size):
+    """
+    Sends a file as a delta against the basis whose signature is given: a MSG_TRANSFER frame, MSG_COPY and MSG_DATA
+    frames, and a MSG_END frame.
+    :param active_socket: a connected socket object
+    :param file: the new file, opened in binary read mode at its start
+    :param request_id: id of the sync request
+    :param signature: the signature of the basis, see receive_signature()
+    :param block_size: the block size of the signature
+    :param basis_size: size of the basis in bytes
+    :return: tuple of (literal bytes sent, bytes reused from the basis)
+    """
+    size = os.fstat(file.fileno()).st_size
+    options = {"size": size, "block_size": block_size}
+    protocol.send_frame(active_socket, MSG_TRANSFER, protocol.encode_options(options), request_id)
+    literal = 0
+    for operation in compute_delta(file, signature, block_size, basis_size):
+        if operation[0] == "copy":
+            protocol.send_frame(active_socket, MSG_COPY, COPY.pack(operation[1], operation[2]), request_id)
+        else:
+            protocol.send_frame(active_socket, MSG_DATA, operation[1], request_id)
+            literal += len(operation[1])
+    protocol.send_frame(active_socket, MSG_END, b"", request_id)
+    return literal, size - literal
+
+
+def receive_delta(active_socket, basis, file, request_id, block_size):
+    """
+    Receives the MSG_COPY and MSG_DATA frames of a delta up to its MSG_END frame and rebuilds the new file from them.
+    The MSG_TRANSFER frame must already have been read by the caller.
+    :param active_socket: a connected socket object
+    :param basis: the old copy of the file opened in binary read mode, None if there is none
+    :param file: where the new file is written, None to discard the delta
+    :param request_id: id of the sync request
+    :param block_size: the block size of the signature the delta was computed against
+    :return: tuple of (literal bytes received, bytes copied from the basis)
+    """
+    literal = 0
+    copied = 0
+    while True:
+        msg_type, frame_request_id, payload = protocol.receive_frame(active_socket)
+        if frame_request_id != request_id:
+            raise protocol.ProtocolError(f"Expected a frame for request {request_id}, got {frame_request_id}")
+        if msg_type == MSG_END:
+            return literal, copied
+        if msg_type == MSG_DATA:
+            if file is not None:
+                file.write(payload)
+            literal += len(payload)
+        elif msg_type == MSG_COPY and len(payload) == COPY.size:
+            if file is None:
+                continue
+            if basis is None:
+                raise protocol.ProtocolError("Delta refers to a basis that does not exist")
+            first, count = COPY.unpack(payload)
+            basis.seek(first * block_size)
+            remaining = count * block_size
+            while remaining:
+                chunk = basis.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    break
+                file.write(chunk)
+                copied += len(chunk)
+                remaining -= len(chunk)
+        else:
+            raise protocol.ProtocolError(f"Unexpected message type {msg_type} in a delta")
@@ -0,0 +1,371 @@
+"""
+Instrumentation of the server: per-command counters and latency histograms, bytes in and out, active sessions and
+in-flight transfers, exposed by the stats command and an optional Prometheus text endpoint. Also sets up the
+server's logging: leveled, rate limited, and written by a background thread so handlers never wait on stdout.
+"""
+
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("fileserver")
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket (+Inf) is implicit
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# log records let through per message and interval by RateLimitFilter
+LOG_RATE = 10
+LOG_INTERVAL = 1.0
+
+
+class LatencyHistogram:
+    """
+    Counts of observations per LATENCY_BUCKETS bucket, plus their number and sum. Not thread safe on its own, it is
+    only used under the lock of ServerMetrics.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        while index < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile by linear interpolation within the bucket it falls in.
+        :param fraction: e.g. 0.95 for the 95th percentile
+        :return: the estimate in seconds, None without observations
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+                upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else lower * 2
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return LATENCY_BUCKETS[-1]
+
+
+class ServerMetrics:
+    """
+    Thread safe counters and gauges of one server. Every update takes one short lock, there is no I/O on the path
+    of a command.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # command -> [ok count, error count, LatencyHistogram]
+        self.commands = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.bytes_deduplicated = 0
+        self.active_sessions = 0
+        self.sessions_total = 0
+        self.inflight_transfers = 0
+        self.queued_transfers = 0
+        self.throttled_seconds = 0.0
+        self.queued_seconds = 0.0
+        self.file_cache_hits = 0
+        self.file_cache_misses = 0
+        self.file_cache_evictions = 0
+        self.file_cache_files = 0
+        self.file_cache_bytes = 0
+
+    def observe_command(self, command, seconds, ok):
+        with self.lock:
+            entry = self.commands.get(command)
+            if entry is None:
+                entry = self.commands[command] = [0, 0, LatencyHistogram()]
+            entry[0 if ok else 1] += 1
+            entry[2].observe(seconds)
+
+    def add_bytes(self, received=0, sent=0, deduplicated=0):
+        """
+        :param received: bytes received from a client, as they were on the wire
+        :param sent: bytes sent to a client, as they were on the wire
+        :param deduplicated: bytes of uploads the client did not send because the dedup store had them
+        """
+        with self.lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+            self.bytes_deduplicated += deduplicated
+
+    def session_opened(self):
+        with self.lock:
+            self.active_sessions += 1
+            self.sessions_total += 1
+
+    def session_closed(self):
+        with self.lock:
+            self.active_sessions -= 1
+
+    def transfer_started(self):
+        with self.lock:
+            self.inflight_transfers += 1
+
+    def transfer_finished(self):
+        with self.lock:
+            self.inflight_transfers -= 1
+
+    def transfer_queued(self, waiting):
+        """
+        :param waiting: 1 when a transfer starts waiting for a free slot (see shaping.TransferSlots), -1 when it got one
+        """
+        with self.lock:
+            self.queued_transfers += waiting
+
+    def add_wait(self, throttled=0.0, queued=0.0):
+        """
+        :param throttled: seconds a transfer slept because of the rate limits
+        :param queued: seconds a transfer waited for a free slot
+        """
+        with self.lock:
+            self.throttled_seconds += throttled
+            self.queued_seconds += queued
+
+    def observe_file_cache(self, hit, evicted, files, size):
+        """
+        :param hit: True for a lookup served from the server's file cache, False for a miss, None for no lookup
+        :param evicted: number of files evicted to make room
+        :param files: number of files the cache holds now
+        :param size: bytes the cache holds now
+        """
+        with self.lock:
+            if hit is not None:
+                if hit:
+                    self.file_cache_hits += 1
+                else:
+                    self.file_cache_misses += 1
+            self.file_cache_evictions += evicted
+            self.file_cache_files = files
+            self.file_cache_bytes = size
+
+    def snapshot(self):
+        """
+        :return: a consistent copy of all counters as a dict
+        """
+        with self.lock:
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "bytes_received": self.bytes_received,
+                "bytes_sent": self.bytes_sent,
+                "bytes_deduplicated": self.bytes_deduplicated,
+                "active_sessions": self.active_sessions,
+                "sessions_total": self.sessions_total,
+                "inflight_transfers": self.inflight_transfers,
+                "queued_transfers": self.queued_transfers,
+                "throttled_seconds": self.throttled_seconds,
+                "queued_seconds": self.queued_seconds,
+                "file_cache_hits": self.file_cache_hits,
+                "file_cache_misses": self.file_cache_misses,
+                "file_cache_evictions": self.file_cache_evictions,
+                "file_cache_files": self.file_cache_files,
+                "file_cache_bytes": self.file_cache_bytes,
+                "commands": {
+                    command: {
+                        "ok": ok,
+                        "errors": errors,
+                        "sum_seconds": histogram.sum,
+                        "buckets": list(histogram.counts),
+                        "p50": histogram.quantile(0.5),
+                        "p95": histogram.quantile(0.95),
+                        "p99": histogram.quantile(0.99),
+                    }
+                    for command, (ok, errors, histogram) in sorted(self.commands.items())
+                },
+            }
+
+    def render_text(self, transfer_stats=None):
+        """
+        :param transfer_stats: the server's protocol.TransferStats, its report is appended
+        :return: a human readable summary, as sent by the stats command
+        """
+        snapshot = self.snapshot()
+        lines = [
+            f"uptime {snapshot['uptime_seconds']:.0f} s, {snapshot['active_sessions']} active sessions "
+            f"({snapshot['sessions_total']} total), {snapshot['inflight_transfers']} transfers in flight, "
+            f"{snapshot['queued_transfers']} queued",
+            f"transfers throttled {snapshot['throttled_seconds']:.1f} s, queued {snapshot['queued_seconds']:.1f} s",
+            f"bytes received {snapshot['bytes_received']}, bytes sent {snapshot['bytes_sent']}, "
+            f"bytes deduplicated {snapshot['bytes_deduplicated']}",
+            f"file cache {snapshot['file_cache_hits']} hits, {snapshot['file_cache_misses']} misses, "
+            f"{snapshot['file_cache_evictions']} evictions, {snapshot['file_cache_files']} files "
+            f"({snapshot['file_cache_bytes']} bytes)",
+            f"{'command':<8} {'ok':>8} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'total s':>9}",
+        ]
+        for command, values in snapshot["commands"].items():
+            lines.append(f"{command:<8} {values['ok']:>8} {values['errors']:>7} {values['p50'] * 1000:>9.2f} "
+                         f"{values['p95'] * 1000:>9.2f} {values['p99'] * 1000:>9.2f} {values['sum_seconds']:>9.2f}")
+        if transfer_stats is not None:
+            report = transfer_stats.report()
+            if report:
+                lines.append(report)
+        return "\n".join(lines)
+
+    def render_prometheus(self, transfer_stats=None):
+        """
+        :param transfer_stats: the server's protocol.TransferStats, exported per transfer path
+        :return: the metrics in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP fileserver_commands_total Commands handled, by command and outcome.",
+            "# TYPE fileserver_commands_total counter",
+        ]
+        for command, values in snapshot["commands"].items():
+            lines.append(f'fileserver_commands_total{{command="{command}",status="ok"}} {values["ok"]}')
+            lines.append(f'fileserver_commands_total{{command="{command}",status="error"}} {values["errors"]}')
+
+        lines += [
+            "# HELP fileserver_command_duration_seconds Time from receiving a command to sending its status.",
+            "# TYPE fileserver_command_duration_seconds histogram",
+        ]
+        for command, values in snapshot["commands"].items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), values["buckets"]):
+                cumulative += count
+                lines.append(f'fileserver_command_duration_seconds_bucket{{command="{command}",le="{bound}"}} '
+                             f'{cumulative}')
+            lines.append(f'fileserver_command_duration_seconds_sum{{command="{command}"}} {values["sum_seconds"]}')
+            lines.append(f'fileserver_command_duration_seconds_count{{command="{command}"}} {cumulative}')
+
+        for name, kind, value, text in (
+                ("bytes_received_total", "counter", snapshot["bytes_received"], "Bytes received from clients."),
+                ("bytes_sent_total", "counter", snapshot["bytes_sent"], "Bytes sent to clients."),
+                ("bytes_deduplicated_total", "counter", snapshot["bytes_deduplicated"],
+                 "Upload bytes taken from the dedup store instead of the network."),
+                ("active_sessions", "gauge", snapshot["active_sessions"], "Open client sessions."),
+                ("sessions_total", "counter", snapshot["sessions_total"], "Client sessions opened."),
+                ("inflight_transfers", "gauge", snapshot["inflight_transfers"], "Transfer commands running."),
+                ("queued_transfers", "gauge", snapshot["queued_transfers"],
+                 "Transfer commands waiting for a free transfer slot."),
+                ("throttled_seconds_total", "counter", snapshot["throttled_seconds"],
+                 "Seconds transfers were slowed down by the rate limits."),
+                ("queued_seconds_total", "counter", snapshot["queued_seconds"],
+                 "Seconds transfers waited for a free transfer slot."),
+                ("file_cache_hits_total", "counter", snapshot["file_cache_hits"],
+                 "Downloads served from the file cache."),
+                ("file_cache_misses_total", "counter", snapshot["file_cache_misses"],
+                 "Downloads of files that were not in the file cache."),
+                ("file_cache_evictions_total", "counter", snapshot["file_cache_evictions"],
+                 "Files evicted from the file cache to make room."),
+                ("file_cache_files", "gauge", snapshot["file_cache_files"], "Files in the file cache."),
+                ("file_cache_bytes", "gauge", snapshot["file_cache_bytes"], "Bytes in the file cache."),
+                ("uptime_seconds", "gauge", snapshot["uptime_seconds"], "Seconds since the server started.")):
+            lines += [f"# HELP fileserver_{name} {text}", f"# TYPE fileserver_{name} {kind}",
+                      f"fileserver_{name} {value}"]
+
+        if transfer_stats is not None:
+            with transfer_stats.lock:
+                totals = {path: list(values) for path, values in transfer_stats.totals.items()}
+            lines += ["# HELP fileserver_transfer_bytes_total File bytes transferred, by transfer path.",
+                      "# TYPE fileserver_transfer_bytes_total counter"]
+            lines += [f'fileserver_transfer_bytes_total{{path="{path}"}} {values[1]}'
+                      for path, values in sorted(totals.items())]
+            lines += ["# HELP fileserver_transfer_seconds_total Time spent in transfers, by transfer path.",
+                      "# TYPE fileserver_transfer_seconds_total counter"]
+            lines += [f'fileserver_transfer_seconds_total{{path="{path}"}} {values[2]}'
+                      for path, values in sorted(totals.items())]
+        return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(server_metrics, port, transfer_stats=None, host="127.0.0.1"):
+    """
+    Serves GET /metrics in the Prometheus text format from a daemon thread.
+    :return: the HTTP server, call shutdown() on it to stop
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = server_metrics.render_prometheus(transfer_stats).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics endpoint: " + format, *args)
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, name="metrics-endpoint", daemon=True).start()
+    logger.info("Metrics endpoint listening on http://%s:%s/metrics", host, http_server.server_address[1])
+    return http_server
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `rate` records of the same message (the format string, before its arguments are filled in) through
+    per interval, so an error repeated by every client under load costs a dictionary lookup instead of a write.
+    The first record after a window reports how many were dropped.
+    """
+
+    def __init__(self, rate=LOG_RATE, interval=LOG_INTERVAL):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.lock = threading.Lock()
+        # (logger name, level, message) -> [window start, records let through, records dropped]
+        self.windows = {}
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+                if dropped:
+                    record.msg = f"{record.msg} [{dropped} similar messages suppressed]"
+                return True
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def configure_logging(level="INFO", rate=LOG_RATE, interval=LOG_INTERVAL, stream=None):
+    """
+    Sends the records of the 'fileserver' logger through a queue to a background thread that writes them, after
+    dropping the ones above the rate limit.
+    :param level: name of the lowest level that is logged, e.g. 'DEBUG'
+    :param rate: records let through per message and interval, 0 for no limit
+    :param interval: length of a rate limit window in seconds
+    :param stream: where the records are written, stdout by default
+    :return: the started logging.handlers.QueueListener, stop() flushes it
+    """
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    if rate:
+        queue_handler.addFilter(RateLimitFilter(rate, interval))
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(threadName)s] %(message)s"))
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+
+    logger.setLevel(level)
+    logger.handlers[:] = [queue_handler]
+    logger.propagate = False
+    return listener
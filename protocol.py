@@ -0,0 +1,915 @@
+"""
+Framing protocol shared by server.py and client.py.
+
+After the handshake every message is sent as a frame: a fixed size header followed by the payload.
+The header is (version, message type, request id, payload length) packed in network byte order, so the reader
+always knows how many bytes to expect and never has to scan the data for a terminator.
+A file is sent as a MSG_TRANSFER frame (metadata), any number of MSG_DATA frames (content) and a MSG_END frame.
+If the session negotiated checksums, the MSG_END payload carries the checksum of the content (see end_payload()),
+which the receiver computes while the data arrives and compares.
+The reply to every command ends with a MSG_STATUS frame.
+"""
+
+import glob
+import hashlib
+import mmap
+import os
+import socket
+import stat
+import struct
+import threading
+import zlib
+from urllib.parse import quote, unquote
+
+# version 2: replies end with MSG_STATUS instead of MSG_LISTING, MSG_ERROR was replaced by it
+PROTOCOL_VERSION = 2
+SUPPORTED_VERSIONS = (2,)
+
+# version (1 byte), message type (1 byte), request id (4 bytes), payload length (8 bytes)
+HEADER = struct.Struct("!BBIQ")
+
+# message types
+MSG_COMMAND = 1
+MSG_LISTING = 2
+MSG_TEXT = 3
+MSG_STATUS = 4
+MSG_TRANSFER = 5
+MSG_DATA = 6
+MSG_END = 7
+# delta transfers of the sync command, see delta.py
+MSG_SIGNATURE = 8
+MSG_COPY = 9
+# deduplicated uploads: the digest of a chunk the server already stores, sent instead of its MSG_DATA, see dedup.py
+MSG_CHUNK = 10
+
+# MSG_STATUS payload: status code (2 bytes) followed by a UTF-8 message
+STATUS = struct.Struct("!H")
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_INVALID = 2
+
+# size of each MSG_DATA frame when streaming a file
+CHUNK_SIZE = 64 * 1024
+
+# MSG_DATA frames sent with sendfile() are larger, since the payload never passes through Python
+SENDFILE_CHUNK_SIZE = 1024 * 1024
+
+# frames other than MSG_DATA are read into memory at once, so their size is capped
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+# payloads up to this size are copied behind the header, larger ones are sent together with it by sendmsg()
+SMALL_PAYLOAD_SIZE = 4096
+
+
+# transfers are compressed only if a sample of the data shrinks to at most this fraction of its size
+COMPRESSIBLE_RATIO = 0.9
+
+# data smaller than this is never compressed
+MIN_COMPRESS_SIZE = 512
+
+
+# checksum of transfers, offered in the handshake: blake2b with 32 byte digests, which is also how dedup.py names
+# the content of a file
+CHECKSUM = "blake2b"
+CHECKSUM_SIZE = 32
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a frame that does not follow the protocol."""
+
+
+class IntegrityError(Exception):
+    """
+    Raised when the data of a transfer does not match the checksum in its MSG_END frame, or the size announced in its
+    MSG_TRANSFER frame. All frames of the transfer have been read by then, so the connection can still be used.
+    """
+
+
+# codec name -> (factory of a compress function, factory of a decompress function), in order of preference.
+# Each function handles the MSG_DATA payloads of one transfer; the compress function must flush its output, so that
+# every payload can be decompressed as soon as it arrives.
+CODECS = {}
+
+
+def register_codec(name, compressor_factory, decompressor_factory):
+    """
+    Makes a compression codec available for negotiation in the handshake.
+    :param name: the name used in the handshake and in MSG_TRANSFER frames, without spaces or commas
+    :param compressor_factory: returns a function that compresses one chunk of a transfer
+    :param decompressor_factory: returns a function that decompresses one MSG_DATA payload of a transfer
+    """
+    CODECS[name] = (compressor_factory, decompressor_factory)
+
+
+def _zlib_compressor():
+    # level 1: the cheapest level already gets most of the gain on text, and costs little CPU per byte
+    compressor = zlib.compressobj(1)
+    return lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _zlib_decompressor():
+    decompressor = zlib.decompressobj()
+
+    def decompress(payload):
+        data = decompressor.decompress(payload, MAX_MESSAGE_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ProtocolError(f"Compressed payload expands beyond {MAX_MESSAGE_SIZE} bytes")
+        return data
+
+    return decompress
+
+
+register_codec("zlib", _zlib_compressor, _zlib_decompressor)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+else:
+    def _zstd_compressor():
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        return lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    # a zstd block decodes to at most 128 KiB and takes at least 4 bytes of input (an RLE block), so a piece of
+    # compressed input this size expands to at most MAX_MESSAGE_SIZE
+    ZSTD_INPUT_PIECE = MAX_MESSAGE_SIZE // (128 * 1024 // 4)
+
+    def _zstd_decompressor():
+        # the zstd decompressobj has no output limit like zlib's max_length: the payload is fed in pieces instead,
+        # and the output is checked after each one
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+        def decompress(payload):
+            view = memoryview(payload)
+            pieces = []
+            size = 0
+            for start in range(0, len(view), ZSTD_INPUT_PIECE):
+                data = decompressor.decompress(view[start:start + ZSTD_INPUT_PIECE])
+                size += len(data)
+                if size > MAX_MESSAGE_SIZE:
+                    raise ProtocolError(f"Compressed payload expands beyond {MAX_MESSAGE_SIZE} bytes")
+                pieces.append(data)
+            return b"".join(pieces)
+
+        return decompress
+
+    # preferred over zlib when both sides have it
+    CODECS = {"zstd": None, **CODECS}
+    register_codec("zstd", _zstd_compressor, _zstd_decompressor)
+
+
+def is_compressible(codec, sample):
+    """
+    Compresses a sample of the data, e.g. its first chunk, to find out whether compressing the rest is worth it.
+    Data that is already compressed (archives, images, video) does not shrink and is sent as it is.
+    :param codec: name of a registered codec
+    :param sample: bytes from the start of the data
+    :return: True if the sample shrinks to at most COMPRESSIBLE_RATIO of its size.
+    """
+    if len(sample) < MIN_COMPRESS_SIZE:
+        return False
+    return len(CODECS[codec][0]()(sample)) <= len(sample) * COMPRESSIBLE_RATIO
+
+
+class StreamCompressor:
+    """
+    Compresses the MSG_DATA payloads of one transfer and counts the raw and the wire bytes. Whether the transfer is
+    compressed at all is decided on its first chunk, see start().
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.compress_chunk = CODECS[codec][0]()
+        self.enabled = True
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def start(self, chunk):
+        """
+        Compresses the first chunk of the transfer, and disables compression for the whole transfer if the chunk
+        does not shrink to COMPRESSIBLE_RATIO of its size.
+        :return: the payload of the first MSG_DATA frame
+        """
+        data = self.compress_chunk(chunk) if len(chunk) >= MIN_COMPRESS_SIZE else chunk
+        if len(chunk) < MIN_COMPRESS_SIZE or len(data) > len(chunk) * COMPRESSIBLE_RATIO:
+            self.enabled = False
+            data = chunk
+        self.raw_bytes += len(chunk)
+        self.wire_bytes += len(data)
+        return data
+
+    def process(self, chunk):
+        """
+        :return: the payload of the MSG_DATA frame carrying chunk
+        """
+        data = self.compress_chunk(chunk) if self.enabled else chunk
+        self.raw_bytes += len(chunk)
+        self.wire_bytes += len(data)
+        return data
+
+
+class StreamDecompressor:
+    """
+    Decompresses the MSG_DATA payloads of one transfer sent with the codec named in its MSG_TRANSFER frame.
+    """
+
+    def __init__(self, codec):
+        if codec not in CODECS:
+            raise ProtocolError(f"Unknown compression codec '{codec}'")
+        self.codec = codec
+        self.decompress_chunk = CODECS[codec][1]()
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def process(self, payload):
+        data = self.decompress_chunk(payload)
+        self.raw_bytes += len(data)
+        self.wire_bytes += len(payload)
+        return data
+
+
+def decompressor_for(metadata):
+    """
+    :param metadata: the decoded options of a MSG_TRANSFER frame
+    :return: a StreamDecompressor if the transfer is compressed, None otherwise
+    """
+    codec = metadata.get("codec")
+    return StreamDecompressor(codec) if codec else None
+
+
+class TransferStats:
+    """
+    Thread safe counters of transfers, bytes and seconds per transfer path (e.g. 'sendfile', 'buffered' or a
+    compression codec), so the throughput of the paths can be compared. The bytes are counted twice: raw (the file
+    content) and on the wire (after compression).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> [number of transfers, raw bytes, seconds, wire bytes]
+        self.totals = {}
+
+    def record(self, path, nbytes, seconds, wire_bytes=None):
+        """
+        Adds one finished transfer to the counters of its path.
+        :param path: name of the transfer path
+        :param nbytes: number of bytes transferred
+        :param seconds: time the transfer took
+        :param wire_bytes: number of bytes sent over the connection, if the transfer was compressed
+        """
+        with self.lock:
+            totals = self.totals.setdefault(path, [0, 0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += nbytes
+            totals[2] += seconds
+            totals[3] += nbytes if wire_bytes is None else wire_bytes
+
+    def rate(self, path):
+        """
+        :param path: name of the transfer path
+        :return: the average throughput of the path in bytes per second, 0 if nothing was transferred yet.
+        """
+        with self.lock:
+            _, nbytes, seconds, _ = self.totals.get(path, (0, 0, 0.0, 0))
+        return nbytes / seconds if seconds else 0.0
+
+    def report(self):
+        """
+        :return: one line per transfer path with its counters and average throughput.
+        """
+        with self.lock:
+            totals = {path: list(values) for path, values in self.totals.items()}
+        return "\n".join(
+            f"{path}: {count} transfers, {nbytes} bytes ({wire} on the wire), "
+            f"{nbytes / seconds / 1e6 if seconds else 0:.1f} MB/s"
+            for path, (count, nbytes, seconds, wire) in sorted(totals.items())
+        )
+
+
+def new_checksum():
+    """
+    :return: a hash object for the checksum of a transfer, fed with the data as it is sent or received
+    """
+    return hashlib.blake2b(digest_size=CHECKSUM_SIZE)
+
+
+def file_checksum(file, chunk_size=SENDFILE_CHUNK_SIZE):
+    """
+    Reads a file from its current position to the end.
+    :return: the hex checksum of the data
+    """
+    checksum = new_checksum()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    while True:
+        count = file.readinto(buffer)
+        if not count:
+            return checksum.hexdigest()
+        checksum.update(view[:count])
+
+
+def end_payload(checksum=None, digest=None):
+    """
+    :param checksum: the hash object that saw the data of the transfer, see new_checksum()
+    :param digest: the hex checksum of the data if it is already known, e.g. from a cache
+    :return: the payload of the MSG_END frame of a transfer, empty without a checksum
+    """
+    if checksum is not None:
+        digest = checksum.hexdigest()
+    return encode_options({"checksum": digest}) if digest else b""
+
+
+def verify_end(payload, checksum):
+    """
+    Compares the checksum in a MSG_END payload with the one computed while the data arrived. Transfers received
+    without computing one pass; a receiver computes one only if the session negotiated checksums, so then the
+    sender must have put one in the MSG_END frame.
+    :param payload: the payload of the MSG_END frame
+    :param checksum: the hash object fed with the received data, or None
+    :raises IntegrityError: if the checksums differ or the MSG_END frame carries none
+    """
+    if checksum is None:
+        return
+    expected = decode_options(payload).get("checksum")
+    if expected is None:
+        raise IntegrityError("Checksum missing: the sender did not put one in the end of the transfer")
+    if expected != checksum.hexdigest():
+        raise IntegrityError(f"Checksum mismatch: the data was corrupted in transit (expected {expected}, "
+                             f"received {checksum.hexdigest()})")
+
+
+def verify_size(received, size):
+    """
+    :param received: the number of bytes that arrived up to the MSG_END frame
+    :param size: the size announced in the MSG_TRANSFER frame, or None
+    :raises IntegrityError: if they differ
+    """
+    if size is not None and received != size:
+        raise IntegrityError(f"Incomplete transfer: received {received} of the announced {size} bytes")
+
+
+def encode_options(options):
+    """
+    Encodes a dict as a space separated 'key=value' string, used by the handshake and MSG_TRANSFER frames.
+    Values are percent-encoded, so they may contain spaces, e.g. file names.
+    :param options: dict of option names to values
+    :return: the encoded options as bytes
+    """
+    return " ".join(f"{key}={quote(str(value), safe='/,')}" for key, value in options.items()).encode()
+
+
+def decode_options(payload):
+    """
+    Decodes a payload created by encode_options(). Words without '=' are ignored.
+    :param payload: bytes or str of space separated 'key=value' words
+    :return: dict of option names to string values
+    """
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode()
+    return {key: unquote(value) for key, _, value in (word.partition("=") for word in payload.split() if "=" in word)}
+
+
+def parse_command(command):
+    """
+    Splits a command line into its verb, the leading '--name=value' options and the remaining argument, e.g.
+    'ls --limit=20 *.txt' -> ('ls', {'limit': '20'}, '*.txt'). The argument keeps its spaces. A '--' word ends the
+    options, and an option without '=value' is stored as 'true'.
+    :param command: the command line
+    :return: tuple of (verb, dict of options, argument)
+    """
+    verb, _, rest = command.partition(" ")
+    options = {}
+    while rest.startswith("--"):
+        word, _, remainder = rest.partition(" ")
+        rest = remainder
+        if word == "--":
+            break
+        name, has_value, value = word[2:].partition("=")
+        options[name] = value if has_value else "true"
+    return verb, options, rest
+
+
+def safe_relative_path(name):
+    """
+    Checks a relative path received from the peer, e.g. the name of a file in a batch transfer.
+    :param name: a '/' separated relative path
+    :return: the path with the platform's separators
+    :raises ValueError: if the path is empty, absolute or leaves its base directory with '..'
+    """
+    parts = name.replace("\\", "/").split("/")
+    if not name or name.startswith("/") or any(part in ("", ".", "..") for part in parts) or parts[0].endswith(":"):
+        raise ValueError(f"Unsafe path '{name}'")
+    return os.path.join(*parts)
+
+
+def partial_path(path):
+    """
+    :param path: path of a file that is being transferred
+    :return: path of the hidden file the transfer is staged in until it is complete, e.g. 'dir/.name.part'
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.part")
+
+
+def expand_paths(base_directory, patterns, exclude=frozenset()):
+    """
+    Expands the arguments of mput/mget to the regular files they name. A directory stands for every file below it,
+    anything else is a glob pattern relative to base_directory, where '**' matches any number of sub directories.
+    :param base_directory: the directory the patterns are relative to
+    :param patterns: list of file names, directory names or glob patterns
+    :param exclude: set of absolute paths of directories whose files are left out, see server.Namespace
+    :return: tuple of (sorted '/' separated paths relative to base_directory, patterns that matched no file)
+    """
+    found = set()
+    unmatched = []
+    for pattern in patterns:
+        matches = set()
+        for name in glob.glob(pattern, root_dir=base_directory, recursive=True):
+            path = os.path.normpath(os.path.join(base_directory, name))
+            if path in exclude:
+                continue
+            if os.path.isdir(path):
+                for root, directories, files in os.walk(path):
+                    directories[:] = [directory for directory in directories
+                                      if os.path.join(root, directory) not in exclude]
+                    relative_root = os.path.relpath(root, base_directory)
+                    matches.update(os.path.normpath(os.path.join(relative_root, file)) for file in files)
+            elif os.path.isfile(path):
+                matches.add(os.path.normpath(name))
+        if not matches:
+            unmatched.append(pattern)
+        found |= matches
+    return sorted(name.replace(os.sep, "/") for name in found), unmatched
+
+
+def configure_socket(active_socket):
+    """
+    Disables Nagle's algorithm on a connected socket. Frames are written as a header followed by the payload, and
+    without TCP_NODELAY the small trailing segments of a reply would wait for the peer's delayed ACK.
+    :param active_socket: a connected TCP socket object
+    """
+    active_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def send_frame(active_socket, msg_type, payload=b"", request_id=0):
+    """
+    Sends one frame on the socket.
+    :param active_socket: a connected socket object
+    :param msg_type: one of the MSG_* constants
+    :param payload: bytes-like payload of the frame
+    :param request_id: id of the request this frame belongs to
+    """
+    header = HEADER.pack(PROTOCOL_VERSION, msg_type, request_id, len(payload))
+    if len(payload) <= SMALL_PAYLOAD_SIZE or not hasattr(active_socket, "sendmsg"):
+        active_socket.sendall(header + bytes(payload))
+        return
+
+    # gather the header and the payload into one system call without copying the payload
+    sent = active_socket.sendmsg([header, payload])
+    if sent < len(header):
+        active_socket.sendall(header[sent:])
+        active_socket.sendall(payload)
+    elif sent < len(header) + len(payload):
+        active_socket.sendall(memoryview(payload)[sent - len(header):])
+
+
+def send_status(active_socket, code, message, request_id):
+    """
+    Sends the MSG_STATUS frame that ends the reply to a command.
+    :param active_socket: a connected socket object
+    :param code: one of the STATUS_* constants
+    :param message: a short text for the user, e.g. the reason of an error
+    :param request_id: id of the request the status belongs to
+    """
+    send_frame(active_socket, MSG_STATUS, STATUS.pack(code) + message.encode(), request_id)
+
+
+def decode_status(payload):
+    """
+    :param payload: the payload of a MSG_STATUS frame
+    :return: tuple of (status code, message)
+    """
+    (code,) = STATUS.unpack_from(payload)
+    return code, bytes(payload[STATUS.size:]).decode()
+
+
+def receive_into(active_socket, buffer):
+    """
+    Fills the given buffer completely with recv_into() calls.
+    :param active_socket: a connected socket object
+    :param buffer: a writable bytes-like object, e.g. a bytearray or memoryview slice
+    """
+    view = memoryview(buffer)
+    while view:
+        received = active_socket.recv_into(view)
+        if not received:
+            raise ConnectionError("Connection closed by the peer")
+        view = view[received:]
+
+
+def receive_header(active_socket):
+    """
+    Receives and unpacks one frame header.
+    :param active_socket: a connected socket object
+    :return: tuple of (message type, request id, payload length)
+    """
+    header = bytearray(HEADER.size)
+    receive_into(active_socket, header)
+    version, msg_type, request_id, length = HEADER.unpack(header)
+    if version not in SUPPORTED_VERSIONS:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    return msg_type, request_id, length
+
+
+def receive_payload(active_socket, length):
+    """
+    Receives a payload of a known length into a buffer that is allocated once.
+    :param active_socket: a connected socket object
+    :param length: the payload length from the frame header
+    :return: the payload as a bytearray
+    """
+    if length > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"Message of {length} bytes exceeds the limit of {MAX_MESSAGE_SIZE} bytes")
+    payload = bytearray(length)
+    receive_into(active_socket, payload)
+    return payload
+
+
+def receive_frame(active_socket):
+    """
+    Receives one complete frame.
+    :param active_socket: a connected socket object
+    :return: tuple of (message type, request id, payload)
+    """
+    msg_type, request_id, length = receive_header(active_socket)
+    return msg_type, request_id, receive_payload(active_socket, length)
+
+
+def send_file(active_socket, file, request_id, size, chunk_size=CHUNK_SIZE, metadata=None, compressor=None,
+              checksum=None, digest=None):
+    """
+    Sends an open file as a MSG_TRANSFER frame, MSG_DATA frames of at most chunk_size bytes and a MSG_END frame.
+    The data starts at the current position of the file, so a range is sent by seeking to its offset first.
+    Only one chunk of the file is held in memory at a time.
+    :param active_socket: a connected socket object
+    :param file: a file object opened in binary read mode
+    :param request_id: id of the request this transfer belongs to
+    :param size: the number of bytes that will be sent
+    :param chunk_size: the size of each read() call
+    :param metadata: extra options for the MSG_TRANSFER frame, e.g. {'name': 'dir/file.txt'} in a batch
+    :param compressor: a StreamCompressor to compress the chunks with, it also counts the raw and the wire bytes.
+        If the first chunk does not compress well, the file is sent uncompressed.
+    :param checksum: a hash object (see new_checksum()) to feed with the data, its digest goes into the MSG_END frame
+    :param digest: the hex checksum of the data if it is already known, sent instead of computing one
+    :return: the number of bytes of the file that were sent, less than size if the file shrank meanwhile; the
+        receiver then fails the transfer (see receive_file_data())
+    """
+    chunk = file.read(min(chunk_size, size))
+    payload = chunk
+    options = {"size": size, **(metadata or {})}
+    if compressor is not None:
+        payload = compressor.start(chunk)
+        if compressor.enabled:
+            options["codec"] = compressor.codec
+
+    send_frame(active_socket, MSG_TRANSFER, encode_options(options), request_id)
+    sent = 0
+    while chunk:
+        send_frame(active_socket, MSG_DATA, payload, request_id)
+        if checksum is not None:
+            checksum.update(chunk)
+        sent += len(chunk)
+        if sent >= size:
+            break
+        chunk = file.read(min(chunk_size, size - sent))
+        payload = compressor.process(chunk) if compressor is not None and chunk else chunk
+    send_frame(active_socket, MSG_END, end_payload(checksum, digest), request_id)
+    return sent
+
+
+def can_sendfile(file):
+    """
+    Checks whether a file can be sent with the zero-copy sendfile() path, i.e. the platform has os.sendfile and the
+    file is a regular file. Anything else (pipes, character devices, in-memory files) uses send_file().
+    :param file: a file object opened in binary read mode
+    :return: True if sendfile_file() can be used for the file.
+    """
+    if not hasattr(os, "sendfile"):
+        return False
+    try:
+        return stat.S_ISREG(os.fstat(file.fileno()).st_mode)
+    except (OSError, ValueError, AttributeError):
+        return False
+
+
+def sendfile_file(active_socket, file, request_id, size, chunk_size=SENDFILE_CHUNK_SIZE, metadata=None, digest=None):
+    """
+    Same frames as send_file(), but the content of each MSG_DATA frame is copied from the file to the socket by the
+    kernel with socket.sendfile(), so it never passes through user space. The data starts at the current position of
+    the file, like send_file(). The data is not seen by Python, so a checksum can only be sent if it is known.
+    :param active_socket: a connected socket object
+    :param file: a regular file opened in binary read mode, see can_sendfile()
+    :param request_id: id of the request this transfer belongs to
+    :param size: the number of bytes that will be sent
+    :param chunk_size: the payload size of each MSG_DATA frame
+    :param metadata: extra options for the MSG_TRANSFER frame
+    :param digest: the hex checksum of the data for the MSG_END frame, or None
+    :return: the number of bytes of the file that were sent
+    """
+    send_frame(active_socket, MSG_TRANSFER, encode_options({"size": size, **(metadata or {})}), request_id)
+    start = file.tell()
+    sent = 0
+    while sent < size:
+        count = min(chunk_size, size - sent)
+        active_socket.sendall(HEADER.pack(PROTOCOL_VERSION, MSG_DATA, request_id, count))
+        if active_socket.sendfile(file, start + sent, count) != count:
+            # the header already promised count bytes, the frame stream cannot be repaired
+            raise ProtocolError("File shrank while it was being sent")
+        sent += count
+    send_frame(active_socket, MSG_END, end_payload(digest=digest), request_id)
+    return sent
+
+
+def send_buffer(active_socket, buffer, request_id, chunk_size=SENDFILE_CHUNK_SIZE, metadata=None, compressor=None,
+                payloads=None, checksum=None, digest=None):
+    """
+    Same frames as send_file() for data that is already in memory, e.g. a file of the server's read cache. The
+    uncompressed MSG_DATA payloads are slices of the buffer, sent without copying it.
+    :param active_socket: a connected socket object
+    :param buffer: a bytes-like object holding the data to send
+    :param request_id: id of the request this transfer belongs to
+    :param chunk_size: the payload size of each MSG_DATA frame
+    :param metadata: extra options for the MSG_TRANSFER frame
+    :param compressor: a StreamCompressor, as for send_file()
+    :param payloads: a list the compressed MSG_DATA payloads are appended to, so they can be sent again with
+        send_payloads(); nothing is appended if the data turned out not to compress
+    :param checksum: a hash object to feed with the data, as for send_file()
+    :param digest: the hex checksum of the data if it is already known
+    :return: the number of bytes of the buffer that were sent
+    """
+    view = memoryview(buffer)
+    size = len(view)
+    chunk = view[:chunk_size]
+    payload = chunk
+    options = {"size": size, **(metadata or {})}
+    if compressor is not None:
+        payload = compressor.start(chunk)
+        if compressor.enabled:
+            options["codec"] = compressor.codec
+
+    send_frame(active_socket, MSG_TRANSFER, encode_options(options), request_id)
+    keep = payloads is not None and compressor is not None and compressor.enabled
+    sent = 0
+    while sent < size:
+        send_frame(active_socket, MSG_DATA, payload, request_id)
+        if keep:
+            payloads.append(payload)
+        if checksum is not None:
+            checksum.update(chunk)
+        sent += len(chunk)
+        chunk = view[sent:sent + chunk_size]
+        payload = compressor.process(chunk) if compressor is not None and len(chunk) else chunk
+    send_frame(active_socket, MSG_END, end_payload(checksum, digest), request_id)
+    return sent
+
+
+def send_payloads(active_socket, payloads, codec, request_id, size, metadata=None, digest=None):
+    """
+    Sends data compressed by an earlier send_buffer() again, without compressing it a second time.
+    :param payloads: the compressed MSG_DATA payloads collected by send_buffer()
+    :param codec: the codec they were compressed with
+    :param size: the number of bytes they decompress to
+    :param digest: the hex checksum of the uncompressed data for the MSG_END frame, or None
+    :return: the number of bytes on the wire
+    """
+    send_frame(active_socket, MSG_TRANSFER, encode_options({"size": size, **(metadata or {}), "codec": codec}),
+               request_id)
+    for payload in payloads:
+        send_frame(active_socket, MSG_DATA, payload, request_id)
+    send_frame(active_socket, MSG_END, end_payload(digest=digest), request_id)
+    return sum(len(payload) for payload in payloads)
+
+
+def receive_file_data(active_socket, file, request_id, chunk_size=CHUNK_SIZE, decompressor=None, checksum=None,
+                      size=None):
+    """
+    Receives the MSG_DATA frames of a transfer up to its MSG_END frame and writes them to the file as they arrive.
+    The MSG_TRANSFER frame must already have been read by the caller. All data is received into one preallocated
+    buffer of chunk_size bytes.
+    :param active_socket: a connected socket object
+    :param file: a file object opened in binary write mode, or None to discard the data
+    :param request_id: id of the request this transfer belongs to
+    :param chunk_size: the size of the receive buffer
+    :param decompressor: a StreamDecompressor if the MSG_TRANSFER frame named a codec, see decompressor_for()
+    :param checksum: a hash object (see new_checksum()) to feed with the data and check against the MSG_END frame
+    :param size: the size announced in the MSG_TRANSFER frame, None if the caller does not check it
+    :return: the number of (decompressed) bytes received
+    :raises IntegrityError: if the data does not match the checksum the sender put in the MSG_END frame, or fewer or
+        more bytes than size arrived, e.g. because the file shrank while it was being sent
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    received = 0
+    while True:
+        msg_type, frame_request_id, length = receive_header(active_socket)
+        if frame_request_id != request_id:
+            raise ProtocolError(f"Expected a frame for request {request_id}, got {frame_request_id}")
+        if msg_type == MSG_END:
+            verify_end(receive_payload(active_socket, length), checksum)
+            verify_size(received, size)
+            return received
+        if msg_type != MSG_DATA:
+            raise ProtocolError(f"Unexpected message type {msg_type} during a file transfer")
+        if decompressor is not None:
+            data = decompressor.process(receive_payload(active_socket, length))
+            if file is not None:
+                file.write(data)
+            if checksum is not None:
+                checksum.update(data)
+            received += len(data)
+            continue
+        while length:
+            part = view[:min(length, chunk_size)]
+            receive_into(active_socket, part)
+            if file is not None:
+                file.write(part)
+            if checksum is not None:
+                checksum.update(part)
+            length -= len(part)
+            received += len(part)
+
+
+def receive_file_data_mapped(active_socket, file, size, request_id, offset=0, decompressor=None, checksum=None):
+    """
+    Same as receive_file_data(), but the file is first extended to the size announced in the MSG_TRANSFER frame and
+    memory-mapped, and every MSG_DATA payload is received directly into its place in the mapping (or decompressed
+    into it).
+    :param active_socket: a connected socket object
+    :param file: a file object opened in binary read/write mode ('wb+', or 'rb+' to write a range into a file)
+    :param size: the size announced in the MSG_TRANSFER frame, must be greater than 0
+    :param request_id: id of the request this transfer belongs to
+    :param offset: where the data goes in the file, the bytes before it are left as they are
+    :param decompressor: a StreamDecompressor if the MSG_TRANSFER frame named a codec
+    :param checksum: a hash object to feed with the data and check against the MSG_END frame
+    :return: the number of (decompressed) bytes received
+    :raises IntegrityError: if the data does not match the checksum the sender put in the MSG_END frame, or ends
+        before size bytes arrived
+    """
+    end = offset + size
+    original_size = os.fstat(file.fileno()).st_size
+    if original_size < end:
+        file.truncate(end)
+    received = 0
+    try:
+        with mmap.mmap(file.fileno(), end) as mapped:
+            view = memoryview(mapped)
+            try:
+                while True:
+                    msg_type, frame_request_id, length = receive_header(active_socket)
+                    if frame_request_id != request_id:
+                        raise ProtocolError(f"Expected a frame for request {request_id}, got {frame_request_id}")
+                    if msg_type == MSG_END:
+                        payload = receive_payload(active_socket, length)
+                        break
+                    if msg_type != MSG_DATA:
+                        raise ProtocolError(f"Unexpected message type {msg_type} during a file transfer")
+                    if decompressor is not None:
+                        data = decompressor.process(receive_payload(active_socket, length))
+                        if received + len(data) > size:
+                            raise ProtocolError(f"Transfer is larger than the announced {size} bytes")
+                        view[offset + received:offset + received + len(data)] = data
+                        if checksum is not None:
+                            checksum.update(data)
+                        received += len(data)
+                        continue
+                    if received + length > size:
+                        raise ProtocolError(f"Transfer is larger than the announced {size} bytes")
+                    receive_into(active_socket, view[offset + received:offset + received + length])
+                    if checksum is not None:
+                        checksum.update(view[offset + received:offset + received + length])
+                    received += length
+            finally:
+                view.release()
+    finally:
+        # also when the connection dropped: the size of a partial file must tell how much of it was received
+        if received < size and original_size < end:
+            file.truncate(max(original_size, offset + received))
+    verify_end(payload, checksum)
+    verify_size(received, size)
+    return received
+
+
+class FrameWriter:
+    """
+    Writable file-like object that sends everything written to it as the data of one transfer, for content that is
+    produced on the fly instead of read from a file, e.g. a tar archive. The data is cut into MSG_DATA frames of
+    chunk_size bytes; the MSG_TRANSFER frame goes out with the first chunk, once the compressor has sampled it, and
+    close() sends the MSG_END frame, with the checksum of the data if a hash object was given.
+    """
+
+    def __init__(self, active_socket, request_id, metadata=None, compressor=None, chunk_size=CHUNK_SIZE,
+                 checksum=None):
+        self.active_socket = active_socket
+        self.request_id = request_id
+        self.metadata = metadata or {}
+        self.compressor = compressor
+        self.chunk_size = chunk_size
+        self.checksum = checksum
+        self.buffer = bytearray()
+        self.started = False
+        self.raw_bytes = 0
+
+    @property
+    def wire_bytes(self):
+        return self.compressor.wire_bytes if self.compressor is not None else self.raw_bytes
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self.send_chunk(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def send_chunk(self, chunk):
+        payload = chunk
+        if not self.started:
+            options = dict(self.metadata)
+            if self.compressor is not None:
+                payload = self.compressor.start(chunk)
+                if self.compressor.enabled:
+                    options["codec"] = self.compressor.codec
+            send_frame(self.active_socket, MSG_TRANSFER, encode_options(options), self.request_id)
+            self.started = True
+        elif self.compressor is not None:
+            payload = self.compressor.process(chunk)
+        if chunk:
+            send_frame(self.active_socket, MSG_DATA, payload, self.request_id)
+            if self.checksum is not None:
+                self.checksum.update(chunk)
+        self.raw_bytes += len(chunk)
+
+    def close(self):
+        if self.buffer or not self.started:
+            self.send_chunk(bytes(self.buffer))
+            self.buffer.clear()
+        send_frame(self.active_socket, MSG_END, end_payload(self.checksum), self.request_id)
+
+
+class FrameReader:
+    """
+    Readable file-like object over the MSG_DATA frames of one transfer, e.g. to unpack a tar archive while it
+    arrives. The MSG_TRANSFER frame must already have been read by the caller. read() returns b'' at the MSG_END
+    frame; a reader that stops early must call drain() to leave the socket at the next message. With a hash object,
+    the data is checked against the checksum in the MSG_END frame, and the read() or drain() that reaches it raises
+    IntegrityError on a mismatch and sets corrupted.
+    """
+
+    def __init__(self, active_socket, request_id, decompressor=None, checksum=None):
+        self.active_socket = active_socket
+        self.request_id = request_id
+        self.decompressor = decompressor
+        self.checksum = checksum
+        self.corrupted = False
+        self.pending = b""
+        self.finished = False
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def read(self, size=-1):
+        while not self.pending and not self.finished:
+            msg_type, frame_request_id, payload = receive_frame(self.active_socket)
+            if frame_request_id != self.request_id:
+                raise ProtocolError(f"Expected a frame for request {self.request_id}, got {frame_request_id}")
+            if msg_type == MSG_END:
+                self.finished = True
+                try:
+                    verify_end(payload, self.checksum)
+                except IntegrityError:
+                    self.corrupted = True
+                    raise
+            elif msg_type == MSG_DATA:
+                self.wire_bytes += len(payload)
+                self.pending = self.decompressor.process(payload) if self.decompressor is not None else payload
+                self.raw_bytes += len(self.pending)
+                if self.checksum is not None:
+                    self.checksum.update(self.pending)
+            else:
+                raise ProtocolError(f"Unexpected message type {msg_type} during a file transfer")
+        if size is None or size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+
+def split_recursive(options, argument):
+    """
+    Reads the recursive flag of cp, ul and dl, given as --recursive or, like in a shell, as a leading -r.
+    :return: tuple of (True if recursive, the argument without the -r)
+    """
+    if argument == "-r" or argument.startswith("-r "):
+        return True, argument[3:]
+    return "recursive" in options, argument
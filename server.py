@@ -1,57 +1,694 @@
+import argparse
+import fnmatch
+import queue
+import selectors
+import shlex
+import signal
 import socket
+import sys
 import random
 import string
 import time
-from threading import Thread
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread, current_thread, main_thread
 import os
 import shutil
+import stat
 import pathlib
-from pathlib import Path
+
+import dedup
+import delta
+import metrics
+import protocol
+import shaping
+import tree
+from protocol import MSG_COMMAND, MSG_LISTING, MSG_TEXT, MSG_TRANSFER, MSG_END, STATUS_OK, STATUS_ERROR, STATUS_INVALID
+
+ENGINES = ("thread", "select")
+
+# commands of one session a selector engine worker handles in a row when the client pipelines them,
+# before the session goes back to the loop so other sessions get a turn
+PIPELINE_BATCH = 32
+
+# seconds a selector engine worker waits on a client that stopped sending or reading in the middle of a command
+SESSION_IO_TIMEOUT = 60
+
+# entries shown by the directory info sent after each command, the rest is summarised in one line
+LISTING_LIMIT = 1000
+
+# "always": the directory info is sent after every command, "never": only the status, unless the client asks with ls
+LISTING_MODES = ("always", "never")
+
+# entries per MSG_TEXT frame of an 'mget --list' manifest
+MANIFEST_LINES = 1000
+
+SUPPORTED_COMMANDS = ("cd, pwd, mkdir, rm, ul, dl, mput, mget, sync, info, du, find, cp, mv, ls, stats, limits, have, "
+                      "exit")
+
+# bytes of file content the hot file cache holds, and the largest file it takes
+FILE_CACHE_SIZE = 256 * 1024 * 1024
+FILE_CACHE_MAX_FILE = 32 * 1024 * 1024
+
+# directory the sessions see as '/', unless --root names another one
+ROOT_DIRECTORY = str(pathlib.Path(__file__).parent.resolve())
+
+# directory of the dedup store, below the directory the server serves and hidden from the sessions
+STORE_DIRECTORY = ".store"
+
+# seconds a stopping server lets the commands in progress finish before it disconnects the remaining sessions
+SHUTDOWN_GRACE = 30
+
+# seconds the supervisor of --processes waits for stopping workers beyond SHUTDOWN_GRACE before it kills them
+KILL_GRACE = 5
+
+# seconds before a worker process that exited is restarted, doubled for every worker that exits again soon after
+# being started, up to MAX_RESTART_DELAY
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30
+
+# exit status of a worker process that could not listen on the port; it is not restarted if it was one of the
+# workers started first, a replacement may have started before its predecessor released the port and is retried
+WORKER_STARTUP_FAILED = 3
+
+# commands counted in the in-flight transfers gauge, they are also the ones the rate limits and the transfer cap
+# apply to
+TRANSFER_COMMANDS = ("ul", "dl", "mput", "mget", "sync")
+
+logger = metrics.logger
+
+
+class CommandError(Exception):
+    """
+    Raised by the handle_* methods when a command fails. The message is sent to the client in the status frame.
+    """
+
+    def __init__(self, message, code=STATUS_ERROR):
+        super().__init__(message)
+        self.code = code
+
+
+class ShutdownRequested(Exception):
+    """
+    Raised in the main thread by the SIGTERM (and SIGINT) handler of a running server, see Server.serve().
+    """
+
+
+class Namespace:
+    """
+    The directory tree one session sees: the server's root directory and the session's working directory in it.
+    Clients name files with '/' separated paths, relative to the working directory or, starting with a '/', to the
+    root; pwd and the directory info show the working directory the same way. Every name is resolved to a path on
+    the server here, for each command, so a cd only changes the session's own state and never the process' working
+    directory that all sessions share. A name that leads out of the root, with '..' or through a symbolic link, is
+    refused, and so is one in a hidden directory of the server's own, e.g. the dedup store.
+    """
+
+    def __init__(self, root, hidden=()):
+        self.root = os.path.realpath(root)
+        self.cwd = "/"
+        # absolute paths of the entries of the root the clients must neither see nor touch
+        self.hidden = frozenset(os.path.join(self.root, name) for name in hidden)
+
+    def virtual_path(self, name):
+        """
+        :param name: a path as the client gives it, '' for the working directory
+        :return: the normalized '/' separated path of name below the root, e.g. '/data/2024'
+        :raises CommandError: if '..' leads above the root
+        """
+
+        parts = [] if name.startswith("/") else [part for part in self.cwd.split("/") if part]
+        for part in name.split("/"):
+            if part == "..":
+                if not parts:
+                    raise CommandError(f"'{name}' is outside of the served directory", STATUS_INVALID)
+                parts.pop()
+            elif part not in ("", "."):
+                parts.append(part)
+        return "/" + "/".join(parts)
+
+    def resolve(self, name, follow_symlinks=True):
+        """
+        :param name: a path as the client gives it, '' for the working directory
+        :param follow_symlinks: False for the commands that act on a link itself, e.g. rm, only the directory it is
+            in has to stay below the root
+        :return: the absolute path of name on the server
+        :raises CommandError: if the path, or a symbolic link in it, leads out of the root or into a hidden directory
+        """
+
+        path = os.path.join(self.root, *[part for part in self.virtual_path(name).split("/") if part])
+        real_path = os.path.realpath(path if follow_symlinks or path == self.root else os.path.dirname(path))
+        if os.path.commonpath([self.root, real_path]) != self.root:
+            raise CommandError(f"'{name}' is outside of the served directory", STATUS_INVALID)
+        if self.is_hidden(path) or self.is_hidden(real_path):
+            raise CommandError(f"'{name}' is reserved by the server", STATUS_INVALID)
+        return path
+
+    def is_hidden(self, path):
+        """
+        :param path: an absolute path on the server
+        :return: True if path is a hidden directory or below one
+        """
+        return any(path == hidden or path.startswith(hidden + os.sep) for hidden in self.hidden)
+
+    @property
+    def directory(self):
+        """
+        The absolute path of the working directory on the server.
+        """
+        return self.resolve("")
+
+
+class DirectoryListingCache:
+    """
+    Names of the sub directories and files of recently listed directories. Each listing is stored with the inode,
+    device and mtime the directory had when it was read, so a lookup costs a single stat() while the directory is
+    unchanged and one os.scandir() pass when it changed. The server's own handlers also invalidate the directories
+    they modify, because two changes within the filesystem's timestamp granularity leave the mtime unchanged.
+    """
+
+    def __init__(self, max_directories=1024):
+        self.lock = Lock()
+        # directory path -> ((st_ino, st_dev, st_mtime_ns), sorted dir names, sorted file names), least recent first
+        self.entries = OrderedDict()
+        self.max_directories = max_directories
+
+    def get(self, directory):
+        """
+        :param directory: path to the directory
+        :return: tuple of (sorted sub directory names, sorted file names)
+        """
+
+        directory = os.path.abspath(directory)
+        stat_result = os.stat(directory)
+        stamp = (stat_result.st_ino, stat_result.st_dev, stat_result.st_mtime_ns)
+
+        with self.lock:
+            entry = self.entries.get(directory)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(directory)
+                return entry[1], entry[2]
+
+        dirs = []
+        files = []
+        with os.scandir(directory) as scan:
+            for item in scan:
+                # DirEntry caches the type from the directory read, no stat() per entry on most filesystems
+                if item.is_dir():
+                    dirs.append(item.name)
+                elif item.is_file():
+                    files.append(item.name)
+        dirs.sort()
+        files.sort()
+
+        with self.lock:
+            self.entries[directory] = (stamp, dirs, files)
+            self.entries.move_to_end(directory)
+            while len(self.entries) > self.max_directories:
+                self.entries.popitem(last=False)
+        return dirs, files
+
+    def invalidate(self, directory, recursive=False):
+        """
+        Drops the cached listing of a directory.
+        :param directory: path to the directory
+        :param recursive: also drop the listings of everything below it, e.g. after it was removed or moved
+        """
+
+        directory = os.path.abspath(directory)
+        prefix = os.path.join(directory, "")
+        with self.lock:
+            self.entries.pop(directory, None)
+            if recursive:
+                for path in [path for path in self.entries if path.startswith(prefix)]:
+                    del self.entries[path]
+
+
+class SignatureCache:
+    """
+    Block signatures (see delta.py) of recently synced files, so syncing an unchanged server file again costs a
+    stat() instead of reading and hashing all of it. Like DirectoryListingCache, each signature is stored with the
+    inode, device, mtime and size the file had when it was read, and the handlers that modify files invalidate it.
+    """
+
+    def __init__(self, max_files=256):
+        self.lock = Lock()
+        # file path -> ((st_ino, st_dev, st_mtime_ns, st_size), block size, signature), least recent first
+        self.entries = OrderedDict()
+        self.max_files = max_files
+
+    def get(self, file_path):
+        """
+        :param file_path: path to a regular file
+        :return: tuple of (block size, size of the file, signature)
+        :raises OSError: if the file cannot be read
+        """
+
+        file_path = os.path.abspath(file_path)
+        with open(file_path, 'rb') as file:
+            stat_result = os.fstat(file.fileno())
+            stamp = (stat_result.st_ino, stat_result.st_dev, stat_result.st_mtime_ns, stat_result.st_size)
+
+            with self.lock:
+                entry = self.entries.get(file_path)
+                if entry is not None and entry[0] == stamp:
+                    self.entries.move_to_end(file_path)
+                    return entry[1], stat_result.st_size, entry[2]
+
+            block_size = delta.choose_block_size(stat_result.st_size)
+            signature = delta.file_signature(file, block_size)
+
+        with self.lock:
+            self.entries[file_path] = (stamp, block_size, signature)
+            self.entries.move_to_end(file_path)
+            while len(self.entries) > self.max_files:
+                self.entries.popitem(last=False)
+        return block_size, stat_result.st_size, signature
+
+    def invalidate(self, path, recursive=False):
+        """
+        Drops the cached signature of a file.
+        :param path: path to the file, or to a directory with recursive=True
+        :param recursive: also drop the signatures of every file below path, e.g. after a directory was removed
+        """
+
+        path = os.path.abspath(path)
+        prefix = os.path.join(path, "")
+        with self.lock:
+            self.entries.pop(path, None)
+            if recursive:
+                for file_path in [file_path for file_path in self.entries if file_path.startswith(prefix)]:
+                    del self.entries[file_path]
+
+
+class DigestCache:
+    """
+    Checksums (see protocol.new_checksum()) of whole files computed while they were sent or received, so a repeated
+    download can go out with sendfile() and still carry its checksum, and info can show it, without reading the file
+    again. Each checksum is stored with the inode, device, mtime and size of the file it belongs to, like the
+    signatures of SignatureCache, and the handlers that modify files invalidate it.
+    """
+
+    def __init__(self, max_files=4096):
+        self.lock = Lock()
+        # file path -> ((st_ino, st_dev, st_mtime_ns, st_size), hex checksum), least recent first
+        self.entries = OrderedDict()
+        self.max_files = max_files
+
+    @staticmethod
+    def stamp(stat_result):
+        return stat_result.st_ino, stat_result.st_dev, stat_result.st_mtime_ns, stat_result.st_size
+
+    def get(self, file_path, stamp):
+        """
+        :param file_path: path to a file
+        :param stamp: the stamp() of the file as the caller is about to read it
+        :return: the hex checksum of the file, None if it is not known for this version of it
+        """
+
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is None or entry[0] != stamp:
+                return None
+            self.entries.move_to_end(file_path)
+            return entry[1]
+
+    def add(self, file_path, stamp, digest):
+        """
+        :param stamp: the stamp() the file had before and after its content was hashed
+        :param digest: the hex checksum of the content
+        """
+
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            self.entries[file_path] = (stamp, digest)
+            self.entries.move_to_end(file_path)
+            while len(self.entries) > self.max_files:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path, recursive=False):
+        """
+        Drops the cached checksum of a file.
+        :param path: path to the file, or to a directory with recursive=True
+        :param recursive: also drop the checksums of every file below path, e.g. after a directory was removed
+        """
+
+        path = os.path.abspath(path)
+        prefix = os.path.join(path, "")
+        with self.lock:
+            self.entries.pop(path, None)
+            if recursive:
+                for file_path in [file_path for file_path in self.entries if file_path.startswith(prefix)]:
+                    del self.entries[file_path]
+
+
+class FileCache:
+    """
+    Contents of recently downloaded files, so a file that many clients fetch is read from disk once and then sent
+    from memory: the MSG_DATA payloads are slices of one shared buffer, no per request open(), read() or copy. Like
+    SignatureCache, each file is stored with the inode, device, mtime and size it had when it was read, checked with
+    one stat() per lookup, and the handlers that modify files invalidate it. The least recently used files are
+    evicted once the contents exceed max_bytes; larger files than max_file_size are never cached, and max_bytes 0
+    disables the cache. For each codec, an entry also remembers whether the file compresses and, if it does, the
+    compressed payloads of the whole file, which count towards max_bytes too.
+    The contents are read into memory rather than mapped: a mapped file truncated by another process would kill the
+    server with SIGBUS on the next access.
+    """
+
+    def __init__(self, max_bytes=FILE_CACHE_SIZE, max_file_size=FILE_CACHE_MAX_FILE, server_metrics=None):
+        self.lock = Lock()
+        # file path -> ((st_ino, st_dev, st_mtime_ns, st_size), content, dict of codec -> False if the content does
+        # not compress, else the list of its compressed payloads), least recent first
+        self.entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.max_file_size = min(max_file_size, max_bytes)
+        self.size = 0
+        # hits, misses and evictions are counted in the server's metrics.ServerMetrics
+        self.metrics = server_metrics
+
+    def get(self, file_path):
+        """
+        :param file_path: path to a file
+        :return: tuple of (content, dict of codec -> compressed payloads or False, see add_payloads()), None if the
+            file cannot be read or is too large to be cached
+        """
+
+        if not self.max_bytes:
+            return None
+        file_path = os.path.abspath(file_path)
+        try:
+            stat_result = os.stat(file_path)
+        except OSError:
+            return None
+        stamp = (stat_result.st_ino, stat_result.st_dev, stat_result.st_mtime_ns, stat_result.st_size)
+
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(file_path)
+                self.record(hit=True)
+                return entry[1], entry[2]
+            self.record(hit=False)
+        if stat_result.st_size > self.max_file_size or not stat.S_ISREG(stat_result.st_mode):
+            return None
+
+        try:
+            with open(file_path, 'rb') as file:
+                content = file.read(self.max_file_size + 1)
+                stat_result = os.fstat(file.fileno())
+        except OSError:
+            return None
+        stamp = (stat_result.st_ino, stat_result.st_dev, stat_result.st_mtime_ns, stat_result.st_size)
+        if len(content) != stat_result.st_size:
+            # changed while it was read
+            return None
+
+        compressed = {}
+        with self.lock:
+            self.discard(file_path)
+            self.entries[file_path] = (stamp, content, compressed)
+            self.size += len(content)
+            self.evict()
+        return content, compressed
+
+    def add_payloads(self, file_path, content, codec, payloads):
+        """
+        Remembers how a cached file compresses with a codec, if it is still cached with that content.
+        :param content: the content returned by get()
+        :param payloads: the compressed payloads of the whole file, False if it does not compress
+        """
+
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is None or entry[1] is not content or codec in entry[2]:
+                return
+            entry[2][codec] = payloads
+            if payloads:
+                self.size += sum(len(payload) for payload in payloads)
+                self.evict()
+
+    def content_stamp(self, file_path, content):
+        """
+        :param content: the content returned by get()
+        :return: the (st_ino, st_dev, st_mtime_ns, st_size) of the file the content was read from, None if the file
+            is no longer cached with that content
+        """
+
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            return entry[0] if entry is not None and entry[1] is content else None
+
+    def discard(self, file_path):
+        # called with self.lock held
+        entry = self.entries.pop(file_path, None)
+        if entry is not None:
+            self.size -= len(entry[1]) + sum(sum(len(payload) for payload in payloads)
+                                             for payloads in entry[2].values() if payloads)
+
+    def evict(self):
+        # called with self.lock held
+        evicted = 0
+        while self.size > self.max_bytes:
+            self.discard(next(iter(self.entries)))
+            evicted += 1
+        self.record(evicted=evicted)
+
+    def record(self, hit=None, evicted=0):
+        # called with self.lock held
+        if self.metrics is not None:
+            self.metrics.observe_file_cache(hit, evicted, len(self.entries), self.size)
+
+    def invalidate(self, path, recursive=False):
+        """
+        Drops the cached content of a file.
+        :param path: path to the file, or to a directory with recursive=True
+        :param recursive: also drop every file below path, e.g. after a directory was removed
+        """
+
+        path = os.path.abspath(path)
+        prefix = os.path.join(path, "")
+        with self.lock:
+            paths = [path] if path in self.entries else []
+            if recursive:
+                paths += [file_path for file_path in self.entries if file_path.startswith(prefix)]
+            for file_path in paths:
+                self.discard(file_path)
+            if paths:
+                self.record()
+
 
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, use_sendfile=True, engine="thread", max_connections=1000, workers=32,
+                 listing_limit=LISTING_LIMIT, compression=None, chunk_size=None, metrics_port=None,
+                 tree_workers=tree.WORKERS, dedup_store=False, file_cache_size=FILE_CACHE_SIZE, reuse_port=False,
+                 root=ROOT_DIRECTORY, rate_limit=0, session_rate_limit=0, max_transfers=0, checksums=True):
         self.host = host
         self.port = port
         self.server_socket = None
+        # several processes listen on the port, see Supervisor
+        self.reuse_port = reuse_port
+        self.use_sendfile = use_sendfile
+        self.transfer_stats = protocol.TransferStats()
+        # "thread": one ClientThread per connection, "select": SelectorEngine with a pool of workers
+        self.engine = engine
+        self.max_connections = max_connections
+        self.workers = workers
+        self.connection_slots = None
+        self.listing_cache = DirectoryListingCache()
+        self.signature_cache = SignatureCache()
+        # checksums of whole files, sent at the end of transfers if the session negotiated them
+        self.digest_cache = DigestCache()
+        # whether clients may ask for checksummed transfers in the handshake
+        self.checksums = checksums
+        self.listing_limit = listing_limit
+        # codecs clients may choose in the handshake, all registered ones by default, () disables compression
+        self.compression = tuple(protocol.CODECS) if compression is None else tuple(compression)
+        # payload size of the MSG_DATA frames of downloads, None for the protocol defaults
+        self.chunk_size = chunk_size
+        self.metrics = metrics.ServerMetrics()
+        # contents of hot files for dl and mget, file_cache_size 0 disables it
+        self.file_cache = FileCache(file_cache_size, server_metrics=self.metrics)
+        # directory scans and file copies of du, find, cp -r and dl -r, shared by all sessions
+        self.tree_executor = ThreadPoolExecutor(max_workers=tree_workers, thread_name_prefix="tree-worker")
+        # port of the Prometheus text endpoint on localhost, None to disable it, and its HTTP server once listening
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        # the directory tree the clients see, every session gets its own Namespace in it
+        self.root = os.path.realpath(root)
+        # content-addressed store the uploads are linked to (see dedup.py), None to store every upload as it is
+        self.store = dedup.ChunkStore(os.path.join(self.root, STORE_DIRECTORY)) if dedup_store else None
+        # entries of the root the sessions can neither see nor change (see Namespace)
+        self.hidden = (STORE_DIRECTORY,) if dedup_store else ()
+        # bandwidth of the transfers, all together and per session, and how many run at once; 0 for no limit
+        self.limits = shaping.Limits(rate_limit, session_rate_limit, max_transfers)
+        # open sessions, so that shutdown() can wait for their commands and disconnect them
+        self.sessions = set()
+        self.sessions_lock = Lock()
 
     def start(self):
-        # Create a socket
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen()
+        self.serve()
+
+    def listen(self, listening_socket=None):
+        """
+        Binds the listening socket, or takes over one bound by the parent process.
+        :raises OSError: if the port cannot be bound
+        """
+
+        if listening_socket is not None:
+            self.server_socket = listening_socket
+        else:
+            self.server_socket = create_listening_socket(self.host, self.port, self.reuse_port)
+        logger.info("Server listening on %s:%s (%s engine)", self.host, self.port, self.engine)
+        if self.metrics_port is not None:
+            self.metrics_server = metrics.serve_prometheus(self.metrics, self.metrics_port, self.transfer_stats)
+
+    def serve(self, shutdown_signals=(signal.SIGTERM, signal.SIGINT)):
+        """
+        Serves connections until one of shutdown_signals arrives, then stops gracefully (see shutdown()). The
+        signals are only handled when the server runs in the main thread.
+        """
+
+        def request_shutdown(signum, frame):
+            raise ShutdownRequested(signal.Signals(signum).name)
+
+        if current_thread() is main_thread():
+            for signum in shutdown_signals:
+                signal.signal(signum, request_shutdown)
+        try:
+            if self.engine == "select":
+                SelectorEngine(self).run()
+            else:
+                self.serve_threads()
+        except ShutdownRequested as e:
+            logger.info("Received %s", e)
+            self.shutdown()
+
+    def shutdown(self, grace=SHUTDOWN_GRACE):
+        """
+        Stops accepting connections, lets the commands in progress finish for up to grace seconds and then
+        disconnects all sessions, the idle ones right away.
+        The listening socket and the metrics endpoint are closed first, so that a replacement worker process (see
+        Supervisor.reload()) can bind the ports while this server drains its sessions.
+        """
+
+        self.server_socket.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        deadline = time.monotonic() + grace
+        with self.sessions_lock:
+            logger.info("Shutting down, %s sessions open", len(self.sessions))
+        while True:
+            with self.sessions_lock:
+                busy = [session for session in self.sessions if session.busy]
+                idle = [session for session in self.sessions if not session.busy]
+            if time.monotonic() >= deadline:
+                idle += busy
+                busy = []
+            # the session ends when its thread or worker sees the connection shut down
+            for session in idle:
+                try:
+                    session.service_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            if not busy:
+                break
+            time.sleep(0.1)
+        self.tree_executor.shutdown(wait=False, cancel_futures=True)
+        logger.info("Server stopped")
 
-        # Bind the socket to the specified address and port
-        self.server_socket.bind((self.host, self.port))
-        # Listen for incoming connections
-        self.server_socket.listen()
-        # print(f"Server listening on {self.host}:{self.port}")
-        print(f"Server listening on {self.host}:{self.port}")
 
-        # while True:
+    def serve_threads(self):
+        """
+        Thread engine: accepts connections and handles each one in its own ClientThread. At most max_connections
+        threads run at once, further connections wait in the listen backlog until a thread finishes.
+        """
+
+        self.connection_slots = BoundedSemaphore(self.max_connections)
+
         while True:
+            self.connection_slots.acquire()
             # Accept incoming connections
-            client_socket, client_address = self.server_socket.accept()
-            # print(f"Accepted connection from {client_address}")
-            print(f"Accepted connection from {client_address}")
-            # send random eof token
-            eof = self.generate_random_eof_token()
-            client_socket.sendall(eof.encode())
+            try:
+                client_socket, client_address, eof = self.accept_connection()
+            except OSError as e:
+                self.connection_slots.release()
+                if self.server_socket.fileno() == -1:
+                    # closed by shutdown()
+                    return
+                logger.error("Error accepting a connection: %s", e)
+                continue
             # Handle the client requests using ClientThread
             client_thread = ClientThread(self, client_socket, client_address, eof)
             client_thread.start()
 
 
-    def get_working_directory_info(self, working_directory):
+    def accept_connection(self):
+        """
+        Accepts one connection and sends the random eof token, the first step of the handshake.
+        :return: the service socket, the client address and the eof token
         """
-        Creates a string representation of a working directory and its contents.
-        :param working_directory: path to the directory
+
+        client_socket, client_address = self.server_socket.accept()
+        logger.info("Accepted connection from %s", client_address)
+        try:
+            client_socket.setblocking(True)
+            protocol.configure_socket(client_socket)
+            # send random eof token
+            eof = self.generate_random_eof_token()
+            client_socket.sendall(eof.encode())
+        except OSError:
+            # e.g. the client reset the connection before the token went out
+            client_socket.close()
+            raise
+        return client_socket, client_address, eof
+
+
+    def get_working_directory_info(self, namespace, offset=0, limit=None, pattern=None):
+        """
+        Creates a string representation of a session's working directory and its contents. Sub directories come
+        first, then files, each sorted by name. Only `limit` entries starting at `offset` are shown, the number of
+        entries left out is given on the last line.
+        :param namespace: the session's Namespace
+        :param offset: number of entries to skip
+        :param limit: maximum number of entries to show, defaults to self.listing_limit (None: all entries)
+        :param pattern: only show entries whose name matches this shell-style pattern, e.g. '*.txt'
         :return: string of the directory and its contents.
         """
-        dirs = "\n-- " + "\n-- ".join(
-            [i.name for i in Path(working_directory).iterdir() if i.is_dir()]
-        )
-        files = "\n-- " + "\n-- ".join(
-            [i.name for i in Path(working_directory).iterdir() if i.is_file()]
-        )
+        working_directory = namespace.cwd
+        try:
+            directory = namespace.directory
+            all_dirs, all_files = self.listing_cache.get(directory)
+        except CommandError as e:
+            return f"Current Directory: {working_directory}: cannot be listed ({e})"
+        except OSError as e:
+            return f"Current Directory: {working_directory}: cannot be listed ({e.strerror})"
+        if directory == namespace.root and namespace.hidden:
+            all_dirs = [name for name in all_dirs if not namespace.is_hidden(os.path.join(directory, name))]
+
+        if pattern:
+            all_dirs = fnmatch.filter(all_dirs, pattern)
+            all_files = fnmatch.filter(all_files, pattern)
+
+        if limit is None:
+            limit = self.listing_limit
+        if limit is None:
+            limit = len(all_dirs) + len(all_files)
+        shown_dirs = all_dirs[offset:offset + limit]
+        shown_files = all_files[max(0, offset - len(all_dirs)):][:limit - len(shown_dirs)]
+
+        dirs = "\n-- " + "\n-- ".join(shown_dirs)
+        files = "\n-- " + "\n-- ".join(shown_files)
         dir_info = f"Current Directory: {working_directory}:\n|{dirs}{files}"
+
+        total = len(all_dirs) + len(all_files)
+        hidden = total - len(shown_dirs) - len(shown_files)
+        if hidden:
+            dir_info += f"\n... {hidden} of {total} entries not shown"
         return dir_info
 
 
@@ -72,6 +709,7 @@ class Server:
         Same implementation as in receive_message_ending_with_token() in client.py
         A helper method to receives a bytearray message of arbitrary size sent on the socket.
         This method returns the message WITHOUT the eof_token at the end of the last packet.
+        It is only used for the handshake, every message after it is a frame (see protocol.py).
         :param active_socket: a socket object that is connected to the server
         :param buffer_size: the buffer size of each recv() call
         :param eof_token: a token that denotes the end of the message.
@@ -79,234 +717,1712 @@ class Server:
         """
 
         file_content = bytearray()
+        token = eof_token.encode()
 
         while True:
-            packet = active_socket.recv(buffer_size)
-            if packet[-10:] == eof_token.encode():
-                file_content += packet[:-10]
-                break
-            file_content += packet
+            # peek first, frames may follow the message and must stay in the socket
+            packet = active_socket.recv(buffer_size, socket.MSG_PEEK)
+            if not packet:
+                raise ConnectionError("Connection closed during the handshake")
+
+            # the token may start in the bytes consumed by an earlier packet
+            index = (file_content[-len(token):] + packet).find(token)
+            if index >= 0:
+                end = index + len(token) - min(len(file_content), len(token))
+                packet = bytearray(end)
+                protocol.receive_into(active_socket, packet)
+                file_content += packet
+                return file_content[:-len(token)]
 
-        return file_content
+            file_content += active_socket.recv(len(packet))
 
 
-    def handle_cd(self, current_working_directory, new_working_directory):
+    def negotiate_protocol(self, service_socket, eof_token):
         """
-        Handles the client cd commands. Reads the client command and changes the current_working_directory variable
-        accordingly. Returns the absolute path of the new current working directory.
-        :param current_working_directory: string of current working directory
-        :param new_working_directory: name of the sub directory or '..' for parent
-        :return: absolute path of new current working directory
+        Second half of the handshake. The client answers the eof token with
+        'hello versions=<v1,v2,...> [listing=always|never] [compression=<codec1,codec2,...>] [checksum=<name>]' and
+        the server replies with 'welcome version=<v> listing=<mode> compression=<codec|none>', choosing the highest
+        version both sides support. From then on every message is a frame of that version. The listing mode is the
+        session default for whether the directory info is sent after each command, it defaults to 'always'. The codec
+        is the first one in the client's list that the server allows, downloads of the session are compressed with it
+        (see protocol.StreamCompressor). If the client offers protocol.CHECKSUM and the server allows checksums, the
+        welcome repeats 'checksum=<name>' and the transfers of the session carry checksums in both directions. A
+        server with a dedup store adds 'dedup=<chunk size>', telling clients they may upload with 'have' and
+        'ul --dedup' (see dedup.py).
+        :param service_socket: active service socket with the client
+        :param eof_token: the token sent to the client in start()
+        :return: dict with the negotiated 'version', 'listing' mode, 'compression' codec (None if there is none) and
+            'checksum' (True if transfers are checksummed), or None if there is no version in common.
         """
 
-        try:
-            os.chdir(os.path.join(current_working_directory, new_working_directory))
-        except os.error:
-            print("Error in path! Server can't find this directory: ", new_working_directory)
-        print("*****************************getced",os.getcwd())
-        return os.getcwd()
+        hello = self.receive_message_ending_with_token(service_socket, 1024, eof_token).decode()
+        options = protocol.decode_options(hello)
+        client_versions = {int(v) for v in options.get("versions", "").split(",") if v.isdigit()}
+        common = client_versions.intersection(protocol.SUPPORTED_VERSIONS)
 
+        if not hello.startswith("hello ") or not common:
+            supported = ",".join(str(v) for v in protocol.SUPPORTED_VERSIONS)
+            service_socket.sendall(f"unsupported versions={supported}{eof_token}".encode())
+            return None
 
-    def handle_mkdir(self, current_working_directory, directory_name):
+        version = max(common)
+        listing = options.get("listing", "always")
+        if listing not in LISTING_MODES:
+            listing = "always"
+        codecs = [codec for codec in options.get("compression", "").split(",") if codec in self.compression]
+        compression = codecs[0] if codecs else None
+        checksum = self.checksums and options.get("checksum") == protocol.CHECKSUM
+        welcome = f"welcome version={version} listing={listing} compression={compression or 'none'}"
+        if checksum:
+            welcome += f" checksum={protocol.CHECKSUM}"
+        if self.store is not None:
+            welcome += f" dedup={self.store.chunk_size}"
+        service_socket.sendall(f"{welcome}{eof_token}".encode())
+        return {"version": version, "listing": listing, "compression": compression, "checksum": checksum}
+
+
+    def handle_cd(self, namespace, new_working_directory):
+        """
+        Handles the client cd commands. Changes the working directory of the session's namespace, the process'
+        working directory stays as it is.
+        :param namespace: the session's Namespace
+        :param new_working_directory: name of the sub directory, '..' for the parent or a path starting at the root
+        :return: the new working directory, as shown to the client
+        """
+
+        path = namespace.resolve(new_working_directory)
+        if not os.path.isdir(path) or not os.access(path, os.X_OK):
+            raise CommandError(f"Server can't find this directory: {new_working_directory}")
+        namespace.cwd = namespace.virtual_path(new_working_directory)
+        logger.debug("cd: working directory is now %s", namespace.cwd)
+        return namespace.cwd
+
+
+    def handle_mkdir(self, namespace, directory_name):
         """
         Handles the client mkdir commands. Creates a new sub directory with the given name in the current working directory.
-        :param current_working_directory: string of current working directory
+        :param namespace: the session's Namespace
         :param directory_name: name of new sub directory
         """
 
+        path = namespace.resolve(directory_name)
         try:
-            os.mkdir(os.path.join(current_working_directory, directory_name))
-            print("Directory created!!!!!!!")
-        except os.error:
-            print("Server facing error in creating new directory!")
-            return os.getcwd()
+            os.mkdir(path)
+            self.listing_cache.invalidate(os.path.dirname(path))
+            logger.debug("mkdir: created '%s' in %s", directory_name, namespace.cwd)
+        except os.error as e:
+            raise CommandError(f"Cannot create directory '{directory_name}': {e.strerror}")
 
 
-    def handle_rm(self, current_working_directory, object_name):
+    def handle_rm(self, namespace, object_name):
         """
         Handles the client rm commands. Removes the given file or sub directory. Uses the appropriate removal method
         based on the object type (directory/file).
-        :param current_working_directory: string of current working directory
+        :param namespace: the session's Namespace
         :param object_name: name of sub directory or file to remove
         """
 
-        file_path = os.path.join(current_working_directory, object_name)
+        file_path = namespace.resolve(object_name, follow_symlinks=False)
+        if file_path == namespace.root:
+            raise CommandError("The root directory cannot be removed", STATUS_INVALID)
 
         # check if file or directory exists
         if os.path.isfile(file_path) or os.path.islink(file_path):
             # remove file
             os.remove(file_path)
+            self.listing_cache.invalidate(os.path.dirname(file_path))
+            self.signature_cache.invalidate(file_path)
+            self.file_cache.invalidate(file_path)
+            self.digest_cache.invalidate(file_path)
 
         elif os.path.isdir(file_path):
             # remove directory and all its content
             shutil.rmtree(file_path, ignore_errors=True)
+            self.listing_cache.invalidate(os.path.dirname(file_path))
+            self.listing_cache.invalidate(file_path, recursive=True)
+            self.signature_cache.invalidate(file_path, recursive=True)
+            self.file_cache.invalidate(file_path, recursive=True)
+            self.digest_cache.invalidate(file_path, recursive=True)
 
         else:
-            print("Server facing error while deleting file: ", object_name)
-            return os.getcwd()
+            raise CommandError(f"'{object_name}' does not exist")
+
+
+    def parse_range(self, options):
+        """
+        Reads the --offset=N and --length=N options of ranged ul/dl commands.
+        :return: tuple of (offset, length or None for the rest of the file)
+        """
+
+        try:
+            offset = int(options.get("offset", 0))
+            length = int(options["length"]) if "length" in options else None
+        except ValueError:
+            raise CommandError("--offset and --length must be numbers", STATUS_INVALID)
+        if offset < 0 or (length is not None and length < 0):
+            raise CommandError("--offset and --length must not be negative", STATUS_INVALID)
+        return offset, length
+
+    def store_file(self, part_path, file_path):
+        """
+        Puts a completely received file in place: renames it, or links it to the dedup store if there is one.
+        :param part_path: where the file was staged
+        :param file_path: its real name
+        """
+
+        if self.store is None:
+            os.replace(part_path, file_path)
+        else:
+            self.store.ingest(part_path, file_path)
+
+    def handle_have(self, argument, service_socket, request_id):
+        """
+        Handles the 'have <digest> ...' commands clients send before a deduplicated upload. The reply is one MSG_TEXT
+        frame with a '1' for each chunk digest the store has and a '0' for each it does not, in the same order.
+        :param argument: the space separated hex digests of the chunks, at most dedup.HAVE_BATCH
+        :param service_socket: active service socket with the client
+        :param request_id: id of the have request, used to tag the reply frames.
+        """
 
+        if self.store is None:
+            raise CommandError("This server does not deduplicate uploads", STATUS_INVALID)
+        digests = argument.split()
+        if len(digests) > dedup.HAVE_BATCH:
+            raise CommandError(f"At most {dedup.HAVE_BATCH} digests per have command", STATUS_INVALID)
+        known = self.store.known(digests)
+        protocol.send_frame(service_socket, MSG_TEXT, "".join("1" if digest in known else "0" for digest in digests)
+                            .encode(), request_id)
 
-    def handle_ul(self, current_working_directory, file_name, service_socket, eof_token):
+    def handle_ul_chunks(self, namespace, file_name, service_socket, request_id, checksum=False):
+        """
+        Handles 'ul --dedup <file>': the file arrives as chunks (see dedup.send_chunks()), those the store has only
+        as their digests. It is staged like any upload and then linked to its object in the store.
+        :param namespace: the session's Namespace
+        :param file_name: name of the file to be created.
+        :param service_socket: active socket with the client to read the chunks from.
+        :param request_id: id of the ul request, used to tag the reply frames.
+        :param checksum: True if the session negotiated checksummed transfers
+        """
+
+        msg_type, _, payload = protocol.receive_frame(service_socket)
+        if msg_type != MSG_TRANSFER:
+            raise protocol.ProtocolError(f"Expected a file transfer for ul, got message type {msg_type}")
+
+        try:
+            file_path = namespace.resolve(file_name)
+            part_path = protocol.partial_path(file_path)
+            if self.store is None:
+                raise CommandError("This server does not deduplicate uploads", STATUS_INVALID)
+            metadata = protocol.decode_options(payload)
+            if int(metadata.get("chunk_size", 0)) != self.store.chunk_size:
+                raise CommandError(f"Chunks of deduplicated uploads must be {self.store.chunk_size} bytes",
+                                   STATUS_INVALID)
+            decompressor = protocol.decompressor_for(metadata)
+            file = open(part_path, 'wb+')
+        except (CommandError, OSError, ValueError, protocol.ProtocolError) as e:
+            dedup.receive_chunks(service_socket, request_id, None, None)
+            if isinstance(e, OSError):
+                raise CommandError(f"Cannot create '{file_name}': {e.strerror}")
+            if isinstance(e, ValueError):
+                raise CommandError(f"Invalid transfer metadata for '{file_name}'", STATUS_INVALID)
+            raise
+
+        try:
+            with file, self.store.reader() as reader:
+                chunks, digest, wire_bytes, reused, missing = dedup.receive_chunks(service_socket, request_id, file,
+                                                                                    reader, decompressor, checksum)
+                file.flush()
+                stamp = DigestCache.stamp(os.fstat(file.fileno()))
+        except protocol.IntegrityError as e:
+            os.remove(part_path)
+            logger.warning("ul: rejected '%s': %s", file_name, e)
+            raise CommandError(f"'{file_name}' was not stored: {e}")
+        self.metrics.add_bytes(received=wire_bytes, deduplicated=reused)
+        if missing:
+            os.remove(part_path)
+            raise CommandError(f"{missing} chunks of '{file_name}' are no longer stored, upload it again")
+        self.store.commit(part_path, file_path, digest, chunks)
+        self.listing_cache.invalidate(os.path.dirname(file_path))
+        self.signature_cache.invalidate(file_path)
+        self.file_cache.invalidate(file_path)
+        self.digest_cache.invalidate(file_path)
+        # the content digest of the store is the transfer checksum, if the file kept the staged inode it is known
+        self.digest_cache.add(file_path, stamp, digest)
+        logger.debug("ul: received '%s' as %s chunks, %s bytes on the wire, %s bytes from the store",
+                     file_name, len(chunks), wire_bytes, reused)
+
+    def handle_ul(self, namespace, file_name, options, service_socket, request_id, checksum=False):
         """
         Handles the client ul commands. First, it reads the payload, i.e. file content from the client, then creates the
         file in the current working directory.
-        Use the helper method: receive_message_ending_with_token() to receive the message from the client.
-        :param current_working_directory: string of current working directory
+        The data is staged in a hidden partial file (see protocol.partial_path()) and renamed to file_name once the
+        last byte arrived, so an interrupted upload never leaves a truncated file under the real name. The client
+        resumes with --offset=N, N being the partial size reported by 'info --partial', and the MSG_TRANSFER frame
+        carries the 'total' size of the file, which tells when it is complete.
+        With checksums, the data is hashed while it arrives; if it does not match the client's checksum, the bytes
+        received by this command are dropped again and the command fails. A complete upload's checksum is cached.
+        Use the helper method: protocol.receive_file_data() to receive the file frames from the client.
+        :param namespace: the session's Namespace
         :param file_name: name of the file to be created.
+        :param options: the command options, 'offset' is where the data goes in the file
         :param service_socket: active socket with the client to read the payload/contents from.
-        :param eof_token: a token to indicate the end of the message.
+        :param request_id: id of the ul request, used to tag the reply frames.
+        :param checksum: True if the session negotiated checksummed transfers
         """
 
-        print("*****************************getcwd ul",current_working_directory)
-        file_path = os.path.join(current_working_directory, file_name)
+        msg_type, _, payload = protocol.receive_frame(service_socket)
+        if msg_type != MSG_TRANSFER:
+            raise protocol.ProtocolError(f"Expected a file transfer for ul, got message type {msg_type}")
 
-        with open(file_path, 'wb') as file:
-            file_content = self.receive_message_ending_with_token(service_socket, 1024, eof_token)
-            file.write(file_content)
+        try:
+            file_path = namespace.resolve(file_name)
+            part_path = protocol.partial_path(file_path)
+            offset, _ = self.parse_range(options)
+            metadata = protocol.decode_options(payload)
+            size = int(metadata["size"]) if "size" in metadata else None
+            total = int(metadata.get("total", offset + (size or 0)))
+            decompressor = protocol.decompressor_for(metadata)
+            if offset:
+                staged = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                if offset > staged:
+                    raise CommandError(f"Cannot resume '{file_name}' at {offset}, only {staged} bytes were received",
+                                       STATUS_INVALID)
+                file = open(part_path, 'r+b')
+                file.seek(offset)
+            else:
+                file = open(part_path, 'wb')
+        except (CommandError, OSError, ValueError, protocol.ProtocolError) as e:
+            # the client is already sending, so the data still has to be read off the socket
+            protocol.receive_file_data(service_socket, None, request_id)
+            if isinstance(e, OSError):
+                raise CommandError(f"Cannot create '{file_name}': {e.strerror}")
+            if isinstance(e, ValueError):
+                raise CommandError(f"Invalid transfer metadata for '{file_name}'", STATUS_INVALID)
+            raise
 
-        print("File successfully uploaded!!!!")
+        hasher = protocol.new_checksum() if checksum else None
+        try:
+            with file:
+                received = protocol.receive_file_data(service_socket, file, request_id, decompressor=decompressor,
+                                                      checksum=hasher, size=size)
+                complete = offset + received >= total
+                if complete:
+                    # a restarted upload may be shorter than what was staged before
+                    file.truncate()
+                file.flush()
+                stamp = DigestCache.stamp(os.fstat(file.fileno()))
+        except protocol.IntegrityError as e:
+            # keep what earlier commands staged, so the upload can be resumed from there
+            if offset:
+                os.truncate(part_path, offset)
+            else:
+                os.remove(part_path)
+            logger.warning("ul: rejected '%s' at offset %s: %s", file_name, offset, e)
+            raise CommandError(f"'{file_name}' was not stored: {e}")
+        self.listing_cache.invalidate(os.path.dirname(file_path))
+        self.metrics.add_bytes(received=decompressor.wire_bytes if decompressor is not None else received)
+
+        if not complete:
+            missing = total - offset - received
+            protocol.send_frame(service_socket, MSG_TEXT,
+                                f"Received {received} bytes of '{file_name}' at offset {offset}, "
+                                f"{missing} bytes still missing".encode(), request_id)
+            return
+        self.store_file(part_path, file_path)
+        self.signature_cache.invalidate(file_path)
+        self.file_cache.invalidate(file_path)
+        self.digest_cache.invalidate(file_path)
+        if hasher is not None and not offset:
+            self.digest_cache.add(file_path, stamp, hasher.hexdigest())
+        logger.debug("ul: received '%s', %s bytes at offset %s", file_name, received, offset)
 
-    def handle_dl(self, current_working_directory, file_name, service_socket, eof_token):
+    def handle_dl(self, namespace, file_name, options, service_socket, request_id, codec=None, checksum=False):
         """
         Handles the client dl commands. First, it loads the given file as binary, then sends it to the client via the
-        given socket.
-        :param current_working_directory: string of current working directory
+        given socket. Regular files are sent with the zero-copy sendfile() path unless it is disabled, anything else
+        falls back to buffered reads. The throughput of both paths is recorded in self.transfer_stats.
+        With --offset=N and/or --length=N only that range is sent, and the MSG_TRANSFER frame carries its 'offset'
+        and the 'total' size of the file, so clients can resume a download or fetch ranges in parallel.
+        With checksums, the MSG_END frame carries the checksum of the data sent (of the range, for a ranged dl).
+        :param namespace: the session's Namespace
         :param file_name: name of the file to be sent to client
+        :param options: the command options, 'offset' and 'length' select a range
         :param service_socket: active service socket with the client
-        :param eof_token: a token to indicate the end of the message.
+        :param request_id: id of the dl request, used to tag the reply frames.
+        :param codec: the compression codec negotiated for the session, None to send the file as it is
+        :param checksum: True if the session negotiated checksummed transfers
+        """
+
+        file_path = namespace.resolve(file_name)
+        offset, length = self.parse_range(options)
+
+        cached = self.file_cache.get(file_path)
+        file = None
+        if cached is None:
+            try:
+                file = open(file_path, 'rb')
+            except OSError as e:
+                raise CommandError(f"Cannot read '{file_name}': {e.strerror}")
+
+        try:
+            metadata = None
+            if "offset" in options or "length" in options:
+                total = len(cached[0]) if file is None else os.fstat(file.fileno()).st_size
+                if offset > total:
+                    raise CommandError(f"Offset {offset} is beyond the end of '{file_name}' ({total} bytes)",
+                                       STATUS_INVALID)
+                metadata = {"offset": offset, "total": total}
+            if file is None:
+                sent, path, wire_bytes = self.send_cached(file_path, cached, service_socket, request_id, metadata,
+                                                          offset, length, codec, checksum)
+            else:
+                sent, path, wire_bytes = self.send_open_file(file_path, file, service_socket, request_id, metadata,
+                                                             offset, length, codec, checksum)
+        finally:
+            if file is not None:
+                file.close()
+
+        logger.debug("dl: sent %s bytes of '%s' (%s on the wire) via %s, average %s throughput: %.1f MB/s",
+                     sent, file_name, wire_bytes, path, path, self.transfer_stats.rate(path) / 1e6)
+
+    def send_cached(self, file_path, cached, service_socket, request_id, metadata=None, offset=0, length=None,
+                    codec=None, checksum=False):
+        """
+        Same as send_open_file() for a file of self.file_cache: the payloads are slices of the cached content. When
+        the whole file is sent, the compressed payloads are kept in the cache, so the next download with the same
+        codec is not compressed again, and so is its checksum. The throughput is recorded as the 'cache' path, or as
+        the codec.
+        :param file_path: path of the file
+        :param cached: tuple of (content, dict of codec -> compressed payloads) returned by FileCache.get()
         """
 
-        print("*****************************getcwd dl", current_working_directory)
-        file_path = os.path.join(current_working_directory, file_name)
+        content, compressed = cached
+        size = max(0, len(content) - offset)
+        if length is not None:
+            size = min(size, length)
+        view = memoryview(content)[offset:offset + size]
+        whole = size == len(content)
+        stamp = self.file_cache.content_stamp(file_path, content) if whole else None
+        digest = self.digest_cache.get(file_path, stamp) if checksum and stamp is not None else None
+        hasher = protocol.new_checksum() if checksum and digest is None else None
+        payloads = compressed.get(codec) if codec is not None and whole else None
+        compressor = None
+        if codec is not None and payloads is None and protocol.is_compressible(codec, view[:protocol.CHUNK_SIZE]):
+            compressor = protocol.StreamCompressor(codec)
+
+        started = time.perf_counter()
+        if payloads:
+            path = codec
+            if hasher is not None:
+                hasher.update(view)
+                digest = hasher.hexdigest()
+            wire_bytes = protocol.send_payloads(service_socket, payloads, codec, request_id, size, metadata, digest)
+            sent = size
+        elif compressor is not None:
+            path = codec
+            payloads = [] if whole else None
+            sent = protocol.send_buffer(service_socket, view, request_id, self.chunk_size or protocol.CHUNK_SIZE,
+                                        metadata, compressor, payloads, hasher, digest)
+            wire_bytes = compressor.wire_bytes
+            if whole:
+                self.file_cache.add_payloads(file_path, content, codec, compressor.enabled and payloads)
+        else:
+            if codec is not None and whole:
+                self.file_cache.add_payloads(file_path, content, codec, False)
+            path = "cache"
+            sent = protocol.send_buffer(service_socket, view, request_id,
+                                        self.chunk_size or protocol.SENDFILE_CHUNK_SIZE, metadata,
+                                        checksum=hasher, digest=digest)
+            wire_bytes = sent
+        if hasher is not None and stamp is not None:
+            self.digest_cache.add(file_path, stamp, hasher.hexdigest())
+        self.transfer_stats.record(path, sent, time.perf_counter() - started, wire_bytes)
+        self.metrics.add_bytes(sent=wire_bytes)
+        return sent, path, wire_bytes
+
+    def send_open_file(self, file_path, file, service_socket, request_id, metadata=None, offset=0, length=None,
+                       codec=None, checksum=False):
+        """
+        Sends an open file with the zero-copy sendfile() path if possible, buffered reads otherwise, and records the
+        throughput in self.transfer_stats. If a codec is given and a sample from the start of the range compresses
+        well, the file is compressed chunk by chunk instead; data that is already compressed still uses sendfile().
+        With checksums, sendfile() is only used if the checksum of the file is in self.digest_cache; otherwise the
+        data is hashed on its way through the buffered path, and the checksum of a whole file that did not change
+        meanwhile is cached for the next download.
+        :param file_path: path of the file, the key of its cached checksum
+        :param file: a file object opened in binary read mode
+        :param service_socket: active service socket with the client
+        :param request_id: id of the request the transfer belongs to
+        :param metadata: extra options for the MSG_TRANSFER frame, e.g. the name of the file in an mget batch
+        :param offset: first byte to send
+        :param length: number of bytes to send, None for the rest of the file
+        :param codec: the compression codec negotiated for the session, or None
+        :param checksum: True if the session negotiated checksummed transfers
+        :return: tuple of (bytes sent, 'sendfile', 'buffered' or the codec, bytes on the wire)
+        """
+
+        stat_result = os.fstat(file.fileno())
+        size = max(0, stat_result.st_size - offset)
+        if length is not None:
+            size = min(size, length)
+        whole = size == stat_result.st_size
+        stamp = DigestCache.stamp(stat_result)
+        digest = self.digest_cache.get(file_path, stamp) if checksum and whole else None
+        hasher = protocol.new_checksum() if checksum and digest is None else None
+        file.seek(offset)
+        compressor = None
+        if codec is not None:
+            sample = file.read(min(size, protocol.CHUNK_SIZE))
+            file.seek(offset)
+            if protocol.is_compressible(codec, sample):
+                compressor = protocol.StreamCompressor(codec)
+
+        started = time.perf_counter()
+        if compressor is not None:
+            path = codec
+            sent = protocol.send_file(service_socket, file, request_id, size, self.chunk_size or protocol.CHUNK_SIZE,
+                                      metadata, compressor, hasher, digest)
+        elif self.use_sendfile and hasher is None and protocol.can_sendfile(file):
+            path = "sendfile"
+            sent = protocol.sendfile_file(service_socket, file, request_id, size,
+                                          self.chunk_size or protocol.SENDFILE_CHUNK_SIZE, metadata, digest)
+        else:
+            path = "buffered"
+            sent = protocol.send_file(service_socket, file, request_id, size, self.chunk_size or protocol.CHUNK_SIZE,
+                                      metadata, checksum=hasher, digest=digest)
+        if sent < size:
+            # the client fails the transfer, see protocol.verify_size()
+            logger.warning("'%s' shrank while it was being sent: %s of %s bytes", file_path, sent, size)
+        if hasher is not None and whole and DigestCache.stamp(os.fstat(file.fileno())) == stamp:
+            self.digest_cache.add(file_path, stamp, hasher.hexdigest())
+        wire_bytes = compressor.wire_bytes if compressor is not None else sent
+        self.transfer_stats.record(path, sent, time.perf_counter() - started, wire_bytes)
+        self.metrics.add_bytes(sent=wire_bytes)
+        return sent, path, wire_bytes
+
+    def handle_mput(self, namespace, service_socket, request_id, checksum=False):
+        """
+        Handles the client mput commands: a batch of files sent in one stream after the command. Each file is a
+        MSG_TRANSFER frame with its relative 'name', its MSG_DATA frames and a MSG_END frame; a MSG_END frame without
+        a transfer ends the batch. Missing sub directories are created. A file that cannot be stored, or that does
+        not match its checksum, is skipped and the rest of the batch is still received.
+        :param namespace: the session's Namespace
+        :param service_socket: active socket with the client to read the files from.
+        :param request_id: id of the mput request, used to tag the reply frames.
+        :param checksum: True if the session negotiated checksummed transfers
+        """
+
+        received_files = 0
+        received_bytes = 0
+        errors = []
+        while True:
+            msg_type, frame_request_id, payload = protocol.receive_frame(service_socket)
+            if frame_request_id != request_id:
+                raise protocol.ProtocolError(f"Expected a frame for request {request_id}, got {frame_request_id}")
+            if msg_type == MSG_END:
+                break
+            if msg_type != MSG_TRANSFER:
+                raise protocol.ProtocolError(f"Expected a file transfer for mput, got message type {msg_type}")
+
+            metadata = protocol.decode_options(payload)
+            name = metadata.get("name", "")
+            try:
+                decompressor = protocol.decompressor_for(metadata)
+                size = int(metadata["size"]) if "size" in metadata else None
+                file_path = namespace.resolve(protocol.safe_relative_path(name))
+                directory = os.path.dirname(file_path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                    self.listing_cache.invalidate(os.path.dirname(directory))
+                file = open(protocol.partial_path(file_path), 'wb')
+            except (CommandError, ValueError, OSError, protocol.ProtocolError) as e:
+                # the rest of the batch is already on its way, read this file off the socket and go on
+                protocol.receive_file_data(service_socket, None, request_id)
+                errors.append(f"{name}: {e.strerror if isinstance(e, OSError) else e}")
+                continue
+
+            hasher = protocol.new_checksum() if checksum else None
+            try:
+                with file:
+                    received = protocol.receive_file_data(service_socket, file, request_id, decompressor=decompressor,
+                                                          checksum=hasher, size=size)
+                    file.flush()
+                    stamp = DigestCache.stamp(os.fstat(file.fileno()))
+            except protocol.IntegrityError as e:
+                os.remove(file.name)
+                logger.warning("mput: rejected '%s': %s", name, e)
+                errors.append(f"{name}: {e}")
+                continue
+            received_bytes += received
+            self.metrics.add_bytes(received=decompressor.wire_bytes if decompressor is not None else received)
+            self.store_file(file.name, file_path)
+            self.listing_cache.invalidate(directory)
+            self.signature_cache.invalidate(file_path)
+            self.file_cache.invalidate(file_path)
+            self.digest_cache.invalidate(file_path)
+            if hasher is not None:
+                self.digest_cache.add(file_path, stamp, hasher.hexdigest())
+            received_files += 1
+
+        # makedirs may have created several levels, the listing of the cwd is the one clients see most
+        self.listing_cache.invalidate(namespace.directory)
+        logger.debug("mput: received %s files (%s bytes) in one batch", received_files, received_bytes)
+        summary = f"Stored {received_files} files ({received_bytes} bytes)"
+        if errors:
+            protocol.send_frame(service_socket, MSG_TEXT, "\n".join(errors).encode(), request_id)
+            raise CommandError(f"{summary}, {len(errors)} failed")
+        protocol.send_frame(service_socket, MSG_TEXT, summary.encode(), request_id)
+
+    def handle_mget(self, namespace, argument, options, service_socket, request_id, codec=None, checksum=False):
+        """
+        Handles the client mget commands. The argument is a list of file names, directories (sent with everything
+        below them) and glob patterns such as '**/*.csv', quoted like a shell command line. Every matching file is
+        sent in one stream, as a MSG_TRANSFER frame with its relative 'name' followed by its data, and a MSG_TEXT
+        summary ends the reply.
+        With --list the files are not sent, the reply is a manifest of 'size name' lines instead, which lets the
+        client spread the files over several connections. With --exact the arguments are file names, not patterns.
+        :param namespace: the session's Namespace
+        :param argument: the quoted names or patterns
+        :param options: the command options, 'list' and 'exact'
+        :param service_socket: active service socket with the client
+        :param request_id: id of the mget request, used to tag the reply frames.
+        :param codec: the compression codec negotiated for the session, or None
+        :param checksum: True if the session negotiated checksummed transfers, every file then carries its own
+        """
+
+        try:
+            patterns = shlex.split(argument)
+        except ValueError as e:
+            raise CommandError(f"Usage: mget [--list] [--exact] <names or patterns>: {e}", STATUS_INVALID)
+        if not patterns:
+            raise CommandError("Usage: mget [--list] [--exact] <names or patterns>", STATUS_INVALID)
+
+        errors = []
+        if "exact" in options:
+            names = patterns
+        else:
+            names, unmatched = protocol.expand_paths(namespace.directory, patterns, namespace.hidden)
+            errors.extend(f"{pattern}: no such file" for pattern in unmatched)
+
+        files = []
+        for name in names:
+            try:
+                files.append((name, namespace.resolve(protocol.safe_relative_path(name))))
+            except (CommandError, ValueError) as e:
+                errors.append(str(e))
+
+        if "list" in options:
+            lines = []
+            for name, file_path in files:
+                try:
+                    lines.append(f"{os.path.getsize(file_path)} {name}")
+                except OSError as e:
+                    errors.append(f"{name}: {e.strerror}")
+            for start in range(0, len(lines), MANIFEST_LINES):
+                protocol.send_frame(service_socket, MSG_TEXT, "\n".join(lines[start:start + MANIFEST_LINES]).encode(), request_id)
+            if errors:
+                raise CommandError("; ".join(errors))
+            return
+
+        sent_files = 0
+        sent_bytes = 0
+        for name, file_path in files:
+            cached = self.file_cache.get(file_path)
+            if cached is not None:
+                sent_bytes += self.send_cached(file_path, cached, service_socket, request_id, {"name": name},
+                                               codec=codec, checksum=checksum)[0]
+                sent_files += 1
+                continue
+            try:
+                file = open(file_path, 'rb')
+            except OSError as e:
+                errors.append(f"{name}: {e.strerror}")
+                continue
+            with file:
+                sent_bytes += self.send_open_file(file_path, file, service_socket, request_id, {"name": name},
+                                                  codec=codec, checksum=checksum)[0]
+            sent_files += 1
+
+        logger.debug("mget: sent %s files (%s bytes) in one batch", sent_files, sent_bytes)
+        summary = f"Sent {sent_files} files ({sent_bytes} bytes)"
+        if errors:
+            raise CommandError(f"{summary}; " + "; ".join(errors))
+        protocol.send_frame(service_socket, MSG_TEXT, summary.encode(), request_id)
+
+    def handle_sync(self, namespace, file_name, options, service_socket, request_id):
+        """
+        Handles the client sync commands, which transfer only the blocks of a file that differ from the other side's
+        copy (see delta.py).
+        'sync <file>' updates the server's copy: the server sends the signature of its file (cached in
+        self.signature_cache), the client answers with a delta, and the file rebuilt from it is staged and renamed
+        like an upload. 'sync --pull <file>' updates the client's copy: the client sends the signature of its file
+        after the command and the server answers with a delta.
+        :param namespace: the session's Namespace
+        :param file_name: name of the file to sync
+        :param options: the command options, 'pull' for the server to client direction
+        :param service_socket: active service socket with the client
+        :param request_id: id of the sync request, used to tag the reply frames.
+        """
+
+        if "pull" in options:
+            block_size, basis_size, signature = delta.receive_signature(service_socket, request_id)
+            file_path = namespace.resolve(file_name)
+            try:
+                file = open(file_path, 'rb')
+            except OSError as e:
+                raise CommandError(f"Cannot read '{file_name}': {e.strerror}")
+            with file:
+                literal, reused = delta.send_delta(service_socket, file, request_id, signature, block_size, basis_size)
+            self.metrics.add_bytes(sent=literal)
+            logger.debug("sync: '%s' to the client, %s bytes sent, %s bytes reused", file_name, literal, reused)
+            return
+
+        block_size, basis_size, signature = delta.MIN_BLOCK_SIZE, 0, []
+        refused = None
+        try:
+            file_path = namespace.resolve(file_name)
+            block_size, basis_size, signature = self.signature_cache.get(file_path)
+        except CommandError as e:
+            # the client sends its delta right after the signature, the command fails once the delta was read
+            refused = e
+        except OSError:
+            # no usable copy on the server, the delta will be the whole file
+            pass
+        delta.send_signature(service_socket, request_id, signature, block_size, basis_size)
+
+        msg_type, _, _ = protocol.receive_frame(service_socket)
+        if msg_type != MSG_TRANSFER:
+            raise protocol.ProtocolError(f"Expected a delta for sync, got message type {msg_type}")
+        if refused is not None:
+            delta.receive_delta(service_socket, None, None, request_id, block_size)
+            raise refused
+
+        part_path = protocol.partial_path(file_path)
+        basis = None
+        try:
+            basis = open(file_path, 'rb') if signature else None
+            file = open(part_path, 'wb')
+        except OSError as e:
+            if basis is not None:
+                basis.close()
+            delta.receive_delta(service_socket, None, None, request_id, block_size)
+            raise CommandError(f"Cannot write '{file_name}': {e.strerror}")
+
+        with file:
+            try:
+                literal, reused = delta.receive_delta(service_socket, basis, file, request_id, block_size)
+            finally:
+                if basis is not None:
+                    basis.close()
+        self.store_file(part_path, file_path)
+        self.signature_cache.invalidate(file_path)
+        self.file_cache.invalidate(file_path)
+        self.digest_cache.invalidate(file_path)
+        self.listing_cache.invalidate(os.path.dirname(file_path))
+
+        self.metrics.add_bytes(received=literal)
+        response = f"Synced {file_name}: {literal} bytes sent, {reused} bytes reused"
+        protocol.send_frame(service_socket, MSG_TEXT, response.encode(), request_id)
+
+    def file_digest(self, file_path, compute=False):
+        """
+        :param file_path: path to a regular file
+        :param compute: read and hash the file if its checksum is not cached, and cache it
+        :return: the hex checksum of the file, None if it is not cached and compute is False
+        :raises OSError: if the file cannot be read
+        """
 
         with open(file_path, 'rb') as file:
-            file_content = file.read() + eof_token.encode()
-            service_socket.sendall(file_content)
+            stamp = DigestCache.stamp(os.fstat(file.fileno()))
+            digest = self.digest_cache.get(file_path, stamp)
+            if digest is None and compute:
+                digest = protocol.file_checksum(file)
+                if DigestCache.stamp(os.fstat(file.fileno())) == stamp:
+                    self.digest_cache.add(file_path, stamp, digest)
+        return digest
 
-    def handle_info(self, current_working_directory, file_name, service_socket, eof_token):
+    def handle_info(self, namespace, file_name, options, service_socket, request_id):
         """
-        Handles the client info commands. Reads the size of a given file.
-        :param current_working_directory: string of current working directory
+        Handles the client info commands. Reads the size of a given file, and the size of its partial upload if one
+        was interrupted. With --partial only the partial size is sent (0 if there is none), which is what clients
+        resume an upload from. The checksum of the file is shown if it is cached (see DigestCache); --checksum
+        computes it if it is not.
+        :param namespace: the session's Namespace
         :param file_name: name of sub directory or file to remove
+        :param options: the command options, 'partial' to ask for the partial upload only, 'checksum' to compute the
+            checksum
         :param service_socket: active service socket with the client
-        :param eof_token: a token to indicate the end of the message.
+        :param request_id: id of the info request, used to tag the reply frame.
         """
-        file_path = os.path.join(current_working_directory, file_name).replace(' ', '_')
+        file_path = namespace.resolve(file_name)
+        part_path = protocol.partial_path(file_path)
+        partial_size = os.path.getsize(part_path) if os.path.isfile(part_path) else None
+
+        if "partial" in options:
+            response = f"Partial upload of {file_name}: {partial_size or 0} bytes"
+            protocol.send_frame(service_socket, MSG_TEXT, response.encode(), request_id)
+            return
 
         try:
             # Get the size of the file
             file_size = os.path.getsize(file_path)
-
-            # Prepare the response message
-            response = f"Size of {file_name}: {file_size} bytes"
-
-            # Send the response to the client
-            service_socket.sendall((response + eof_token).encode())
         except FileNotFoundError:
-            # If the file is not found, send an error message to the client
-            response = f"File '{file_name}' not found"
-            service_socket.sendall((response + eof_token).encode())
-        except Exception as e:
+            if partial_size is None:
+                # If the file is not found, send an error message to the client
+                response = f"File '{file_name}' not found"
+                raise CommandError(response)
+            file_size = None
+        except OSError as e:
             # Handle other exceptions and send an error message to the client
             response = f"Error: {e}"
-            service_socket.sendall((response + eof_token).encode())
+            raise CommandError(response)
+
+        # Prepare the response message
+        responses = []
+        if file_size is not None:
+            responses.append(f"Size of {file_name}: {file_size} bytes")
+            if os.path.isfile(file_path):
+                try:
+                    digest = self.file_digest(file_path, "checksum" in options)
+                except OSError as e:
+                    raise CommandError(f"Cannot read '{file_name}': {e.strerror}")
+                if digest is not None:
+                    responses.append(f"Checksum of {file_name}: {protocol.CHECKSUM} {digest}")
+        if partial_size is not None:
+            responses.append(f"Partial upload of {file_name}: {partial_size} bytes")
+
+        # Send the response to the client
+        for response in responses:
+            protocol.send_frame(service_socket, MSG_TEXT, response.encode(), request_id)
+
+    def handle_stats(self, options, service_socket, request_id):
+        """
+        Handles the client stats commands. Sends the server's command counts and latencies, bytes in and out, sessions
+        and transfer throughput as a readable table, or with --format=prometheus in the Prometheus text format, the
+        same as the --metrics-port endpoint serves.
+        :param options: the command options, 'format' is 'text' (default) or 'prometheus'
+        :param service_socket: active service socket with the client
+        :param request_id: id of the stats request, used to tag the reply frame.
+        """
+
+        output_format = options.get("format", "text")
+        if output_format == "prometheus":
+            response = self.metrics.render_prometheus(self.transfer_stats)
+        elif output_format == "text":
+            response = self.metrics.render_text(self.transfer_stats)
+        else:
+            raise CommandError("Usage: stats [--format=text|prometheus]", STATUS_INVALID)
+        protocol.send_frame(service_socket, MSG_TEXT, response.encode(), request_id)
+
+    def handle_limits(self, options, service_socket, request_id):
+        """
+        Handles the client limits commands. Changes the bandwidth limits and the transfer cap that are given as
+        options, in bytes per second and transfers, 0 for no limit, and sends the limits in force. A new session rate
+        also applies to the sessions already open. With --processes every worker process has its own limits, the
+        command changes those of the worker that handles it.
+        :param options: the command options, 'rate', 'session-rate' and 'transfers'
+        :param service_socket: active service socket with the client
+        :param request_id: id of the limits request, used to tag the reply frame.
+        """
+
+        usage = "Usage: limits [--rate=BYTES_PER_SECOND] [--session-rate=BYTES_PER_SECOND] [--transfers=N]"
+        values = {}
+        for name in ("rate", "session-rate", "transfers"):
+            if name in options:
+                try:
+                    values[name] = int(options[name])
+                except ValueError:
+                    raise CommandError(usage, STATUS_INVALID)
+                if values[name] < 0:
+                    raise CommandError(usage, STATUS_INVALID)
+        if values:
+            self.limits.set(values.get("rate"), values.get("session-rate"), values.get("transfers"))
+            logger.info("Limits changed: %s", self.limits.describe())
+        protocol.send_frame(service_socket, MSG_TEXT, self.limits.describe().encode(), request_id)
+
+    def handle_ls(self, namespace, pattern, options, service_socket, request_id):
+        """
+        Handles the client ls commands. Sends one page of the directory info, optionally filtered by name.
+        :param namespace: the session's Namespace
+        :param pattern: shell-style pattern the names must match, e.g. '*.csv', empty for all entries
+        :param options: the command options, 'offset' and 'limit' select the page
+        :param service_socket: active service socket with the client
+        :param request_id: id of the ls request, used to tag the reply frame.
+        """
+
+        try:
+            offset = int(options.get("offset", 0))
+            limit = int(options["limit"]) if "limit" in options else None
+        except ValueError:
+            raise CommandError("Usage: ls [--offset=N] [--limit=N] [pattern]", STATUS_INVALID)
+        if limit is not None and limit < 0:
+            raise CommandError("Usage: ls [--offset=N] [--limit=N] [pattern]", STATUS_INVALID)
+
+        listing = self.get_working_directory_info(namespace, max(offset, 0), limit, pattern)
+        protocol.send_frame(service_socket, MSG_LISTING, listing.encode(), request_id)
+
+    def handle_du(self, namespace, name, options, service_socket, request_id):
+        """
+        Handles the client du commands. Adds up the size of the files below a directory (the current one if no name
+        is given) in one request, walking the tree on self.tree_executor. The reply has a 'size name/' line for each
+        sub directory, sorted by name, and a total line; --summary sends the total only.
+        :param namespace: the session's Namespace
+        :param name: the directory to measure, empty for the current one
+        :param options: the command options, 'summary' to leave out the sub directories
+        :param service_socket: active service socket with the client
+        :param request_id: id of the du request, used to tag the reply frames.
+        """
+
+        path = namespace.resolve(name)
+        if not os.path.isdir(path):
+            raise CommandError(f"'{name}' is not a directory")
+        (total_bytes, files, directories), children = tree.disk_usage(path, self.tree_executor,
+                                                                          namespace.hidden)
+
+        lines = [] if "summary" in options else [f"{size} {child}/" for child, (size, _, _) in sorted(children.items())]
+        lines.append(f"{total_bytes} total ({files} files, {directories} directories)")
+        for start in range(0, len(lines), MANIFEST_LINES):
+            protocol.send_frame(service_socket, MSG_TEXT, "\n".join(lines[start:start + MANIFEST_LINES]).encode(),
+                                request_id)
+
+    def handle_find(self, namespace, name, options, service_socket, request_id):
+        """
+        Handles the client find commands. Sends the paths of everything below a directory (the current one if no
+        name is given), relative to it and breadth first, MANIFEST_LINES per MSG_TEXT frame as the walk goes.
+        Directories end with a '/'.
+        :param namespace: the session's Namespace
+        :param name: the directory to search, empty for the current one
+        :param options: the command options, 'name' is a shell-style pattern the names must match and 'type' is
+            'f' for files or 'd' for directories
+        :param service_socket: active service socket with the client
+        :param request_id: id of the find request, used to tag the reply frames.
+        """
+
+        kind = options.get("type")
+        if kind not in (None, "f", "d"):
+            raise CommandError("Usage: find [--name=PATTERN] [--type=f|d] [directory]", STATUS_INVALID)
+        path = namespace.resolve(name)
+        if not os.path.isdir(path):
+            raise CommandError(f"'{name}' is not a directory")
+
+        lines = []
+        found = 0
+        for found, line in enumerate(tree.find(path, self.tree_executor, options.get("name"), kind,
+                                                          namespace.hidden), 1):
+            lines.append(line)
+            if len(lines) >= MANIFEST_LINES:
+                protocol.send_frame(service_socket, MSG_TEXT, "\n".join(lines).encode(), request_id)
+                lines = []
+        if lines:
+            protocol.send_frame(service_socket, MSG_TEXT, "\n".join(lines).encode(), request_id)
+        logger.debug("find: %s entries below %s", found, path)
+
+    def handle_cp(self, namespace, argument, options, service_socket, request_id):
+        """
+        Handles the client cp commands: 'cp <source> <destination>' copies a file, 'cp -r <source> <destination>'
+        (or --recursive) a whole directory tree, on self.tree_executor. Like in a shell, an existing destination
+        directory receives a copy under the source's name. Names with spaces are quoted.
+        :param namespace: the session's Namespace
+        :param argument: the quoted source and destination, with the -r if any
+        :param options: the command options, 'recursive' to copy directories
+        :param service_socket: active service socket with the client
+        :param request_id: id of the cp request, used to tag the reply frames.
+        """
+
+        recursive, argument = protocol.split_recursive(options, argument)
+        try:
+            names = shlex.split(argument)
+        except ValueError:
+            names = []
+        if len(names) != 2:
+            raise CommandError("Usage: cp [-r] <source> <destination>", STATUS_INVALID)
+
+        source = namespace.resolve(names[0])
+        destination = namespace.resolve(names[1])
+        if os.path.isdir(destination):
+            destination = os.path.join(destination, os.path.basename(os.path.normpath(source)))
+        if os.path.exists(destination) and os.path.isdir(source):
+            raise CommandError(f"'{names[1]}' already exists")
+
+        if os.path.isdir(source):
+            if not recursive:
+                raise CommandError(f"'{names[0]}' is a directory, copy it with cp -r")
+            real_source = os.path.realpath(source)
+            if os.path.commonpath([real_source, os.path.realpath(destination)]) == real_source:
+                raise CommandError(f"Cannot copy '{names[0]}' into itself")
+            files, size, errors = tree.copy_tree(source, destination, self.tree_executor, namespace.hidden)
+        elif os.path.isfile(source):
+            # copied next to the destination and renamed, an existing destination may be linked to the dedup store
+            part_path = protocol.partial_path(destination)
+            shutil.copy2(source, part_path)
+            self.store_file(part_path, destination)
+            files, size, errors = 1, os.path.getsize(destination), []
+        else:
+            raise CommandError(f"'{names[0]}' does not exist")
+
+        self.listing_cache.invalidate(os.path.dirname(destination))
+        self.listing_cache.invalidate(destination, recursive=True)
+        self.signature_cache.invalidate(destination, recursive=True)
+        self.file_cache.invalidate(destination, recursive=True)
+        self.digest_cache.invalidate(destination, recursive=True)
+        summary = f"Copied {files} files ({size} bytes)"
+        if errors:
+            protocol.send_frame(service_socket, MSG_TEXT, "\n".join(errors).encode(), request_id)
+            raise CommandError(f"{summary}, {len(errors)} errors")
+        protocol.send_frame(service_socket, MSG_TEXT, summary.encode(), request_id)
+
+    def handle_dl_tree(self, namespace, name, service_socket, request_id, codec=None, checksum=False):
+        """
+        Handles the client 'dl -r <directory>' commands: sends the whole tree as one tar stream (see
+        tree.send_archive()) whose members are named after the directory, followed by a summary.
+        :param namespace: the session's Namespace
+        :param name: the directory to send
+        :param service_socket: active service socket with the client
+        :param request_id: id of the dl request, used to tag the reply frames.
+        :param codec: the compression codec negotiated for the session, or None
+        :param checksum: True if the session negotiated checksummed transfers, the stream then carries one
+        """
+
+        path = namespace.resolve(name)
+        if not os.path.isdir(path):
+            raise CommandError(f"'{name}' is not a directory")
+        compressor = protocol.StreamCompressor(codec) if codec is not None else None
+
+        started = time.perf_counter()
+        files, writer, errors = tree.send_archive(service_socket, path, os.path.basename(os.path.normpath(path)),
+                                                  request_id, self.tree_executor, compressor,
+                                                  protocol.new_checksum() if checksum else None, namespace.hidden)
+        self.transfer_stats.record("tar", writer.raw_bytes, time.perf_counter() - started, writer.wire_bytes)
+        self.metrics.add_bytes(sent=writer.wire_bytes)
+
+        summary = f"Sent {files} files ({writer.raw_bytes} bytes of archive, {writer.wire_bytes} on the wire)"
+        if errors:
+            protocol.send_frame(service_socket, MSG_TEXT, "\n".join(errors).encode(), request_id)
+            raise CommandError(f"{summary}, {len(errors)} errors")
+        protocol.send_frame(service_socket, MSG_TEXT, summary.encode(), request_id)
+
+    def handle_ul_tree(self, namespace, service_socket, request_id, checksum=False):
+        """
+        Handles the client 'ul -r <directory>' commands: the client streams the tree as one tar archive right after
+        the command, which is unpacked into the current working directory while it arrives (see
+        tree.receive_archive()). Existing files are overwritten.
+        :param namespace: the session's Namespace
+        :param service_socket: active socket with the client to read the archive from.
+        :param request_id: id of the ul request, used to tag the reply frames.
+        :param checksum: True if the session negotiated checksummed transfers
+        """
+
+        msg_type, _, payload = protocol.receive_frame(service_socket)
+        if msg_type != MSG_TRANSFER:
+            raise protocol.ProtocolError(f"Expected a file transfer for ul, got message type {msg_type}")
+        metadata = protocol.decode_options(payload)
+        try:
+            if metadata.get("archive") != "tar":
+                raise CommandError("ul -r expects a tar archive", STATUS_INVALID)
+            directory = namespace.directory
+            decompressor = protocol.decompressor_for(metadata)
+        except (CommandError, protocol.ProtocolError) as e:
+            # the archive is read to its end so the session stays usable
+            protocol.receive_file_data(service_socket, None, request_id)
+            if isinstance(e, protocol.ProtocolError):
+                raise CommandError(str(e), STATUS_INVALID)
+            raise
+
+        files, reader, errors = tree.receive_archive(service_socket, request_id, directory, decompressor,
+                                                     protocol.new_checksum() if checksum else None, namespace.hidden)
+        self.metrics.add_bytes(received=reader.wire_bytes)
+        top = os.path.join(directory, metadata.get("name", ""))
+        self.listing_cache.invalidate(directory)
+        self.listing_cache.invalidate(top, recursive=True)
+        self.signature_cache.invalidate(top, recursive=True)
+        self.file_cache.invalidate(top, recursive=True)
+        self.digest_cache.invalidate(top, recursive=True)
 
-        # Print the response on the server side (for debugging)
-        print(response)
+        summary = f"Received {files} files ({reader.raw_bytes} bytes of archive, {reader.wire_bytes} on the wire)"
+        if errors:
+            protocol.send_frame(service_socket, MSG_TEXT, "\n".join(errors).encode(), request_id)
+            raise CommandError(f"{summary}, {len(errors)} errors")
+        protocol.send_frame(service_socket, MSG_TEXT, summary.encode(), request_id)
 
-    def handle_mv(self, current_working_directory, file_name, destination_name):
+    def handle_mv(self, namespace, file_name, destination_name):
         """
         Handles the client mv commands. First, it looks for the file in the current directory, then it moves or renames
         to the destination file depending on the nature of the request.
-        :param current_working_directory: string of current working directory
+        :param namespace: the session's Namespace
         :param file_name: name of the file tp be moved / renamed
         :param destination_name: destination directory or new filename
         """
-        source_path = os.path.join(current_working_directory, file_name)
+        source_path = namespace.resolve(file_name, follow_symlinks=False)
+        destination_path = namespace.resolve(destination_name)
+        if source_path == namespace.root:
+            raise CommandError("The root directory cannot be moved", STATUS_INVALID)
 
         # Check if the source file exists
-        if os.path.exists(source_path):
+        if os.path.lexists(source_path):
+            self.listing_cache.invalidate(os.path.dirname(source_path))
+            self.listing_cache.invalidate(source_path, recursive=True)
+            self.signature_cache.invalidate(source_path, recursive=True)
+            self.file_cache.invalidate(source_path, recursive=True)
+            self.digest_cache.invalidate(source_path, recursive=True)
             # Check if the destination is a directory or a new filename
-            if os.path.isdir(destination_name):
+            if os.path.isdir(destination_path):
                 # Destination is a directory, move the file to the destination directory
-                destination_path = os.path.join(destination_name, file_name)
+                destination_path = os.path.join(destination_path, os.path.basename(source_path))
                 os.rename(source_path, destination_path)
-                print(f"Moved '{file_name}' to '{destination_path}'")
+                self.listing_cache.invalidate(os.path.dirname(destination_path))
+                self.signature_cache.invalidate(destination_path, recursive=True)
+                self.file_cache.invalidate(destination_path, recursive=True)
+                self.digest_cache.invalidate(destination_path, recursive=True)
+                logger.debug("mv: moved '%s' to '%s'", file_name, destination_name)
             else:
                 # Destination is a new filename, rename the file
-                destination_path = os.path.join(current_working_directory, destination_name)
                 os.rename(source_path, destination_path)
-                print(f"Renamed '{file_name}' to '{destination_name}'")
+                self.listing_cache.invalidate(os.path.dirname(destination_path))
+                self.signature_cache.invalidate(destination_path, recursive=True)
+                self.file_cache.invalidate(destination_path, recursive=True)
+                self.digest_cache.invalidate(destination_path, recursive=True)
+                logger.debug("mv: renamed '%s' to '%s'", file_name, destination_name)
         else:
-            print(f"File '{file_name}' does not exist in the current directory.")
+            raise CommandError(f"File '{file_name}' does not exist in the current directory")
 
 
-class ClientThread(Thread):
+class ClientSession:
+    """
+    State of one client connection: its socket, eof token and current working directory. The thread engine drives a
+    session from its own ClientThread, the selector engine from whichever worker is free when the socket is readable.
+    """
 
     def __init__(self, server: Server, service_socket: socket.socket, address: str, eof_token: str):
-        Thread.__init__(self)
         self.server_obj = server
         self.service_socket = service_socket
         self.address = address
         self.eof_token = eof_token
+        # the session's root and working directory, see Namespace
+        self.namespace = None
+        self.listing_mode = "always"
+        # codec downloads are compressed with, negotiated in the handshake
+        self.compression = None
+        # the transfers of the session carry checksums, negotiated in the handshake
+        self.checksum = False
+        self.is_open = False
+        # a command is being handled, a graceful shutdown waits for it
+        self.busy = False
+        # the session's own share of the bandwidth, see shaping.Limits
+        self.bucket = None
 
-    def run(self):
+    def open(self):
+        """
+        Finishes the handshake and sends the initial working directory info.
+        :return: False if the client does not speak a supported protocol version and the session must be closed.
+        """
 
-        # print ("Connection from : ", self.address)
-        print(f"Connection from : ", {self.address})
+        settings = self.server_obj.negotiate_protocol(self.service_socket, self.eof_token)
+        if settings is None:
+            return False
+        self.listing_mode = settings["listing"]
+        self.compression = settings["compression"]
+        self.checksum = settings["checksum"]
 
         # establish working directory
-        current_working_dir = pathlib.Path(__file__).parent.resolve()
+        self.namespace = Namespace(self.server_obj.root, self.server_obj.hidden)
 
         # send the current dir info
-        self.service_socket.sendall((self.server_obj.get_working_directory_info(current_working_dir) + self.eof_token).encode())
+        protocol.send_frame(self.service_socket, MSG_LISTING, self.server_obj.get_working_directory_info(self.namespace).encode())
+        self.is_open = True
+        self.bucket = self.server_obj.limits.session_bucket()
+        self.server_obj.metrics.session_opened()
+        with self.server_obj.sessions_lock:
+            self.server_obj.sessions.add(self)
+        return True
 
-        # while True:
-        while True:
-            command = self.server_obj.receive_message_ending_with_token(self.service_socket, 1024, self.eof_token)
-            command = command.decode()
+    def handle_command(self):
+        """
+        Receives one command frame and calls the corresponding handler. Every reply frame carries the request id of
+        the command it answers, and every reply ends with a status frame (MSG_STATUS) holding STATUS_OK or the error.
+        Before it, the current directory info (MSG_LISTING) is sent if the session's listing mode is 'always'; a
+        command can override the mode with a leading --listing=always|never option.
+        Clients may pipeline commands, i.e. send the next ones before this reply arrives. They stay in the socket
+        until the next call, and the replies go out in the order the commands were received.
+        :return: False once the client sent exit.
+        """
 
-            # get the command and arguments and call the corresponding method
-            if command.lower() == "exit":
-                break
+        msg_type, request_id, payload = protocol.receive_frame(self.service_socket)
+        if msg_type != MSG_COMMAND:
+            raise protocol.ProtocolError(f"Expected a command, got message type {msg_type}")
+        self.busy = True
+        try:
+            return self.run_command(request_id, payload)
+        finally:
+            self.busy = False
 
+    def run_command(self, request_id, payload):
+        """
+        Handles one received command and sends its reply, see handle_command().
+        """
 
-            if command.startswith("mkdir "):
-                self.server_obj.handle_mkdir(current_working_dir, command[6:])
-            elif command.startswith("cd "):
-                current_working_dir = self.server_obj.handle_cd(current_working_dir, command[3:])
-            elif command.startswith("rm "):
-                self.server_obj.handle_rm(current_working_dir, command[3:])
-            elif command.startswith("ul "):
-                self.server_obj.handle_ul(current_working_dir, command[3:], self.service_socket, self.eof_token)
-            elif command.startswith("dl "):
-                self.server_obj.handle_dl(current_working_dir, command[3:], self.service_socket, self.eof_token)
-            elif command.startswith("info "):
-                self.server_obj.handle_info(current_working_dir, command[5:], self.service_socket, self.eof_token)
-            elif command.startswith("mv "):
-                args = command.split(" ")
-                if len(args) == 3:
-                    _, source, destination = args
-                    self.server_obj.handle_mv(current_working_dir, source, destination)
+        verb, options, argument = protocol.parse_command(payload.decode())
+        namespace = self.namespace
+        listing = options.get("listing", self.listing_mode)
+
+        # get the command and arguments and call the corresponding method
+        if verb.lower() == "exit":
+            return False
+
+        started = time.perf_counter()
+        transfer = verb in TRANSFER_COMMANDS
+        # the data of transfers goes through the rate limits, everything else straight to the client
+        service_socket = self.service_socket
+        if transfer:
+            limits = self.server_obj.limits
+            queued = limits.slots.acquire(self.server_obj.metrics.transfer_queued)
+            if queued:
+                self.server_obj.metrics.add_wait(queued=queued)
+            if limits.shaping:
+                service_socket = shaping.ShapedSocket(self.service_socket, [self.bucket, limits.bucket],
+                                                      self.server_obj.metrics.add_wait)
+            self.server_obj.metrics.transfer_started()
+        try:
+            if listing not in LISTING_MODES:
+                raise CommandError(f"--listing must be one of {', '.join(LISTING_MODES)}", STATUS_INVALID)
+
+            if verb == "mkdir":
+                self.server_obj.handle_mkdir(namespace, argument)
+            elif verb == "cd":
+                self.server_obj.handle_cd(namespace, argument)
+            elif verb == "pwd":
+                protocol.send_frame(service_socket, MSG_TEXT, namespace.cwd.encode(), request_id)
+            elif verb == "rm":
+                self.server_obj.handle_rm(namespace, argument)
+            elif verb == "ul" and protocol.split_recursive(options, argument)[0]:
+                self.server_obj.handle_ul_tree(namespace, service_socket, request_id, self.checksum)
+            elif verb == "ul" and "dedup" in options:
+                self.server_obj.handle_ul_chunks(namespace, argument, service_socket, request_id, self.checksum)
+            elif verb == "ul":
+                self.server_obj.handle_ul(namespace, argument, options, service_socket, request_id, self.checksum)
+            elif verb == "dl" and protocol.split_recursive(options, argument)[0]:
+                self.server_obj.handle_dl_tree(namespace, protocol.split_recursive(options, argument)[1],
+                                               service_socket, request_id, self.compression, self.checksum)
+            elif verb == "dl":
+                self.server_obj.handle_dl(namespace, argument, options, service_socket, request_id,
+                                          self.compression, self.checksum)
+            elif verb == "mput":
+                self.server_obj.handle_mput(namespace, service_socket, request_id, self.checksum)
+            elif verb == "mget":
+                self.server_obj.handle_mget(namespace, argument, options, service_socket, request_id,
+                                            self.compression, self.checksum)
+            elif verb == "sync":
+                self.server_obj.handle_sync(namespace, argument, options, service_socket, request_id)
+            elif verb == "info":
+                self.server_obj.handle_info(namespace, argument, options, service_socket, request_id)
+            elif verb == "du":
+                self.server_obj.handle_du(namespace, argument, options, service_socket, request_id)
+            elif verb == "find":
+                self.server_obj.handle_find(namespace, argument, options, service_socket, request_id)
+            elif verb == "cp":
+                self.server_obj.handle_cp(namespace, argument, options, service_socket, request_id)
+            elif verb == "mv":
+                args = argument.split(" ")
+                if len(args) != 2:
+                    raise CommandError("Usage: mv <source> <destination>", STATUS_INVALID)
+                source, destination = args
+                self.server_obj.handle_mv(namespace, source, destination)
+            elif verb == "ls":
+                self.server_obj.handle_ls(namespace, argument, options, service_socket, request_id)
+                # the page is the listing, don't send the directory info a second time
+                listing = "never"
+            elif verb == "stats":
+                self.server_obj.handle_stats(options, service_socket, request_id)
+                listing = "never"
+            elif verb == "limits":
+                self.server_obj.handle_limits(options, service_socket, request_id)
+                listing = "never"
+            elif verb == "have":
+                self.server_obj.handle_have(argument, service_socket, request_id)
+                listing = "never"
             else:
-                print("Invalid command. Supported commands: cd, mkdir, rm, ul, dl, info, mv, exit")
+                verb = "invalid"
+                raise CommandError(f"Invalid command. Supported commands: {SUPPORTED_COMMANDS}", STATUS_INVALID)
+            status, message = STATUS_OK, "ok"
+        except CommandError as e:
+            status, message = e.code, str(e)
+        except (ConnectionError, TimeoutError):
+            raise
+        except OSError as e:
+            logger.warning("Error while handling '%s' from %s: %s", verb, self.address, e)
+            status, message = STATUS_ERROR, f"{verb} failed: {e.strerror or e}"
+        finally:
+            if transfer:
+                self.server_obj.limits.slots.release()
+                self.server_obj.metrics.transfer_finished()
+
+        # send current dir info
+        if listing == "always":
+            protocol.send_frame(self.service_socket, MSG_LISTING, self.server_obj.get_working_directory_info(namespace).encode(), request_id)
+        protocol.send_status(self.service_socket, status, message, request_id)
+        self.server_obj.metrics.observe_command(verb, time.perf_counter() - started, status == STATUS_OK)
+        return True
+
+    def has_pending_input(self):
+        """
+        Checks without blocking whether the client already sent more data, e.g. the next pipelined command.
+        :return: True if at least one byte is waiting in the socket.
+        """
 
-            time.sleep(1)
-            # send current dir info
-            self.service_socket.sendall((self.server_obj.get_working_directory_info(current_working_dir) + self.eof_token).encode())
-            #self.service_socket.sendall((self.server_obj.get_working_directory_info(current_working_dir) + self.eof_token).encode())
+        # a socket with a timeout polls for data before it calls recv(), even with MSG_DONTWAIT, and would keep the
+        # worker waiting up to SESSION_IO_TIMEOUT for a client that sent nothing: peek in non-blocking mode instead
+        timeout = self.service_socket.gettimeout()
+        self.service_socket.setblocking(False)
+        try:
+            return bool(self.service_socket.recv(1, socket.MSG_PEEK))
+        except (BlockingIOError, InterruptedError):
+            return False
+        finally:
+            self.service_socket.settimeout(timeout)
 
-        # print('Connection closed from:', self.address)
-        print(f'Connection closed from:', {self.address})
+    def close(self):
+        logger.info("Connection closed from %s", self.address)
+        if self.is_open:
+            self.is_open = False
+            self.server_obj.metrics.session_closed()
+            self.server_obj.limits.drop_session_bucket(self.bucket)
+            with self.server_obj.sessions_lock:
+                self.server_obj.sessions.discard(self)
         self.service_socket.close()
 
 
+class ClientThread(Thread):
+
+    def __init__(self, server: Server, service_socket: socket.socket, address: str, eof_token: str):
+        Thread.__init__(self, daemon=True)
+        self.server_obj = server
+        self.service_socket = service_socket
+        self.address = address
+        self.eof_token = eof_token
+        self.session = ClientSession(server, service_socket, address, eof_token)
+
+    def run(self):
+
+        try:
+            if self.session.open():
+                # while True:
+                while self.session.handle_command():
+                    pass
+        except (ConnectionError, protocol.ProtocolError) as e:
+            logger.warning("Connection error from %s: %s", self.address, e)
+        finally:
+            self.session.close()
+            self.server_obj.connection_slots.release()
+
+
+class SelectorEngine:
+    """
+    Event driven alternative to one ClientThread per connection. A single loop waits on a selector until a session's
+    socket is readable, then hands the session to a bounded pool of worker threads. The worker handles exactly one
+    command (or the handshake) with the usual blocking calls and gives the session back to the loop, so idle sessions
+    cost no thread and all filesystem work runs on the pool.
+    Backpressure: at most server.max_connections sessions are open, beyond that the listening socket is not polled
+    and new connections wait in the listen backlog. Readable sessions wait in self.ready while all workers are busy,
+    so clients block on their own sends instead of work piling up in the executor.
+    """
+
+    def __init__(self, server: Server):
+        self.server_obj = server
+        self.selector = selectors.DefaultSelector()
+        self.executor = ThreadPoolExecutor(max_workers=server.workers, thread_name_prefix="session-worker")
+        self.ready = deque()
+        # sessions handed back by the workers, with whether they are still open
+        self.finished = queue.SimpleQueue()
+        # workers write a byte here to wake the loop up when they finish
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.open_sessions = 0
+        self.busy_workers = 0
+        self.accepting = False
+
+    def run(self):
+        self.server_obj.server_socket.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, "wakeup")
+        self.set_accepting(True)
+
+        while True:
+            for key, _ in self.selector.select():
+                if key.data == "listen":
+                    self.accept()
+                elif key.data == "wakeup":
+                    self.drain_wakeup()
+                else:
+                    # a worker owns the socket until the command is done, stop watching it meanwhile
+                    self.selector.unregister(key.fileobj)
+                    self.ready.append(key.data)
+            self.collect_finished()
+            self.dispatch()
+
+    def set_accepting(self, accepting):
+        if accepting and not self.accepting:
+            self.selector.register(self.server_obj.server_socket, selectors.EVENT_READ, "listen")
+        elif not accepting and self.accepting:
+            self.selector.unregister(self.server_obj.server_socket)
+        self.accepting = accepting
+
+    def accept(self):
+        try:
+            client_socket, client_address, eof = self.server_obj.accept_connection()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            logger.error("Error accepting a connection: %s", e)
+            return
+
+        self.open_sessions += 1
+        session = ClientSession(self.server_obj, client_socket, client_address, eof)
+        self.selector.register(client_socket, selectors.EVENT_READ, session)
+        if self.open_sessions >= self.server_obj.max_connections:
+            self.set_accepting(False)
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def dispatch(self):
+        while self.ready and self.busy_workers < self.server_obj.workers:
+            self.busy_workers += 1
+            self.executor.submit(self.run_step, self.ready.popleft())
+
+    def run_step(self, session: ClientSession):
+        """
+        Runs on a worker thread: handles the handshake or the next command of the session, and up to PIPELINE_BATCH
+        commands if the client pipelined more of them.
+        """
+
+        session.service_socket.settimeout(SESSION_IO_TIMEOUT)
+        try:
+            keep_open = session.handle_command() if session.is_open else session.open()
+            handled = 1
+            while keep_open and handled < PIPELINE_BATCH and session.has_pending_input():
+                keep_open = session.handle_command()
+                handled += 1
+        except (OSError, protocol.ProtocolError) as e:
+            logger.warning("Connection error from %s: %s", session.address, e)
+            keep_open = False
+        except Exception:
+            logger.exception("Unexpected error while serving %s", session.address)
+            keep_open = False
+
+        self.finished.put((session, keep_open))
+        try:
+            self.wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            # the loop has not drained earlier wakeups yet, it will see this session too
+            pass
+
+    def collect_finished(self):
+        while True:
+            try:
+                session, keep_open = self.finished.get_nowait()
+            except queue.Empty:
+                return
+
+            self.busy_workers -= 1
+            if keep_open:
+                self.selector.register(session.service_socket, selectors.EVENT_READ, session)
+            else:
+                session.close()
+                self.open_sessions -= 1
+                if self.open_sessions < self.server_obj.max_connections:
+                    self.set_accepting(True)
+
+
+def create_listening_socket(host, port, reuse_port=False):
+    """
+    :param reuse_port: set SO_REUSEPORT, so that several processes can listen on the port and the kernel spreads the
+        connections over them
+    :return: a TCP socket listening on host:port
+    """
+
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # allow restarting the server right away while old connections are still in TIME_WAIT
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listening_socket.bind((host, port))
+    listening_socket.listen()
+    return listening_socket
+
+
+class Supervisor:
+    """
+    Pre-fork mode (--processes N): N worker processes each run a complete Server, with its own engine, sessions,
+    caches and metrics, so the protocol, checksum and compression work of the sessions spreads over N cores instead
+    of sharing one interpreter lock. On Linux every worker binds its own socket with SO_REUSEPORT and the kernel
+    balances the connections between them; elsewhere the supervisor binds one socket before forking and the workers
+    accept from it in turn.
+    The supervisor serves nothing itself. It restarts a worker that exits, after RESTART_DELAY seconds that double
+    while the worker keeps exiting soon after its start; SIGTERM or SIGINT stop all workers gracefully (see
+    Server.shutdown()), and SIGHUP replaces them one by one with fresh processes without closing the port. Only the
+    workers started first give up when they cannot listen; a replacement that finds its ports still held by the
+    worker it replaces is restarted like a worker that exited.
+    """
+
+    SIGNALS = {signal.SIGCHLD, signal.SIGTERM, signal.SIGINT, signal.SIGHUP}
+
+    def __init__(self, make_server, processes, log_listener=None, listening_socket=None):
+        """
+        :param make_server: function of the worker index that creates the worker's Server, called in the worker
+        :param processes: number of worker processes
+        :param log_listener: the QueueListener of metrics.configure_logging(), restarted in every worker
+        :param listening_socket: socket the workers share if they do not bind their own
+        """
+
+        self.make_server = make_server
+        self.processes = processes
+        self.log_listener = log_listener
+        self.listening_socket = listening_socket
+        # pid -> (worker index, time.monotonic() at its start)
+        self.workers = {}
+        # pids of replaced workers that are finishing their sessions, they are not restarted
+        self.retiring = set()
+        # pids of the workers started with the supervisor, a startup failure of one of them is not retried
+        self.first_workers = set()
+        # worker index -> time.monotonic() when it is due to be restarted
+        self.restarts = {}
+        self.delays = [RESTART_DELAY] * processes
+        self.stop_deadline = None
+        self.failed = False
+
+    def run(self):
+        """
+        Starts the workers and supervises them until they are all stopped.
+        :return: 0 after a requested stop, 1 if workers could not start
+        """
+
+        # the signals are received synchronously with sigtimedwait() below, the handler only makes SIGCHLD pending
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.SIGNALS)
+        for index in range(self.processes):
+            self.first_workers.add(self.spawn(index))
+        logger.info("Supervisor %s started %s worker processes", os.getpid(), self.processes)
+
+        while self.workers or (self.restarts and self.stop_deadline is None):
+            now = time.monotonic()
+            wakeups = list(self.restarts.values()) + ([self.stop_deadline] if self.stop_deadline else [])
+            timeout = max(0.0, min(wakeups) - now) if wakeups else None
+            info = signal.sigtimedwait(self.SIGNALS, timeout) if timeout is not None \
+                else signal.sigwaitinfo(self.SIGNALS)
+            if info is not None and info.si_signo in (signal.SIGTERM, signal.SIGINT):
+                self.stop()
+            elif info is not None and info.si_signo == signal.SIGHUP:
+                self.reload()
+            self.reap()
+
+            now = time.monotonic()
+            if self.stop_deadline is not None and now >= self.stop_deadline:
+                for pid in self.workers:
+                    logger.warning("Worker pid %s did not stop in time, killing it", pid)
+                    self.signal_worker(pid, signal.SIGKILL)
+                self.stop_deadline = now + KILL_GRACE
+            for index, due in list(self.restarts.items()):
+                if due <= now and self.stop_deadline is None:
+                    del self.restarts[index]
+                    self.spawn(index)
+
+        logger.info("Supervisor stopped")
+        return 1 if self.failed else 0
+
+    def spawn(self, index):
+        # the logging thread does not survive fork(), the worker starts its own and the supervisor restarts it
+        if self.log_listener is not None:
+            self.log_listener.stop()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = self.run_worker(index)
+            except BaseException:
+                logger.exception("Worker %s failed", index)
+            finally:
+                if self.log_listener is not None:
+                    self.log_listener.stop()
+                os._exit(status)
+        if self.log_listener is not None:
+            self.log_listener.start()
+        self.workers[pid] = (index, time.monotonic())
+        return pid
+
+    def run_worker(self, index):
+        """
+        Runs in the forked worker process.
+        :return: the exit status of the worker
+        """
+
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # the supervisor decides when the workers stop, a Ctrl-C on the terminal reaches it as well
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, self.SIGNALS)
+        current_thread().name = f"worker-{index}"
+        if self.log_listener is not None:
+            self.log_listener.start()
+
+        server = self.make_server(index)
+        try:
+            server.listen(self.listening_socket)
+        except OSError as e:
+            logger.error("Worker %s cannot listen on %s:%s: %s", index, server.host, server.port, e)
+            return WORKER_STARTUP_FAILED
+        server.serve(shutdown_signals=(signal.SIGTERM,))
+        return 0
+
+    def signal_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def stop(self):
+        if self.stop_deadline is None:
+            logger.info("Stopping %s worker processes", len(self.workers))
+            self.stop_deadline = time.monotonic() + SHUTDOWN_GRACE + KILL_GRACE
+        self.restarts.clear()
+        for pid in self.workers:
+            self.signal_worker(pid, signal.SIGTERM)
+
+    def reload(self):
+        if self.stop_deadline is not None:
+            return
+        logger.info("Replacing %s worker processes", len(self.workers))
+        for pid, (index, _) in list(self.workers.items()):
+            if pid not in self.retiring:
+                self.retiring.add(pid)
+                self.signal_worker(pid, signal.SIGTERM)
+                self.spawn(index)
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            index, started = self.workers.pop(pid)
+            code = os.waitstatus_to_exitcode(status)
+            first_worker = pid in self.first_workers
+            self.first_workers.discard(pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                continue
+            if self.stop_deadline is not None:
+                continue
+            if code == WORKER_STARTUP_FAILED and first_worker:
+                self.failed = True
+                continue
+
+            if time.monotonic() - started < MAX_RESTART_DELAY:
+                delay = self.delays[index]
+                self.delays[index] = min(delay * 2, MAX_RESTART_DELAY)
+            else:
+                delay = self.delays[index] = RESTART_DELAY
+            logger.warning("Worker %s (pid %s) exited with status %s, restarting it in %.1f s", index, pid, code, delay)
+            self.restarts[index] = time.monotonic() + delay
+
+
 def run_server():
     HOST = "127.0.0.1"
     PORT = 65432
 
-    server = Server(HOST, PORT)
-    server.start()
+    parser = argparse.ArgumentParser(description="File server")
+    parser.add_argument("--port", type=int, default=PORT, help="port to listen on")
+    parser.add_argument("--no-sendfile", action="store_true", help="send downloads with buffered reads only")
+    parser.add_argument("--engine", choices=ENGINES, default="thread",
+                        help="thread: one thread per connection, select: event loop with a worker pool")
+    parser.add_argument("--max-connections", type=int, default=1000, help="maximum number of open sessions")
+    parser.add_argument("--workers", type=int, default=32, help="worker threads of the select engine")
+    parser.add_argument("--listing-limit", type=int, default=LISTING_LIMIT,
+                        help="entries shown in the directory info sent after each command")
+    parser.add_argument("--compression", default=",".join(protocol.CODECS),
+                        help="comma separated codecs clients may use, 'none' to disable compression "
+                             f"(available: {', '.join(protocol.CODECS)})")
+    parser.add_argument("--no-checksums", action="store_true",
+                        help="refuse checksummed transfers, downloads then always use sendfile() when they can")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="payload bytes per data frame of downloads (default: 64 KiB buffered, 1 MiB sendfile)")
+    parser.add_argument("--tree-workers", type=int, default=tree.WORKERS,
+                        help="threads scanning and copying directory trees for du, find, cp -r and dl -r")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="lowest level of the messages logged")
+    parser.add_argument("--log-rate", type=int, default=metrics.LOG_RATE,
+                        help="times per second the same message may be logged, 0 for no limit")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics (off by default)")
+    parser.add_argument("--root", default=ROOT_DIRECTORY,
+                        help="directory served to the clients, they cannot leave it (default: the directory of "
+                             "server.py)")
+    parser.add_argument("--dedup", action="store_true",
+                        help=f"store uploads once per content in {STORE_DIRECTORY}/ and link them into place, clients "
+                             "skip sending the chunks the server has")
+    parser.add_argument("--file-cache-size", type=int, default=FILE_CACHE_SIZE,
+                        help="bytes of hot file contents kept in memory for dl and mget, 0 to disable the cache; "
+                             "shared out among the worker processes")
+    parser.add_argument("--rate-limit", type=int, default=0,
+                        help="bytes per second of all transfers together, 0 for no limit; shared out among the "
+                             "worker processes, changed at runtime with the limits command")
+    parser.add_argument("--session-rate-limit", type=int, default=0,
+                        help="bytes per second of the transfers of each session, 0 for no limit")
+    parser.add_argument("--max-transfers", type=int, default=0,
+                        help="transfers running at once, more wait for their turn; 0 for no limit, shared out among "
+                             "the worker processes")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes serving the port, each with its own sessions and caches; the metrics "
+                             "endpoint of worker i is on --metrics-port + i, SIGHUP replaces the workers")
+    args = parser.parse_args()
+    if args.processes > 1 and not (hasattr(os, "fork") and hasattr(signal, "sigtimedwait")):
+        parser.error("--processes needs a platform with fork() and sigtimedwait()")
+
+    log_listener = metrics.configure_logging(args.log_level, args.log_rate)
+
+    if args.dedup:
+        # once for all processes, before any of them writes to the store
+        store = dedup.ChunkStore(os.path.join(args.root, STORE_DIRECTORY))
+        removed = store.collect_garbage()
+        store.close()
+        if removed:
+            logger.info("Dedup store: removed %s objects without links", removed)
+
+    compression = [codec for codec in args.compression.split(",") if codec in protocol.CODECS]
+    # balancing over SO_REUSEPORT sockets is Linux behaviour, elsewhere the workers share one socket
+    reuse_port = args.processes > 1 and sys.platform.startswith("linux")
+
+    def make_server(index=0):
+        metrics_port = args.metrics_port + index if args.metrics_port is not None else None
+        return Server(HOST, args.port, use_sendfile=not args.no_sendfile, engine=args.engine,
+                      max_connections=args.max_connections, workers=args.workers, listing_limit=args.listing_limit,
+                      compression=compression, chunk_size=args.chunk_size, metrics_port=metrics_port,
+                      tree_workers=args.tree_workers, dedup_store=args.dedup,
+                      file_cache_size=args.file_cache_size // args.processes, reuse_port=reuse_port,
+                      root=args.root, rate_limit=-(-args.rate_limit // args.processes),
+                      session_rate_limit=args.session_rate_limit,
+                      max_transfers=-(-args.max_transfers // args.processes), checksums=not args.no_checksums)
+
+    if args.processes <= 1:
+        make_server().start()
+        log_listener.stop()
+        return
+
+    listening_socket = None
+    if not reuse_port:
+        try:
+            listening_socket = create_listening_socket(HOST, args.port)
+        except OSError as e:
+            logger.error("Cannot listen on %s:%s: %s", HOST, args.port, e)
+            log_listener.stop()
+            sys.exit(1)
+    status = Supervisor(make_server, args.processes, log_listener, listening_socket).run()
+    log_listener.stop()
+    sys.exit(status)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,257 @@
+"""
+Bandwidth and concurrency limits of the server's transfers: token buckets per session and for the whole server, and
+a cap on the transfers running at once.
+
+The data of a transfer command goes through a ShapedSocket, which asks the buckets before it moves every QUANTUM
+bytes. A bucket hands out its tokens in the order they are asked for and lets the waiting transfers sleep until
+their turn, so transfers sharing a bucket send one quantum each in turn instead of the biggest one taking the whole
+link. The other commands and the status frames bypass the buckets, which keeps interactive commands fast while bulk
+transfers are being shaped. Every limit can be changed while the server runs, see Limits.
+"""
+
+import threading
+import time
+
+# bytes a transfer moves per turn of the buckets
+QUANTUM = 64 * 1024
+
+# seconds of its rate a bucket may save up and spend at once after being idle
+BURST_SECONDS = 0.25
+
+
+class TokenBucket:
+    """
+    A token bucket that goes into debt: reserve() takes the tokens right away and returns how long the caller has to
+    wait until the bucket would have held them. Callers that reserve one after the other are thereby queued behind
+    each other, one reservation's worth of time apart. Thread safe.
+    """
+
+    def __init__(self, rate=0):
+        """
+        :param rate: bytes per second, 0 for no limit
+        """
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def capacity(self):
+        return max(self.rate * BURST_SECONDS, QUANTUM)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = rate
+            self.tokens = min(self.tokens, self.capacity)
+
+    def refill(self, now):
+        # called with self.lock held
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, count):
+        """
+        :param count: bytes about to be moved
+        :return: seconds to wait before moving them, 0 without a limit
+        """
+        with self.lock:
+            if not self.rate:
+                return 0
+            self.refill(time.monotonic())
+            self.tokens -= count
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class TransferSlots:
+    """
+    Caps the number of transfers running at once; the transfers beyond the cap wait in arrival order until one ends.
+    """
+
+    def __init__(self, limit=0):
+        """
+        :param limit: maximum number of transfers at once, 0 for no limit
+        """
+        self.condition = threading.Condition()
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.next_ticket = 0
+        self.serving = 0
+
+    def acquire(self, on_queued=None):
+        """
+        Waits for a free slot.
+        :param on_queued: called with 1 before waiting and with -1 after, e.g. to keep a gauge of the waiting transfers
+        :return: seconds waited
+        """
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            if ticket == self.serving and (not self.limit or self.active < self.limit):
+                self.serving += 1
+                self.active += 1
+                return 0
+            started = time.monotonic()
+            self.waiting += 1
+            if on_queued is not None:
+                on_queued(1)
+            while ticket != self.serving or (self.limit and self.active >= self.limit):
+                self.condition.wait()
+            self.waiting -= 1
+            if on_queued is not None:
+                on_queued(-1)
+            self.serving += 1
+            self.active += 1
+            # the next in line may fit as well
+            self.condition.notify_all()
+            return time.monotonic() - started
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+
+class Limits:
+    """
+    The limits of one server: the rate of the global bucket, the rate every session's own bucket gets, and the
+    transfer cap. set() changes them at runtime, also for the sessions already open.
+    """
+
+    def __init__(self, rate=0, session_rate=0, max_transfers=0):
+        """
+        :param rate: bytes per second of all transfers together, 0 for no limit
+        :param session_rate: bytes per second of the transfers of one session, 0 for no limit
+        :param max_transfers: transfer commands running at once, 0 for no limit
+        """
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(rate)
+        self.session_rate = session_rate
+        self.slots = TransferSlots(max_transfers)
+        # the session buckets, so a new session rate reaches them
+        self.session_buckets = set()
+
+    @property
+    def shaping(self):
+        """
+        True if the transfers have to go through a ShapedSocket at all.
+        """
+        return bool(self.bucket.rate or self.session_rate)
+
+    def session_bucket(self):
+        """
+        :return: a new bucket for a session, to be given back with drop_session_bucket() when it closes
+        """
+        bucket = TokenBucket(self.session_rate)
+        with self.lock:
+            self.session_buckets.add(bucket)
+        return bucket
+
+    def drop_session_bucket(self, bucket):
+        with self.lock:
+            self.session_buckets.discard(bucket)
+
+    def set(self, rate=None, session_rate=None, max_transfers=None):
+        """
+        Changes the given limits, None leaves one as it is.
+        """
+        if rate is not None:
+            self.bucket.set_rate(rate)
+        if session_rate is not None:
+            with self.lock:
+                self.session_rate = session_rate
+                buckets = list(self.session_buckets)
+            for bucket in buckets:
+                bucket.set_rate(session_rate)
+        if max_transfers is not None:
+            self.slots.set_limit(max_transfers)
+
+    def describe(self):
+        """
+        :return: the limits and the transfers running and waiting, as sent by the limits command
+        """
+        def rate_text(rate):
+            return f"{rate} bytes/s" if rate else "unlimited"
+
+        with self.slots.condition:
+            active, waiting, limit = self.slots.active, self.slots.waiting, self.slots.limit
+        return (f"rate {rate_text(self.bucket.rate)}, session rate {rate_text(self.session_rate)}, "
+                f"transfers {active} running, {waiting} waiting, max {limit or 'unlimited'}")
+
+
+class ShapedSocket:
+    """
+    Wraps a connected socket for the duration of a transfer: every QUANTUM bytes sent or received are first
+    reserved in the session's bucket and then in the global one, sleeping as long as they say. Everything but the
+    data calls goes straight to the socket.
+    """
+
+    def __init__(self, active_socket, buckets, on_throttle=None):
+        """
+        :param buckets: the TokenBuckets to ask, in order
+        :param on_throttle: called with the seconds slept, e.g. to count them in the metrics
+        """
+        self.active_socket = active_socket
+        self.buckets = buckets
+        self.on_throttle = on_throttle
+
+    def __getattr__(self, name):
+        return getattr(self.active_socket, name)
+
+    def throttle(self, count):
+        slept = 0
+        for bucket in self.buckets:
+            delay = bucket.reserve(count)
+            if delay > 0:
+                time.sleep(delay)
+                slept += delay
+        if slept and self.on_throttle is not None:
+            self.on_throttle(slept)
+
+    def sendall(self, data):
+        view = memoryview(data).cast("B")
+        for start in range(0, len(view), QUANTUM):
+            piece = view[start:start + QUANTUM]
+            self.throttle(len(piece))
+            self.active_socket.sendall(piece)
+
+    def sendmsg(self, buffers):
+        # send_frame() gathers a header and a payload, the rest of a partial send goes through sendall()
+        buffers = list(buffers)
+        size = sum(len(buffer) for buffer in buffers)
+        if size > QUANTUM:
+            first = memoryview(buffers[0]).cast("B")
+            self.sendall(first)
+            return len(first)
+        self.throttle(size)
+        return self.active_socket.sendmsg(buffers)
+
+    def sendfile(self, file, offset=0, count=None):
+        sent = 0
+        while count is None or sent < count:
+            piece = QUANTUM if count is None else min(QUANTUM, count - sent)
+            self.throttle(piece)
+            moved = self.active_socket.sendfile(file, offset + sent, piece)
+            sent += moved
+            if moved < piece:
+                break
+        return sent
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        view = memoryview(buffer).cast("B")
+        nbytes = min(nbytes or len(view), QUANTUM)
+        received = self.active_socket.recv_into(view, nbytes, flags)
+        self.throttle(received)
+        return received
+
+    def recv(self, bufsize, flags=0):
+        data = self.active_socket.recv(min(bufsize, QUANTUM), flags)
+        self.throttle(len(data))
+        return data
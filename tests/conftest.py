@@ -0,0 +1,94 @@
+"""
+Fixtures shared by the tests: servers running in background threads on free ports of 127.0.0.1, each serving a
+temporary directory, and clients connected to them that read and write another temporary directory.
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import client  # noqa: E402
+import server  # noqa: E402
+
+
+def serve(running_server):
+    try:
+        running_server.serve()
+    except (OSError, ValueError):
+        # shutdown() closed the listening socket under the engine
+        pass
+
+
+@pytest.fixture
+def root(tmp_path):
+    """
+    The directory the servers serve.
+    """
+    path = tmp_path / "server"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def local(tmp_path):
+    """
+    The directory the clients upload from and download to.
+    """
+    path = tmp_path / "client"
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def start_server(root):
+    """
+    Starts a Server with the given options (see server.Server) on a free port; it is stopped after the test.
+    """
+    servers = []
+
+    def start(**options):
+        options.setdefault("root", str(root))
+        running_server = server.Server("127.0.0.1", 0, **options)
+        running_server.listen()
+        running_server.port = running_server.server_socket.getsockname()[1]
+        threading.Thread(target=serve, args=(running_server,), daemon=True).start()
+        servers.append(running_server)
+        return running_server
+
+    yield start
+    for running_server in servers:
+        running_server.shutdown(grace=0)
+
+
+@pytest.fixture
+def connect(local):
+    """
+    Opens a Client session to a running server, with the given options (see client.Client); it is closed after the
+    test. The client is quiet, does not ask for the directory info and does not compress unless told to.
+    """
+    clients = []
+
+    def open_session(running_server, **options):
+        options.setdefault("listing", "never")
+        options.setdefault("verbose", False)
+        options.setdefault("compression", "none")
+        session = client.Client("127.0.0.1", running_server.port, **options)
+        session.local_directory = str(local)
+        clients.append(session.connect())
+        return session
+
+    yield open_session
+    for session in clients:
+        session.close()
+
+
+@pytest.fixture(params=server.ENGINES)
+def engine(request):
+    """
+    Runs a test once per server engine.
+    """
+    return request.param
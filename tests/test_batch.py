@@ -0,0 +1,73 @@
+import io
+import socket
+
+import pytest
+
+import client
+
+
+def batch_client(running_server, local):
+    session = client.Client("127.0.0.1", running_server.port, listing="never", verbose=False, compression="none")
+    session.local_directory = str(local)
+    return session
+
+
+def test_execute_returns_a_result_per_command(start_server, connect, root, local):
+    (local / "up.txt").write_text("content")
+    session = connect(start_server())
+
+    results = session.execute(["mkdir logs", "cd logs", "ul up.txt", "info up.txt", "exit", "mkdir never"])
+
+    assert [result.command for result in results] == ["mkdir logs", "cd logs", "ul up.txt", "info up.txt"]
+    assert all(result.ok for result in results)
+    assert results[3].texts[0].startswith("Size of")
+    assert (root / "logs" / "up.txt").read_text() == "content"
+    assert not (root / "never").exists()
+
+
+def test_execute_stops_on_error(start_server, connect, root):
+    session = connect(start_server())
+
+    # a failed cd is always awaited, nothing after it is sent
+    made, failed, skipped = session.execute(["mkdir a", "cd missing", "mkdir b"], stop_on_error=True)
+
+    assert made.ok and not failed.ok
+    assert (skipped.status, skipped.message) == (None, "not run")
+    assert not (root / "b").exists()
+
+
+def test_execute_reports_a_missing_local_file(start_server, connect):
+    session = connect(start_server())
+
+    result, = session.execute(["ul nothing.txt"])
+
+    assert not result.ok
+    assert result.message == "File does not exist on the client"
+
+
+@pytest.mark.parametrize("stop_on_error, expected", [(False, ["a", "b"]), (True, ["a"])])
+def test_batch_exit_status_and_output(start_server, local, root, capsys, stop_on_error, expected):
+    script = io.StringIO("# set up\nmkdir a\n\ncd missing\nmkdir b\npwd\n")
+
+    status = batch_client(start_server(), local).run_batch(script, stop_on_error)
+
+    assert status == client.EXIT_FAILED
+    assert sorted(path.name for path in root.iterdir()) == expected
+    assert "line 4: cd missing:" in capsys.readouterr().err
+
+
+def test_batch_of_successful_commands(start_server, local, capsys):
+    status = batch_client(start_server(), local).run_batch(["mkdir a", "pwd"])
+
+    assert status == client.EXIT_OK
+    assert capsys.readouterr().out.splitlines() == ["/"]
+
+
+def test_batch_without_a_server(capsys):
+    # a bound socket that does not listen: connections to its port are refused
+    with socket.socket() as closed_port:
+        closed_port.bind(("127.0.0.1", 0))
+        unreachable = client.Client("127.0.0.1", closed_port.getsockname()[1], listing="never", verbose=False)
+
+        assert unreachable.run_batch(["pwd"]) == client.EXIT_CONNECTION
+    assert "failed" in capsys.readouterr().err
@@ -0,0 +1,24 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCHMARK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmark.py")
+
+
+def test_benchmark_passes_its_options_on_and_reports_them(tmp_path):
+    output = tmp_path / "results.json"
+
+    subprocess.run([sys.executable, BENCHMARK, "--clients", "2", "--operations", "10", "--sizes", "1K,64K",
+                    "--dedup", "--no-checksums", "--rate-limit", "100000000", "--session-rate-limit", "50000000",
+                    "--max-transfers", "2", "--scratch", str(tmp_path), "--output", str(output)],
+                   check=True, timeout=60)
+
+    results = json.loads(output.read_text())
+    assert results["client_failures"] == []
+    assert results["errors"] == 0
+    assert results["operations"] == 2 * 10
+    assert {key: results["config"][key] for key in
+            ("checksums", "processes", "dedup", "rate_limit", "session_rate_limit", "max_transfers")} == {
+        "checksums": False, "processes": 1, "dedup": True, "rate_limit": 100_000_000,
+        "session_rate_limit": 50_000_000, "max_transfers": 2}
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import threading
+
+import pytest
+
+import protocol
+
+
+def test_verify_end_compares_the_checksums():
+    checksum = protocol.new_checksum()
+    checksum.update(b"data")
+    protocol.verify_end(protocol.end_payload(checksum), checksum)
+    protocol.verify_end(b"", None)
+
+    other = protocol.new_checksum()
+    other.update(b"dato")
+    with pytest.raises(protocol.IntegrityError):
+        protocol.verify_end(protocol.end_payload(checksum), other)
+    # negotiated, but the sender left it out
+    with pytest.raises(protocol.IntegrityError):
+        protocol.verify_end(b"", checksum)
+
+
+@pytest.fixture
+def corrupt_client_checksums(monkeypatch):
+    """
+    Makes the checksums computed on the client, in the test's thread, differ from the server's as if the data had
+    been corrupted in transit. The server runs in the same process, its threads keep the real checksum.
+    """
+    new_checksum = protocol.new_checksum
+
+    def corrupted():
+        if threading.current_thread() is threading.main_thread():
+            return hashlib.blake2b(b"corrupted", digest_size=protocol.CHECKSUM_SIZE)
+        return new_checksum()
+
+    monkeypatch.setattr(protocol, "new_checksum", corrupted)
+
+
+def test_sessions_negotiate_checksums(start_server, connect):
+    running_server = start_server()
+
+    assert connect(running_server).checksum
+    assert not connect(running_server, checksums=False).checksum
+    assert not connect(start_server(checksums=False)).checksum
+
+
+def test_corrupted_upload_is_not_stored(start_server, connect, root, local, corrupt_client_checksums):
+    (root / "data.bin").write_bytes(b"old")
+    (local / "data.bin").write_bytes(os.urandom(100_000))
+    session = connect(start_server())
+
+    result, = session.execute(["ul data.bin"])
+
+    assert not result.ok
+    assert "Checksum mismatch" in result.message
+    assert (root / "data.bin").read_bytes() == b"old"
+    assert not (root / ".data.bin.part").exists()
+
+
+def test_corrupted_download_is_thrown_away(start_server, connect, root, local, corrupt_client_checksums):
+    (root / "data.bin").write_bytes(os.urandom(100_000))
+    session = connect(start_server())
+
+    result, = session.execute(["dl data.bin"])
+
+    assert not result.ok
+    assert "Checksum mismatch" in result.message
+    assert not (local / "data.bin").exists()
+    assert not (local / ".data.bin.part").exists()
+
+
+def test_without_checksums_nothing_is_verified(start_server, connect, root, local, corrupt_client_checksums):
+    content = os.urandom(100_000)
+    (root / "data.bin").write_bytes(content)
+    session = connect(start_server(), checksums=False)
+
+    result, = session.execute(["dl data.bin"])
+
+    assert result.ok
+    assert (local / "data.bin").read_bytes() == content
+
+
+def test_info_reports_the_checksum_of_an_upload(start_server, connect, local):
+    content = os.urandom(100_000)
+    (local / "data.bin").write_bytes(content)
+    session = connect(start_server())
+
+    session.execute(["ul data.bin"])
+    info, = session.execute(["info --checksum data.bin"])
+
+    checksum = protocol.new_checksum()
+    checksum.update(content)
+    assert f"Checksum of data.bin: {protocol.CHECKSUM} {checksum.hexdigest()}" in info.texts
+
+
+def test_an_upload_without_its_checksum_is_not_stored(start_server, connect, root):
+    session = connect(start_server())
+    request_id = session.send_command("ul a.bin", session.client_socket)
+    protocol.send_frame(session.client_socket, protocol.MSG_TRANSFER, protocol.encode_options({"size": 4}), request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_DATA, b"data", request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_END, b"", request_id)
+
+    reply = session.receive_reply(session.client_socket, request_id)
+
+    assert not reply.ok
+    assert "Checksum missing" in reply.message
+    assert os.listdir(root) == []
+
+
+@pytest.mark.parametrize("use_mmap", [True, False])
+@pytest.mark.parametrize("checksums", [True, False])
+def test_a_file_that_shrinks_during_a_download_fails_it(start_server, connect, root, local, monkeypatch, use_mmap,
+                                                        checksums):
+    (root / "a.bin").write_bytes(os.urandom(300_000))
+    send_file = protocol.send_file
+
+    def shrink_first(active_socket, file, *args, **kwargs):
+        # the server took the size already, the file loses its second half before it is read
+        if threading.current_thread() is not threading.main_thread():
+            os.truncate(root / "a.bin", 150_000)
+        return send_file(active_socket, file, *args, **kwargs)
+
+    monkeypatch.setattr(protocol, "send_file", shrink_first)
+    session = connect(start_server(use_sendfile=False, file_cache_size=0), checksums=checksums)
+    session.use_mmap = use_mmap
+
+    result, = session.execute(["dl a.bin"])
+
+    assert not result.ok
+    assert "received 150000 of the announced 300000 bytes" in result.message
+    assert os.listdir(local) == []
+    assert session.execute(["pwd"])[0].ok
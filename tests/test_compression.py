@@ -0,0 +1,67 @@
+import os
+import zlib
+
+import pytest
+
+import protocol
+
+
+def test_the_preferred_common_codec_is_negotiated(start_server, connect):
+    running_server = start_server(compression=["zlib"])
+
+    assert connect(running_server, compression="bogus,zlib").codec == "zlib"
+    assert connect(running_server, compression="none").codec is None
+
+
+def test_compressed_ul_and_dl_round_trip(start_server, connect, root, local):
+    content = b"a line of text that compresses well\n" * 20_000
+    (local / "up.txt").write_bytes(content)
+    (root / "down.txt").write_bytes(content)
+    running_server = start_server(compression=["zlib"], file_cache_size=0)
+    session = connect(running_server, compression="zlib")
+
+    uploaded, downloaded = session.execute(["ul up.txt", "dl down.txt"])
+
+    assert uploaded.ok and downloaded.ok
+    assert (root / "up.txt").read_bytes() == content
+    assert (local / "down.txt").read_bytes() == content
+    count, raw, _, wire = running_server.transfer_stats.totals["zlib"]
+    assert raw == len(content) and wire < len(content) // 10
+
+
+def test_incompressible_data_is_sent_as_it_is(start_server, connect, root, local):
+    content = os.urandom(200_000)
+    (root / "noise.bin").write_bytes(content)
+    running_server = start_server(compression=["zlib"], file_cache_size=0)
+    session = connect(running_server, compression="zlib")
+
+    result, = session.execute(["dl noise.bin"])
+
+    assert result.ok
+    assert (local / "noise.bin").read_bytes() == content
+    assert "zlib" not in running_server.transfer_stats.totals
+
+
+@pytest.mark.parametrize("codec", ["zlib", "zstd"])
+def test_a_payload_expanding_beyond_the_message_size_is_refused(codec):
+    if codec == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+        bomb = zstandard.ZstdCompressor().compress(b"\0" * (4 * protocol.MAX_MESSAGE_SIZE))
+    else:
+        bomb = zlib.compress(b"\0" * (4 * protocol.MAX_MESSAGE_SIZE))
+    decompressor = protocol.StreamDecompressor(codec)
+
+    with pytest.raises(protocol.ProtocolError):
+        decompressor.process(bomb)
+
+
+@pytest.mark.parametrize("codec", list(protocol.CODECS))
+def test_stream_compression_round_trip(codec):
+    compressor = protocol.StreamCompressor(codec)
+    decompressor = protocol.StreamDecompressor(codec)
+    chunks = [b"text " * 10_000, b"more text " * 5_000, os.urandom(1000)]
+
+    payloads = [compressor.start(chunks[0])] + [compressor.process(chunk) for chunk in chunks[1:]]
+
+    assert compressor.enabled
+    assert b"".join(decompressor.process(payload) for payload in payloads) == b"".join(chunks)
@@ -0,0 +1,110 @@
+import os
+
+import dedup
+import protocol
+import server
+
+
+def store_of(root):
+    return dedup.ChunkStore(str(root / server.STORE_DIRECTORY))
+
+
+def test_chunk_store_links_equal_files_to_one_object(tmp_path):
+    store = dedup.ChunkStore(str(tmp_path / "store"))
+    for name in ("a.bin", "b.bin"):
+        (tmp_path / f".{name}.part").write_bytes(b"same content" * 1000)
+        store.ingest(str(tmp_path / f".{name}.part"), str(tmp_path / name))
+
+    assert os.path.samefile(tmp_path / "a.bin", tmp_path / "b.bin")
+    assert os.stat(tmp_path / "a.bin").st_nlink == 3
+    assert not list(tmp_path.glob(".*.part"))
+    store.close()
+
+
+def test_reupload_of_the_same_file_leaves_no_part_file(start_server, connect, root, local):
+    content = os.urandom(300_000)
+    (local / "a.bin").write_bytes(content)
+    running_server = start_server(dedup_store=True)
+    session = connect(running_server)
+
+    first, second = session.execute(["ul a.bin", "ul a.bin"])
+    info, = session.execute(["info a.bin"])
+
+    assert first.ok and second.ok
+    assert (root / "a.bin").read_bytes() == content
+    assert not (root / ".a.bin.part").exists()
+    assert not any(text.startswith("Partial") for text in info.texts)
+    # the visible file and the object
+    assert os.stat(root / "a.bin").st_nlink == 2
+    assert running_server.metrics.bytes_deduplicated == len(content)
+
+
+def test_removed_files_are_collected(start_server, connect, root, local):
+    (local / "a.bin").write_bytes(os.urandom(100_000))
+    session = connect(start_server(dedup_store=True))
+    session.execute(["ul a.bin", "ul a.bin", "rm a.bin"])
+
+    store = store_of(root)
+    try:
+        assert store.collect_garbage() == 1
+    finally:
+        store.close()
+    assert not [name for _, _, names in os.walk(root / server.STORE_DIRECTORY / "objects") for name in names]
+
+
+def test_an_object_replaced_behind_the_store_is_not_linked(tmp_path):
+    content = b"same content" * 1000
+    store = dedup.ChunkStore(str(tmp_path / "store"))
+    (tmp_path / ".a.bin.part").write_bytes(content)
+    store.ingest(str(tmp_path / ".a.bin.part"), str(tmp_path / "a.bin"))
+    object_path, = [os.path.join(path, name) for path, _, names in os.walk(tmp_path / "store" / "objects")
+                    for name in names]
+    os.remove(object_path)
+    with open(object_path, "wb") as poisoned:
+        poisoned.write(b"poison")
+
+    (tmp_path / ".b.bin.part").write_bytes(content)
+    store.ingest(str(tmp_path / ".b.bin.part"), str(tmp_path / "b.bin"))
+
+    assert (tmp_path / "b.bin").read_bytes() == content
+    assert os.path.samefile(tmp_path / "b.bin", object_path)
+    store.close()
+
+
+def test_the_store_is_hidden_from_the_sessions(start_server, connect, root, local):
+    (local / "a.bin").write_bytes(os.urandom(100_000))
+    session = connect(start_server(dedup_store=True))
+    assert session.execute(["ul a.bin"])[0].ok
+    object_path, = [os.path.join(path, name) for path, _, names in os.walk(root / server.STORE_DIRECTORY / "objects")
+                    for name in names]
+    request_id = session.send_command(f"ul {os.path.relpath(object_path, root)}", session.client_socket)
+    protocol.send_frame(session.client_socket, protocol.MSG_TRANSFER, protocol.encode_options({"size": 6}), request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_DATA, b"poison", request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_END, b"", request_id)
+    assert session.receive_reply(session.client_socket, request_id).status == protocol.STATUS_INVALID
+
+    listing, found, usage = session.execute(["ls", "find", "du --summary"])
+    refused = session.execute(["rm .store", "cd .store", "mv a.bin .store/a.bin", "dl .store/index.sqlite",
+                               "mget --list .store"])
+
+    assert server.STORE_DIRECTORY not in "\n".join(listing.texts)
+    assert found.texts == ["a.bin"]
+    assert usage.texts == ["100000 total (1 files, 0 directories)"]
+    assert [result.status for result in refused[:4]] == [protocol.STATUS_INVALID] * 4
+    assert not refused[4].ok
+    assert os.path.samefile(root / "a.bin", object_path)
+
+
+def test_a_deduplicated_upload_without_its_checksum_is_not_stored(start_server, connect, root):
+    session = connect(start_server(dedup_store=True))
+    request_id = session.send_command("ul --dedup a.bin", session.client_socket)
+    protocol.send_frame(session.client_socket, protocol.MSG_TRANSFER,
+                        protocol.encode_options({"total": 4, "chunk_size": dedup.CHUNK_SIZE}), request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_DATA, b"data", request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_END, b"", request_id)
+
+    reply = session.receive_reply(session.client_socket, request_id)
+
+    assert not reply.ok
+    assert "Checksum missing" in reply.message
+    assert not (root / "a.bin").exists()
@@ -0,0 +1,102 @@
+import io
+import random
+import socket
+import threading
+
+import pytest
+
+import delta
+import protocol
+
+
+def rebuild(tmp_path, basis, new):
+    """
+    Runs the delta of new against basis through the wire format.
+    :return: tuple of (rebuilt file, literal bytes sent)
+    """
+    block_size = delta.choose_block_size(len(basis))
+    signature = delta.file_signature(io.BytesIO(basis), block_size)
+    new_path = tmp_path / "new.bin"
+    new_path.write_bytes(new)
+    sender, receiver = socket.socketpair()
+    result = {}
+
+    def send():
+        with open(new_path, "rb") as file:
+            result["sent"] = delta.send_delta(sender, file, 1, signature, block_size, len(basis))
+
+    with sender, receiver:
+        thread = threading.Thread(target=send)
+        thread.start()
+        msg_type, _, _ = protocol.receive_frame(receiver)
+        assert msg_type == protocol.MSG_TRANSFER
+        output = io.BytesIO()
+        delta.receive_delta(receiver, io.BytesIO(basis), output, 1, block_size)
+        thread.join()
+    return output.getvalue(), result["sent"][0]
+
+
+def random_bytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+BASIS = random_bytes(300_000, 1)
+
+
+@pytest.mark.parametrize("new", [
+    BASIS,
+    BASIS[:100_000] + b"inserted" + BASIS[100_000:],
+    BASIS[:100_000] + BASIS[120_000:],
+    b"prepended" + BASIS,
+    BASIS + b"appended",
+    BASIS[:-1],
+    random_bytes(50_000, 2),
+    b"",
+], ids=["same", "insert", "delete", "prepend", "append", "shorter", "unrelated", "empty"])
+def test_delta_round_trip(tmp_path, new):
+    rebuilt, _ = rebuild(tmp_path, BASIS, new)
+
+    assert rebuilt == new
+
+
+def test_small_change_sends_few_literal_bytes(tmp_path):
+    new = BASIS[:150_000] + b"x" + BASIS[150_001:]
+
+    rebuilt, literal = rebuild(tmp_path, BASIS, new)
+
+    assert rebuilt == new
+    assert literal <= 2 * delta.choose_block_size(len(BASIS))
+
+
+def test_delta_against_an_empty_basis(tmp_path):
+    rebuilt, literal = rebuild(tmp_path, b"", BASIS)
+
+    assert rebuilt == BASIS
+    assert literal == len(BASIS)
+
+
+def test_sync_pushes_and_pulls_changes(start_server, connect, root, local):
+    session = connect(start_server())
+    (root / "doc.bin").write_bytes(BASIS)
+    changed = BASIS[:200_000] + b"edit" + BASIS[200_000:]
+    (local / "doc.bin").write_bytes(changed)
+
+    pushed, = session.execute(["sync doc.bin"])
+    assert pushed.ok, pushed.message
+    assert (root / "doc.bin").read_bytes() == changed
+
+    (root / "doc.bin").write_bytes(b"server side " + changed)
+    pulled, = session.execute(["sync --pull doc.bin"])
+    assert pulled.ok, pulled.message
+    assert (local / "doc.bin").read_bytes() == b"server side " + changed
+    assert not (local / ".doc.bin.part").exists()
+
+
+def test_sync_pull_without_a_local_copy(start_server, connect, root, local):
+    session = connect(start_server())
+    (root / "doc.bin").write_bytes(BASIS)
+
+    pulled, = session.execute(["sync --pull doc.bin"])
+
+    assert pulled.ok, pulled.message
+    assert (local / "doc.bin").read_bytes() == BASIS
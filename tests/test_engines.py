@@ -0,0 +1,62 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import protocol
+
+
+def test_concurrent_sessions(engine, start_server, connect, root, local):
+    running_server = start_server(engine=engine, workers=4)
+    sessions = [connect(running_server) for _ in range(8)]
+    for index in range(len(sessions)):
+        (local / f"file{index}.bin").write_bytes(os.urandom(200_000 + index))
+
+    def work(index):
+        return sessions[index].execute([f"mkdir dir{index}", f"cd dir{index}", f"ul file{index}.bin",
+                                        f"info file{index}.bin"])
+
+    with ThreadPoolExecutor(len(sessions)) as executor:
+        results = list(executor.map(work, range(len(sessions))))
+
+    for index, replies in enumerate(results):
+        assert all(reply.ok for reply in replies), replies
+        assert replies[-1].texts[0] == f"Size of file{index}.bin: {200_000 + index} bytes"
+        assert (root / f"dir{index}" / f"file{index}.bin").read_bytes() == (local / f"file{index}.bin").read_bytes()
+
+
+def test_connections_beyond_the_limit_wait(engine, start_server, connect):
+    running_server = start_server(engine=engine, max_connections=1)
+    first = connect(running_server)
+    second = []
+    waiting = threading.Thread(target=lambda: second.append(connect(running_server)))
+    waiting.start()
+
+    waiting.join(0.5)
+    assert waiting.is_alive()
+    first.close()
+    waiting.join(10)
+
+    assert not waiting.is_alive()
+    assert second[0].execute(["pwd"])[0].texts == ["/"]
+
+
+def test_a_failed_accept_does_not_stop_the_server(engine, start_server, connect, monkeypatch):
+    running_server = start_server(engine=engine, max_connections=1)
+    configure_socket = protocol.configure_socket
+    failures = []
+
+    def fail_once(client_socket):
+        # the clients connect from the test's thread, the server accepts on its own
+        if threading.current_thread() is not threading.main_thread() and not failures:
+            failures.append(True)
+            raise OSError("setsockopt failed")
+        configure_socket(client_socket)
+
+    monkeypatch.setattr(protocol, "configure_socket", fail_once)
+    with pytest.raises((OSError, protocol.ProtocolError)):
+        connect(running_server)
+
+    assert failures
+    assert connect(running_server).execute(["pwd"])[0].texts == ["/"]
@@ -0,0 +1,71 @@
+import builtins
+import os
+
+import server
+
+
+def test_file_cache_reads_a_file_once(tmp_path, monkeypatch):
+    (tmp_path / "hot.bin").write_bytes(b"hot" * 1000)
+    cache = server.FileCache(max_bytes=100_000)
+    content, _ = cache.get(tmp_path / "hot.bin")
+
+    def fail(*args, **kwargs):
+        raise AssertionError("a cached file must not be read again")
+
+    monkeypatch.setattr(builtins, "open", fail)
+    assert cache.get(tmp_path / "hot.bin")[0] is content
+
+
+def test_file_cache_notices_a_changed_file(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"old")
+    cache = server.FileCache(max_bytes=100_000)
+    cache.get(path)
+
+    path.write_bytes(b"new content")
+
+    assert cache.get(path)[0] == b"new content"
+
+
+def test_file_cache_evicts_and_skips_large_files(tmp_path):
+    for name in ("a", "b", "c"):
+        (tmp_path / name).write_bytes(b"x" * 400)
+    (tmp_path / "large").write_bytes(b"x" * 2000)
+    cache = server.FileCache(max_bytes=1000)
+
+    for name in ("a", "b", "c"):
+        cache.get(tmp_path / name)
+
+    assert cache.get(tmp_path / "large") is None
+    assert list(cache.entries) == [str(tmp_path / "b"), str(tmp_path / "c")]
+    assert cache.size == 800
+    assert server.FileCache(max_bytes=0).get(tmp_path / "a") is None
+
+
+def test_file_cache_invalidate(tmp_path):
+    (tmp_path / "sub").mkdir()
+    for name in ("top", "sub/a", "sub/b"):
+        (tmp_path / name).write_bytes(b"x")
+    cache = server.FileCache(max_bytes=1000)
+    for name in ("top", "sub/a", "sub/b"):
+        cache.get(tmp_path / name)
+
+    cache.invalidate(tmp_path / "sub", recursive=True)
+
+    assert list(cache.entries) == [str(tmp_path / "top")]
+    assert cache.size == 1
+
+
+def test_downloads_are_served_from_the_cache(start_server, connect, root, local):
+    (root / "hot.bin").write_bytes(os.urandom(50_000))
+    running_server = start_server()
+    session = connect(running_server)
+
+    session.execute(["dl hot.bin", "dl hot.bin"])
+    (local / "hot.bin").write_bytes(b"replaced")
+    session.execute(["ul hot.bin", "dl hot.bin"])
+
+    assert running_server.metrics.file_cache_hits == 1
+    assert running_server.metrics.file_cache_misses == 2
+    assert (root / "hot.bin").read_bytes() == b"replaced"
+    assert (local / "hot.bin").read_bytes() == b"replaced"
@@ -0,0 +1,58 @@
+import os
+
+import server
+
+
+def test_listing_cache_sorts_and_reuses_listings(tmp_path, monkeypatch):
+    for name in ("b.txt", "a.txt"):
+        (tmp_path / name).write_text(name)
+    (tmp_path / "sub").mkdir()
+    cache = server.DirectoryListingCache()
+
+    assert cache.get(tmp_path) == (["sub"], ["a.txt", "b.txt"])
+
+    def fail(*args):
+        raise AssertionError("an unchanged directory must not be read again")
+
+    monkeypatch.setattr(os, "scandir", fail)
+    assert cache.get(tmp_path) == (["sub"], ["a.txt", "b.txt"])
+
+
+def test_listing_cache_invalidate(tmp_path):
+    cache = server.DirectoryListingCache()
+    (tmp_path / "sub").mkdir()
+    cache.get(tmp_path)
+    cache.get(tmp_path / "sub")
+
+    cache.invalidate(tmp_path, recursive=True)
+
+    assert cache.entries == {}
+
+
+def test_listing_cache_evicts_the_least_recently_used(tmp_path):
+    cache = server.DirectoryListingCache(max_directories=2)
+    for name in ("a", "b", "c"):
+        (tmp_path / name).mkdir()
+        cache.get(tmp_path / name)
+
+    assert list(cache.entries) == [str(tmp_path / "b"), str(tmp_path / "c")]
+
+
+def test_directory_info_follows_changes(start_server, connect, root):
+    session = connect(start_server())
+    assert session.execute(["ls"])[0].listing == "Current Directory: /:\n|\n-- \n-- "
+
+    session.execute(["mkdir new"])
+    (root / "file.txt").write_text("x")
+
+    assert session.execute(["ls"])[0].listing == "Current Directory: /:\n|\n-- new\n-- file.txt"
+
+
+def test_directory_info_is_capped(start_server, connect, root):
+    for index in range(10):
+        (root / f"f{index}").write_text("x")
+    session = connect(start_server(listing_limit=3))
+
+    listing = session.execute(["ls"])[0].listing
+
+    assert listing.splitlines()[-4:] == ["-- f0", "-- f1", "-- f2", "... 7 of 10 entries not shown"]
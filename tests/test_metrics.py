@@ -0,0 +1,62 @@
+import logging
+import urllib.request
+
+import metrics
+import protocol
+
+
+def test_histogram_quantiles_interpolate_within_buckets():
+    histogram = metrics.LatencyHistogram()
+    assert histogram.quantile(0.5) is None
+
+    for _ in range(100):
+        histogram.observe(metrics.LATENCY_BUCKETS[0] / 2)
+
+    assert histogram.count == 100
+    assert 0 < histogram.quantile(0.5) <= metrics.LATENCY_BUCKETS[0]
+
+
+def test_stats_counts_commands_and_bytes(start_server, connect, local):
+    (local / "up.bin").write_bytes(b"x" * 5000)
+    session = connect(start_server())
+    session.execute(["mkdir a", "rm missing", "ul up.bin"])
+
+    stats, = session.execute(["stats"])
+    prometheus, = session.execute(["stats --format=prometheus"])
+    usage, = session.execute(["stats --format=xml"])
+
+    text = "\n".join(stats.texts)
+    assert "bytes received 5000" in text
+    lines = "\n".join(prometheus.texts).splitlines()
+    assert 'fileserver_commands_total{command="mkdir",status="ok"} 1' in lines
+    assert 'fileserver_commands_total{command="rm",status="error"} 1' in lines
+    assert "fileserver_bytes_received_total 5000" in lines
+    assert usage.status == protocol.STATUS_INVALID
+
+
+def test_prometheus_endpoint_serves_the_metrics():
+    server_metrics = metrics.ServerMetrics()
+    server_metrics.observe_command("dl", 0.01, True)
+    http_server = metrics.serve_prometheus(server_metrics, 0)
+    try:
+        url = f"http://127.0.0.1:{http_server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            body = response.read().decode()
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
+
+    assert 'fileserver_commands_total{command="dl",status="ok"} 1' in body.splitlines()
+    assert 'fileserver_command_duration_seconds_count{command="dl"} 1' in body.splitlines()
+
+
+def test_rate_limit_filter_drops_repeated_messages():
+    rate_filter = metrics.RateLimitFilter(rate=2, interval=60)
+
+    def record(message):
+        return logging.LogRecord("fileserver", logging.ERROR, __file__, 1, message, (), None)
+
+    passed = [rate_filter.filter(record("same %s")) for _ in range(5)]
+
+    assert passed == [True, True, False, False, False]
+    assert rate_filter.filter(record("other %s"))
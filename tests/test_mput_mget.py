@@ -0,0 +1,91 @@
+import os
+
+import protocol
+
+
+def make_tree(base):
+    files = {}
+    for name in ("a.txt", "b.csv", "sub/c.txt", "sub/deeper/d.txt"):
+        path = base / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        files[name] = os.urandom(1000 + len(name))
+        path.write_bytes(files[name])
+    return files
+
+
+def test_mput_sends_files_and_directories_over_the_pool(start_server, connect, root, local):
+    files = make_tree(local)
+    session = connect(start_server(), connections=3)
+
+    result, = session.execute(["mput a.txt sub"])
+
+    assert result.ok, result.texts
+    assert result.message == f"Sent 3 files ({sum(len(files[name]) for name in files if name != 'b.csv')} bytes)"
+    for name in ("a.txt", "sub/c.txt", "sub/deeper/d.txt"):
+        assert (root / name).read_bytes() == files[name]
+    assert not (root / "b.csv").exists()
+
+
+def test_mget_fetches_patterns(start_server, connect, root, local):
+    files = make_tree(root)
+    session = connect(start_server(), connections=2)
+
+    result, = session.execute(["mget **/*.txt"])
+
+    assert result.ok, result.texts
+    for name in ("a.txt", "sub/c.txt", "sub/deeper/d.txt"):
+        assert (local / name).read_bytes() == files[name]
+    assert not (local / "b.csv").exists()
+
+
+def test_mget_list_returns_a_manifest(start_server, connect, root):
+    files = make_tree(root)
+    session = connect(start_server())
+
+    result, = session.pipeline(["mget --list *.csv sub"], session.client_socket)
+
+    assert result.ok
+    assert sorted("\n".join(result.texts).splitlines()) == sorted(
+        f"{len(files[name])} {name}" for name in ("b.csv", "sub/c.txt", "sub/deeper/d.txt"))
+
+
+def send_mput(session, files):
+    """
+    Sends an mput stream by hand: files is a list of (metadata, data) tuples.
+    :return: the Reply
+    """
+    request_id = session.send_command("mput", session.client_socket)
+    for metadata, data in files:
+        protocol.send_frame(session.client_socket, protocol.MSG_TRANSFER, protocol.encode_options(metadata), request_id)
+        protocol.send_frame(session.client_socket, protocol.MSG_DATA, data, request_id)
+        checksum = protocol.new_checksum()
+        checksum.update(data)
+        protocol.send_frame(session.client_socket, protocol.MSG_END, protocol.end_payload(checksum), request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_END, b"", request_id)
+    return session.receive_reply(session.client_socket, request_id)
+
+
+def test_mput_skips_a_file_with_an_unknown_codec(start_server, connect, root):
+    session = connect(start_server())
+
+    reply = send_mput(session, [({"name": "bad.bin", "codec": "bogus"}, b"x" * 100),
+                                ({"name": "good.bin"}, b"y" * 100)])
+
+    assert not reply.ok
+    assert reply.texts == ["bad.bin: Unknown compression codec 'bogus'"]
+    assert (root / "good.bin").read_bytes() == b"y" * 100
+    assert sorted(os.listdir(root)) == ["good.bin"]
+    assert session.execute(["pwd"])[0].ok
+
+
+def test_mput_refuses_names_outside_the_directory(start_server, connect, root):
+    (root / "inner").mkdir()
+    session = connect(start_server())
+    session.execute(["cd inner"])
+
+    reply = send_mput(session, [({"name": "../escaped.bin"}, b"x"), ({"name": "/abs.bin"}, b"x")])
+
+    assert not reply.ok
+    assert len(reply.texts[0].splitlines()) == 2
+    assert sorted(os.listdir(root)) == ["inner"]
+    assert os.listdir(root / "inner") == []
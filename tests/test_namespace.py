@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+import protocol
+import server
+
+
+@pytest.fixture
+def jail(tmp_path):
+    """
+    A served directory with a data/ sub directory, and a secret file next to it with links pointing to it.
+    """
+    (tmp_path / "root" / "data").mkdir(parents=True)
+    (tmp_path / "secret.txt").write_text("secret")
+    os.symlink(tmp_path / "secret.txt", tmp_path / "root" / "leak.txt")
+    os.symlink(tmp_path, tmp_path / "root" / "outside")
+    os.symlink(tmp_path / "root" / "data", tmp_path / "root" / "inside")
+    return tmp_path / "root"
+
+
+def test_virtual_paths_stay_below_the_root(jail):
+    namespace = server.Namespace(str(jail))
+    namespace.cwd = "/data"
+
+    assert namespace.virtual_path("") == "/data"
+    assert namespace.virtual_path("../data/./x/../y") == "/data/y"
+    assert namespace.virtual_path("/a//b") == "/a/b"
+    for name in ("../..", "/..", "../../etc/passwd"):
+        with pytest.raises(server.CommandError):
+            namespace.virtual_path(name)
+
+
+def test_symbolic_links_out_of_the_root_are_refused(jail):
+    namespace = server.Namespace(str(jail))
+
+    assert namespace.resolve("inside/x") == os.path.join(str(jail), "inside", "x")
+    for name in ("leak.txt", "outside", "outside/secret.txt"):
+        with pytest.raises(server.CommandError):
+            namespace.resolve(name)
+    # rm acts on the link itself, which is inside
+    assert namespace.resolve("leak.txt", follow_symlinks=False) == os.path.join(str(jail), "leak.txt")
+
+
+def test_sessions_cannot_leave_the_served_directory(start_server, connect, jail, local):
+    session = connect(start_server(root=str(jail)))
+    (local / "up.txt").write_text("x")
+
+    commands = ["cd ..", "cd /..", "cd outside", "dl leak.txt", "dl ../secret.txt", "info outside/secret.txt",
+                "mkdir ../made", "ul ../up.txt", "cp leak.txt copy.txt", "mv /data ../moved", "du outside",
+                "find ../.."]
+    results = session.execute(commands)
+
+    assert [result.command for result in results if result.ok] == []
+    assert all(result.status == protocol.STATUS_INVALID for result in results if result.command != "ul ../up.txt")
+    assert not {"made", "moved", "up.txt"} & set(os.listdir(jail.parent))
+    assert sorted(os.listdir(jail)) == ["data", "inside", "leak.txt", "outside"]
+    assert not (local / "leak.txt").exists()
+    assert session.execute(["pwd"])[0].texts == ["/"]
+
+
+def test_absolute_names_start_at_the_root(start_server, connect, jail):
+    (jail / "data" / "file.txt").write_text("content")
+    session = connect(start_server(root=str(jail)))
+
+    moved, found = session.execute(["cd /data", "info /data/file.txt"])
+    pwd, = session.execute(["pwd"])
+
+    assert moved.ok and found.ok
+    assert pwd.texts == ["/data"]
@@ -0,0 +1,44 @@
+import os
+import time
+
+
+def test_pipelined_replies_come_back_in_order(engine, start_server, connect, root):
+    session = connect(start_server(engine=engine))
+    commands = []
+    for index in range(100):
+        commands += [f"mkdir d{index}", f"info d{index}", f"rm d{index}"]
+    commands.append("info d0")
+
+    replies = session.pipeline(commands, session.client_socket)
+
+    assert [reply.request_id for reply in replies] == sorted(reply.request_id for reply in replies)
+    assert all(reply.ok for reply in replies[:-1])
+    assert not replies[-1].ok
+    assert os.listdir(root) == []
+
+
+def test_pipelined_uploads_and_downloads(engine, start_server, connect, root, local):
+    session = connect(start_server(engine=engine))
+    for index in range(20):
+        (local / f"up{index}.txt").write_bytes(os.urandom(1000 + index))
+        (root / f"down{index}.txt").write_bytes(os.urandom(2000 + index))
+    commands = [f"ul up{index}.txt" for index in range(20)] + [f"dl down{index}.txt" for index in range(20)]
+
+    replies = session.pipeline(commands, session.client_socket)
+
+    assert all(reply.ok for reply in replies)
+    for index in range(20):
+        assert (root / f"up{index}.txt").read_bytes() == (local / f"up{index}.txt").read_bytes()
+        assert (local / f"down{index}.txt").read_bytes() == (root / f"down{index}.txt").read_bytes()
+
+
+def test_an_idle_session_does_not_hold_a_worker(engine, start_server, connect):
+    # after each command a select engine worker looks for more pipelined input, it must not wait for it
+    running_server = start_server(engine=engine, workers=1)
+    idle, busy = connect(running_server), connect(running_server)
+    assert idle.execute(["pwd"])[0].ok
+
+    started = time.monotonic()
+    for _ in range(5):
+        assert busy.execute(["pwd"])[0].ok
+    assert time.monotonic() - started < 5
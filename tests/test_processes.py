@@ -0,0 +1,91 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+import client
+import protocol
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs fork() and /proc")
+
+
+def free_ports(count):
+    probes = [socket.socket() for _ in range(count)]
+    try:
+        for probe in probes:
+            probe.bind(("127.0.0.1", 0))
+        return [probe.getsockname()[1] for probe in probes]
+    finally:
+        for probe in probes:
+            probe.close()
+
+
+def children(pid):
+    pids = []
+    for entry in os.listdir("/proc"):
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # state, then the parent pid; exited workers not reaped yet are zombies
+        if int(fields[1]) == pid and fields[0] != "Z":
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def metrics_answer(port):
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=2) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+
+def wait_for(condition, timeout=15):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def test_sighup_replaces_every_worker(tmp_path):
+    port, metrics_port, _ = free_ports(3)
+    with open(tmp_path / "server.log", "wb") as log:
+        supervisor = subprocess.Popen([sys.executable, SERVER, "--port", str(port), "--processes", "2",
+                                       "--metrics-port", str(metrics_port), "--root", str(tmp_path)],
+                                      stdout=log, stderr=subprocess.STDOUT)
+    session = client.Client("127.0.0.1", port, listing="never", verbose=False, compression="none")
+    try:
+        assert wait_for(lambda: len(children(supervisor.pid)) == 2 and metrics_answer(metrics_port)
+                        and metrics_answer(metrics_port + 1))
+        first_workers = children(supervisor.pid)
+        # an upload in progress keeps its worker draining after the SIGHUP
+        session.connect()
+        request_id = session.send_command("ul stalled.bin", session.client_socket)
+        protocol.send_frame(session.client_socket, protocol.MSG_TRANSFER, protocol.encode_options({"size": 1000}),
+                            request_id)
+        protocol.send_frame(session.client_socket, protocol.MSG_DATA, b"x" * 10, request_id)
+        assert wait_for(lambda: (tmp_path / ".stalled.bin.part").exists())
+
+        supervisor.send_signal(signal.SIGHUP)
+
+        def replaced():
+            new_workers = set(children(supervisor.pid)) - set(first_workers)
+            return len(new_workers) == 2 and metrics_answer(metrics_port) and metrics_answer(metrics_port + 1)
+
+        assert wait_for(replaced), (tmp_path / "server.log").read_text()
+    finally:
+        session.close()
+        supervisor.terminate()
+        supervisor.wait(timeout=30)
+    assert supervisor.returncode == 0
@@ -0,0 +1,74 @@
+import socket
+
+import pytest
+
+import client
+import protocol
+
+
+@pytest.fixture
+def pair():
+    sender, receiver = socket.socketpair()
+    receiver.settimeout(10)
+    with sender, receiver:
+        yield sender, receiver
+
+
+def test_frames_keep_their_boundaries_and_request_ids(pair):
+    sender, receiver = pair
+    large = bytes(range(256)) * 100
+    protocol.send_frame(sender, protocol.MSG_TEXT, b"first", 7)
+    protocol.send_frame(sender, protocol.MSG_DATA, large, 8)
+    protocol.send_frame(sender, protocol.MSG_END, b"", 8)
+
+    assert protocol.receive_frame(receiver) == (protocol.MSG_TEXT, 7, b"first")
+    assert protocol.receive_frame(receiver) == (protocol.MSG_DATA, 8, large)
+    assert protocol.receive_frame(receiver) == (protocol.MSG_END, 8, b"")
+
+
+def test_status_round_trip(pair):
+    sender, receiver = pair
+    protocol.send_status(sender, protocol.STATUS_ERROR, "File 'x' not found", 3)
+
+    msg_type, request_id, payload = protocol.receive_frame(receiver)
+
+    assert (msg_type, request_id) == (protocol.MSG_STATUS, 3)
+    assert protocol.decode_status(payload) == (protocol.STATUS_ERROR, "File 'x' not found")
+
+
+def test_oversized_payload_is_refused(pair):
+    sender, receiver = pair
+    sender.sendall(protocol.HEADER.pack(protocol.PROTOCOL_VERSION, protocol.MSG_TEXT, 1,
+                                        protocol.MAX_MESSAGE_SIZE + 1))
+
+    with pytest.raises(protocol.ProtocolError):
+        protocol.receive_frame(receiver)
+
+
+def test_unknown_version_is_refused(pair):
+    sender, receiver = pair
+    sender.sendall(protocol.HEADER.pack(99, protocol.MSG_TEXT, 1, 0))
+
+    with pytest.raises(protocol.ProtocolError):
+        protocol.receive_frame(receiver)
+
+
+def test_closed_connection_is_reported(pair):
+    sender, receiver = pair
+    sender.sendall(protocol.HEADER.pack(protocol.PROTOCOL_VERSION, protocol.MSG_TEXT, 1, 10) + b"short")
+    sender.close()
+
+    with pytest.raises(ConnectionError):
+        protocol.receive_frame(receiver)
+
+
+def test_handshake_without_common_version_is_refused(start_server):
+    running_server = start_server()
+    with socket.create_connection(("127.0.0.1", running_server.port), timeout=10) as active_socket:
+        eof_token = bytearray(client.EOF_TOKEN_LENGTH)
+        protocol.receive_into(active_socket, eof_token)
+        active_socket.sendall(b"hello versions=1" + eof_token)
+
+        reply = active_socket.recv(1024)
+
+    assert reply.startswith(b"unsupported versions=")
@@ -0,0 +1,107 @@
+import os
+import time
+
+import protocol
+
+
+def test_ranged_dl_writes_in_place(start_server, connect, root, local):
+    content = os.urandom(100_000)
+    (root / "data.bin").write_bytes(content)
+    (local / "data.bin").write_bytes(b"\0" * len(content))
+    session = connect(start_server())
+
+    first, second = session.execute(["dl --offset=0 --length=1000 data.bin", "dl --offset=50000 data.bin"])
+
+    assert first.ok and second.ok
+    assert (local / "data.bin").read_bytes() == content[:1000] + b"\0" * 49_000 + content[50_000:]
+
+
+def test_range_beyond_the_end_is_invalid(start_server, connect, root):
+    (root / "data.bin").write_bytes(b"x" * 100)
+    session = connect(start_server())
+
+    result, = session.execute(["dl --offset=200 data.bin"])
+
+    assert result.status == protocol.STATUS_INVALID
+
+
+def test_dl_resumes_from_the_partial_file(start_server, connect, root, local):
+    content = os.urandom(300_000)
+    (root / "data.bin").write_bytes(content)
+    (local / ".data.bin.part").write_bytes(content[:120_000])
+    running_server = start_server(file_cache_size=0)
+    session = connect(running_server)
+
+    reply = session.download_file("dl data.bin", session.client_socket)
+
+    assert reply.ok, reply.message
+    assert (local / "data.bin").read_bytes() == content
+    assert not (local / ".data.bin.part").exists()
+    assert sum(totals[1] for totals in running_server.transfer_stats.totals.values()) == 180_000
+
+
+def test_dl_starts_over_when_the_server_file_shrank(start_server, connect, root, local):
+    (root / "data.bin").write_bytes(b"new")
+    (local / ".data.bin.part").write_bytes(b"old content that is longer")
+    session = connect(start_server())
+
+    reply = session.download_file("dl data.bin", session.client_socket)
+
+    assert reply.ok, reply.message
+    assert (local / "data.bin").read_bytes() == b"new"
+
+
+def test_ul_resumes_from_the_partial_upload(start_server, connect, root, local):
+    content = os.urandom(300_000)
+    (local / "data.bin").write_bytes(content)
+    (root / ".data.bin.part").write_bytes(content[:100_000])
+    running_server = start_server()
+    session = connect(running_server)
+    assert session.partial_upload_size("data.bin", session.client_socket) == 100_000
+
+    session.issue_ul("ul data.bin", session.client_socket)
+
+    assert (root / "data.bin").read_bytes() == content
+    assert not (root / ".data.bin.part").exists()
+    assert running_server.metrics.bytes_received == 200_000
+
+
+def test_ul_at_a_wrong_offset_is_refused(start_server, connect, root, local):
+    (local / "data.bin").write_bytes(b"x" * 1000)
+    session = connect(start_server())
+
+    result, = session.execute(["ul --offset=99 data.bin"])
+
+    assert not result.ok
+    assert not (root / "data.bin").exists()
+
+
+def test_interrupted_ul_keeps_the_old_file(start_server, connect, root):
+    (root / "data.bin").write_bytes(b"old")
+    running_server = start_server()
+    session = connect(running_server)
+    request_id = session.send_command("ul data.bin", session.client_socket)
+    protocol.send_frame(session.client_socket, protocol.MSG_TRANSFER, protocol.encode_options({"size": 1000}),
+                        request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_DATA, b"n" * 400, request_id)
+    session.client_socket.close()
+    session.client_socket = None
+    deadline = time.monotonic() + 10
+    # the part file exists once the command runs, the session ends when the server notices the closed connection
+    while (running_server.sessions or not (root / ".data.bin.part").exists()) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert (root / "data.bin").read_bytes() == b"old"
+    assert (root / ".data.bin.part").read_bytes() == b"n" * 400
+
+
+def test_info_on_a_name_with_a_space(start_server, connect, root):
+    (root / "a b.bin").write_bytes(b"x" * 1000)
+    (root / "a_b.bin").write_bytes(b"y")
+    (root / ".a b.bin.part").write_bytes(b"x" * 10)
+    session = connect(start_server())
+
+    info, = session.execute(["info a b.bin"])
+
+    assert info.texts[0] == "Size of a b.bin: 1000 bytes"
+    assert "Partial upload of a b.bin: 10 bytes" in info.texts
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+import pytest
+
+import protocol
+import shaping
+
+
+def test_token_bucket_queues_reservations_behind_each_other():
+    assert shaping.TokenBucket(0).reserve(10 ** 9) == 0
+    bucket = shaping.TokenBucket(1_000_000)
+
+    assert bucket.reserve(int(bucket.capacity)) == 0
+    assert bucket.reserve(100_000) == pytest.approx(0.1, abs=0.02)
+    assert bucket.reserve(100_000) == pytest.approx(0.2, abs=0.02)
+
+
+def test_token_bucket_rate_can_change():
+    bucket = shaping.TokenBucket(1_000_000)
+    bucket.reserve(int(bucket.capacity))
+
+    bucket.set_rate(0)
+
+    assert bucket.reserve(10 ** 9) == 0
+
+
+def test_transfer_slots_serve_in_arrival_order():
+    slots = shaping.TransferSlots(1)
+    slots.acquire()
+    order = []
+    queued = []
+
+    def transfer(number):
+        slots.acquire(queued.append)
+        order.append(number)
+        slots.release()
+
+    threads = []
+    for number in range(3):
+        threads.append(threading.Thread(target=transfer, args=(number,)))
+        threads[-1].start()
+        while slots.waiting <= number:
+            time.sleep(0.001)
+    assert order == []
+
+    slots.release()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order == [0, 1, 2]
+    assert queued == [1, 1, 1, -1, -1, -1]
+    assert slots.active == 0
+
+
+def test_raising_the_transfer_cap_lets_waiting_transfers_start():
+    slots = shaping.TransferSlots(1)
+    slots.acquire()
+    waiter = threading.Thread(target=slots.acquire)
+    waiter.start()
+    while not slots.waiting:
+        time.sleep(0.001)
+
+    slots.set_limit(2)
+    waiter.join(timeout=5)
+
+    assert not waiter.is_alive()
+    assert slots.active == 2
+
+
+def test_session_rate_limit_slows_a_download_down(start_server, connect, root, local):
+    content = os.urandom(600_000)
+    (root / "data.bin").write_bytes(content)
+    running_server = start_server(session_rate_limit=1_000_000, file_cache_size=0)
+    session = connect(running_server)
+
+    started = time.monotonic()
+    result, = session.execute(["dl data.bin"])
+    elapsed = time.monotonic() - started
+
+    assert result.ok
+    assert (local / "data.bin").read_bytes() == content
+    # the burst of the bucket goes out at once, the rest at the rate
+    assert elapsed >= (len(content) - shaping.BURST_SECONDS * 1_000_000) / 1_000_000 * 0.9
+    assert running_server.metrics.throttled_seconds > 0
+
+
+def test_limits_command_changes_the_limits(start_server, connect):
+    session = connect(start_server(rate_limit=1000))
+
+    changed, = session.execute(["limits --rate=0 --session-rate=5000 --transfers=2"])
+    usage, = session.execute(["limits --rate=-1"])
+
+    assert changed.texts == ["rate unlimited, session rate 5000 bytes/s, transfers 0 running, 0 waiting, max 2"]
+    assert usage.status == protocol.STATUS_INVALID
+
+
+def test_transfers_beyond_the_cap_wait_for_a_slot(start_server, connect, root, local):
+    (root / "data.bin").write_bytes(b"x" * 1000)
+    running_server = start_server(max_transfers=1)
+    uploading = connect(running_server)
+    downloading = connect(running_server)
+    request_id = uploading.send_command("ul up.bin", uploading.client_socket)
+    protocol.send_frame(uploading.client_socket, protocol.MSG_TRANSFER, protocol.encode_options({"size": 10}),
+                        request_id)
+    while running_server.limits.slots.active != 1:
+        time.sleep(0.01)
+
+    results = []
+    waiting = threading.Thread(target=lambda: results.extend(downloading.execute(["dl data.bin"])))
+    waiting.start()
+    while running_server.limits.slots.waiting != 1:
+        time.sleep(0.01)
+    assert not results
+
+    protocol.send_frame(uploading.client_socket, protocol.MSG_DATA, b"u" * 10, request_id)
+    checksum = protocol.new_checksum()
+    checksum.update(b"u" * 10)
+    protocol.send_frame(uploading.client_socket, protocol.MSG_END, protocol.end_payload(checksum), request_id)
+    assert uploading.receive_reply(uploading.client_socket, request_id).ok
+    waiting.join(timeout=10)
+
+    assert results[0].ok
+    assert (local / "data.bin").read_bytes() == b"x" * 1000
+    assert running_server.metrics.queued_seconds > 0
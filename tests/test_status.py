@@ -0,0 +1,42 @@
+import protocol
+
+
+def test_every_reply_carries_a_status(start_server, connect):
+    session = connect(start_server())
+
+    made, failed, invalid = session.execute(["mkdir a", "rm missing", "bogus"])
+
+    assert (made.status, made.message) == (protocol.STATUS_OK, "ok")
+    assert failed.status == protocol.STATUS_ERROR
+    assert invalid.status == protocol.STATUS_INVALID
+    assert invalid.message.startswith("Invalid command")
+
+
+def test_listing_mode_is_negotiated(start_server, connect):
+    running_server = start_server()
+    quiet = connect(running_server, listing="never")
+    chatty = connect(running_server, listing="always")
+
+    assert quiet.execute(["mkdir a"])[0].listing is None
+    assert chatty.execute(["mkdir b"])[0].listing.startswith("Current Directory: /:")
+
+
+def test_listing_can_be_asked_for_per_command(start_server, connect):
+    session = connect(start_server(), listing="never")
+
+    asked, = session.execute(["mkdir --listing=always a"])
+
+    assert asked.ok
+    assert "-- a" in asked.listing.splitlines()
+
+
+def test_ls_pages_and_filters(start_server, connect, root):
+    for name in ("a.txt", "b.txt", "c.csv", "d.txt"):
+        (root / name).write_text(name)
+    session = connect(start_server())
+
+    page, = session.execute(["ls --offset=1 --limit=2 *.txt"])
+    usages = session.execute(["ls --limit=x", "ls --limit=-1"])
+
+    assert page.listing.splitlines()[-3:] == ["-- b.txt", "-- d.txt", "... 1 of 3 entries not shown"]
+    assert [usage.status for usage in usages] == [protocol.STATUS_INVALID] * 2
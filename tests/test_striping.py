@@ -0,0 +1,122 @@
+import hashlib
+import os
+import threading
+
+import pytest
+
+import client
+import protocol
+
+# small ranges, so that a file of a few hundred KiB is striped
+STRIPE_SIZE = 64 * 1024
+
+
+@pytest.fixture(autouse=True)
+def small_stripes(monkeypatch):
+    monkeypatch.setattr(client, "STRIPE_SIZE", STRIPE_SIZE)
+
+
+@pytest.fixture
+def big_file(root):
+    content = os.urandom(20 * STRIPE_SIZE + 123)
+    (root / "big.bin").write_bytes(content)
+    return content
+
+
+@pytest.mark.parametrize("stripes", ["3", "auto"])
+def test_striped_download_rebuilds_the_file(start_server, connect, local, big_file, stripes, monkeypatch):
+    session = connect(start_server(), connections=4)
+    sent = []
+    send_command = session.send_command
+
+    def record(command, client_socket):
+        sent.append(command)
+        return send_command(command, client_socket)
+
+    monkeypatch.setattr(session, "send_command", record)
+
+    result, = session.execute([f"dl --stripes={stripes} big.bin"])
+
+    assert result.ok, result.message
+    assert (local / "big.bin").read_bytes() == big_file
+    assert os.listdir(local) == ["big.bin"]
+    assert session.transfer_stats.totals["striped"][1] == len(big_file)
+    # the first download of the file: the server has no checksum cached and computes one
+    assert "info --checksum big.bin" in sent
+
+
+def test_small_files_are_not_striped(start_server, connect, root, local):
+    (root / "small.bin").write_bytes(b"x" * STRIPE_SIZE)
+    session = connect(start_server(), connections=4)
+
+    result, = session.execute(["dl --stripes=3 small.bin"])
+
+    assert result.ok
+    assert (local / "small.bin").read_bytes() == b"x" * STRIPE_SIZE
+    assert "striped" not in session.transfer_stats.totals
+
+
+def test_a_corrupted_range_is_fetched_again(start_server, connect, local, big_file, monkeypatch):
+    new_checksum = protocol.new_checksum
+    corrupted = []
+
+    def corrupt_once():
+        # the streams run on the client's executor threads, the server's threads keep the real checksum
+        if threading.current_thread().name.startswith("ThreadPoolExecutor") and not corrupted:
+            corrupted.append(True)
+            return hashlib.blake2b(b"corrupted", digest_size=protocol.CHECKSUM_SIZE)
+        return new_checksum()
+
+    monkeypatch.setattr(protocol, "new_checksum", corrupt_once)
+    session = connect(start_server(), connections=4)
+
+    result, = session.execute(["dl --stripes=3 big.bin"])
+
+    assert corrupted
+    assert result.ok, result.message
+    assert (local / "big.bin").read_bytes() == big_file
+
+
+def test_a_file_that_does_not_match_its_checksum_is_thrown_away(start_server, connect, local, big_file, monkeypatch):
+    file_checksum = protocol.file_checksum
+
+    def wrong_checksum(file, *args):
+        if threading.current_thread() is threading.main_thread():
+            return "0" * 2 * protocol.CHECKSUM_SIZE
+        return file_checksum(file, *args)
+
+    monkeypatch.setattr(protocol, "file_checksum", wrong_checksum)
+    session = connect(start_server(), connections=4, checksums=False)
+
+    result, = session.execute(["dl --stripes=3 big.bin"])
+
+    assert not result.ok
+    assert "did not match its checksum" in result.message
+    assert os.listdir(local) == []
+
+
+@pytest.mark.parametrize("name", ["big.bin", "small.bin"])
+def test_download_into_a_missing_local_directory(start_server, connect, root, local, big_file, name):
+    (root / "x").mkdir()
+    (root / "big.bin").rename(root / "x" / "big.bin")
+    (root / "x" / "small.bin").write_bytes(b"small")
+    session = connect(start_server(), connections=4)
+
+    result, = session.execute([f"dl --stripes=3 x/{name}"])
+
+    assert not result.ok
+    assert os.listdir(local) == []
+    assert session.execute(["pwd"])[0].ok
+
+
+def test_striped_download_of_a_name_with_a_space(start_server, connect, root, local, big_file):
+    (root / "big.bin").rename(root / "a b.bin")
+    session = connect(start_server(), connections=4)
+
+    info, result = session.execute(["info --checksum a b.bin", "dl --stripes=3 a b.bin"])
+
+    assert info.ok, info.message
+    assert f"Size of a b.bin: {len(big_file)} bytes" in info.texts[0]
+    assert result.ok, result.message
+    assert (local / "a b.bin").read_bytes() == big_file
+    assert session.transfer_stats.totals["striped"][1] == len(big_file)
@@ -0,0 +1,98 @@
+import os
+import socket
+import threading
+
+import pytest
+
+import protocol
+
+
+def read_transfer(active_socket):
+    """
+    :return: the MSG_DATA payloads of one transfer read off the socket, up to its MSG_END frame
+    """
+    msg_type, _, _ = protocol.receive_frame(active_socket)
+    assert msg_type == protocol.MSG_TRANSFER
+    payloads = []
+    while True:
+        msg_type, _, payload = protocol.receive_frame(active_socket)
+        if msg_type == protocol.MSG_END:
+            return payloads
+        assert msg_type == protocol.MSG_DATA
+        payloads.append(payload)
+
+
+def test_send_file_streams_bounded_chunks(tmp_path):
+    content = os.urandom(5 * protocol.CHUNK_SIZE + 123)
+    path = tmp_path / "data.bin"
+    path.write_bytes(content)
+    sender, receiver = socket.socketpair()
+    with sender, receiver, open(path, "rb") as file:
+        # the socket buffer is smaller than the file, so the transfer is read while it is sent
+        receiver.settimeout(10)
+        payloads = []
+        reader = threading.Thread(target=lambda: payloads.extend(read_transfer(receiver)))
+        reader.start()
+        sent = protocol.send_file(sender, file, 1, len(content))
+        reader.join()
+
+    assert sent == len(content)
+    assert all(len(payload) <= protocol.CHUNK_SIZE for payload in payloads)
+    assert b"".join(payloads) == content
+
+
+def test_ul_and_dl_round_trip(start_server, connect, root, local):
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    (local / "up.bin").write_bytes(content)
+    session = connect(start_server())
+
+    upload, = session.execute(["ul up.bin"])
+    assert upload.ok, upload.message
+    assert (root / "up.bin").read_bytes() == content
+
+    (root / "down.bin").write_bytes(content[::-1])
+    download, = session.execute(["dl down.bin"])
+    assert download.ok, download.message
+    assert (local / "down.bin").read_bytes() == content[::-1]
+
+
+def test_dl_of_missing_file_fails(start_server, connect, local):
+    session = connect(start_server())
+
+    result, = session.execute(["dl missing.bin"])
+
+    assert not result.ok
+    assert not (local / "missing.bin").exists()
+
+
+@pytest.mark.parametrize("use_sendfile, server_path", [(True, "sendfile"), (False, "buffered")])
+@pytest.mark.parametrize("use_mmap, client_path", [(True, "mmap"), (False, "buffered")])
+def test_dl_paths(start_server, connect, root, local, use_sendfile, server_path, use_mmap, client_path):
+    content = os.urandom(2 * protocol.SENDFILE_CHUNK_SIZE + 5)
+    (root / "big.bin").write_bytes(content)
+    running_server = start_server(use_sendfile=use_sendfile, file_cache_size=0)
+    # checksummed downloads hash the file while sending it, which sendfile() cannot
+    session = connect(running_server, checksums=False)
+    session.use_mmap = use_mmap
+
+    result, = session.execute(["dl big.bin"])
+
+    assert result.ok, result.message
+    assert (local / "big.bin").read_bytes() == content
+    assert list(running_server.transfer_stats.totals) == [server_path]
+    assert list(session.transfer_stats.totals) == [client_path]
+
+
+def test_mapped_receive_writes_a_range_in_place(tmp_path):
+    path = tmp_path / "target.bin"
+    path.write_bytes(b"a" * 100)
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        receiver.settimeout(10)
+        protocol.send_frame(sender, protocol.MSG_DATA, b"b" * 10, 5)
+        protocol.send_frame(sender, protocol.MSG_END, b"", 5)
+        with open(path, "rb+") as file:
+            received = protocol.receive_file_data_mapped(receiver, file, 10, 5, offset=95)
+
+    assert received == 10
+    assert path.read_bytes() == b"a" * 95 + b"b" * 10
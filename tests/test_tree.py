@@ -0,0 +1,146 @@
+import io
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import protocol
+import tree
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(4) as pool:
+        yield pool
+
+
+def make_tree(base):
+    files = {"a.txt": b"a" * 10, "sub/b.csv": b"b" * 20, "sub/deeper/c.txt": b"c" * 30, "other/d.txt": b"d" * 40}
+    for name, content in files.items():
+        path = base / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    (base / "empty").mkdir()
+    return files
+
+
+def read_tree(base):
+    return {path.relative_to(base).as_posix(): path.read_bytes() for path in base.rglob("*") if path.is_file()}
+
+
+def test_disk_usage_adds_up_the_tree(tmp_path, executor):
+    make_tree(tmp_path)
+
+    totals, children = tree.disk_usage(str(tmp_path), executor)
+
+    assert totals == [100, 4, 4]
+    assert children == {"sub": [50, 2, 1], "other": [40, 1, 0], "empty": [0, 0, 0]}
+
+
+def test_find_filters_by_name_and_kind(tmp_path, executor):
+    make_tree(tmp_path)
+    os.symlink(tmp_path / "sub", tmp_path / "link")
+
+    assert sorted(tree.find(str(tmp_path), executor, "*.txt")) == ["a.txt", "other/d.txt", "sub/deeper/c.txt"]
+    assert sorted(tree.find(str(tmp_path), executor, kind="d")) == ["empty/", "other/", "sub/", "sub/deeper/"]
+
+
+def test_copy_tree_copies_files_and_directories(tmp_path, executor):
+    files = make_tree(tmp_path / "source")
+
+    copied, size, errors = tree.copy_tree(str(tmp_path / "source"), str(tmp_path / "copy"), executor)
+
+    assert (copied, size, errors) == (4, 100, [])
+    assert read_tree(tmp_path / "copy") == files
+    assert (tmp_path / "copy" / "empty").is_dir()
+
+
+def test_extract_member_refuses_to_leave_the_destination(tmp_path):
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "destination").mkdir()
+    os.symlink(tmp_path / "outside", tmp_path / "destination" / "link")
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as archive:
+        for name in ("../escaped.txt", "link/escaped.txt"):
+            member = tarfile.TarInfo(name)
+            member.size = 1
+            archive.addfile(member, io.BytesIO(b"x"))
+    buffer.seek(0)
+
+    with tarfile.open(fileobj=buffer, mode="r") as archive:
+        for member in archive.getmembers():
+            with pytest.raises(ValueError):
+                tree.extract_member(archive, member, str(tmp_path / "destination"), set())
+
+    assert os.listdir(tmp_path / "outside") == []
+    assert not (tmp_path / "escaped.txt").exists()
+
+
+def test_extract_member_refuses_an_excluded_directory(tmp_path):
+    excluded = os.path.join(os.path.realpath(tmp_path), ".store")
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as archive:
+        for name in (".store", ".store/objects/x"):
+            member = tarfile.TarInfo(name)
+            member.type = tarfile.DIRTYPE if name == ".store" else tarfile.REGTYPE
+            member.size = 0 if name == ".store" else 1
+            archive.addfile(member, io.BytesIO(b"x"))
+    buffer.seek(0)
+
+    with tarfile.open(fileobj=buffer, mode="r") as archive:
+        for member in archive.getmembers():
+            with pytest.raises(ValueError):
+                tree.extract_member(archive, member, str(tmp_path), set(), {excluded})
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_du_find_and_cp_commands(start_server, connect, root):
+    files = make_tree(root)
+    session = connect(start_server())
+
+    du, summary, found, copied, again = session.execute(
+        ["du", "du --summary sub", "find --name=*.txt --type=f", "cp -r sub copy", "cp -r sub copy"])
+
+    assert "\n".join(du.texts).splitlines() == ["0 empty/", "40 other/", "50 sub/",
+                                                "100 total (4 files, 4 directories)"]
+    assert summary.texts == ["50 total (2 files, 1 directories)"]
+    assert sorted("\n".join(found.texts).splitlines()) == ["a.txt", "other/d.txt", "sub/deeper/c.txt"]
+    # like in a shell: the first copy creates copy/, the second one lands in it
+    sub_files = {name[4:]: content for name, content in files.items() if name.startswith("sub/")}
+    assert copied.ok and again.ok
+    assert read_tree(root / "copy") == {**sub_files, **{f"sub/{name}": content for name, content in sub_files.items()}}
+    assert session.execute(["cp -r sub sub/deeper"])[0].message == "Cannot copy 'sub' into itself"
+    assert session.execute(["find --type=x"])[0].status == protocol.STATUS_INVALID
+
+
+def test_recursive_dl_and_ul_round_trip(start_server, connect, root, local):
+    files = make_tree(root / "tree")
+    session = connect(start_server())
+
+    downloaded, = session.execute(["dl -r tree"])
+    assert downloaded.ok, downloaded.texts
+    assert read_tree(local / "tree") == files
+
+    (local / "tree" / "sub" / "new.txt").write_bytes(b"new")
+    os.rename(local / "tree", local / "copy")
+    uploaded, = session.execute(["ul -r copy"])
+    assert uploaded.ok, uploaded.texts
+    assert read_tree(root / "copy") == {**files, "sub/new.txt": b"new"}
+
+
+def test_ul_r_with_an_unknown_codec_is_refused(start_server, connect, root):
+    session = connect(start_server())
+    request_id = session.send_command("ul -r tree", session.client_socket)
+    metadata = {"archive": "tar", "name": "tree", "codec": "bogus"}
+    protocol.send_frame(session.client_socket, protocol.MSG_TRANSFER, protocol.encode_options(metadata), request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_DATA, b"x" * 100, request_id)
+    protocol.send_frame(session.client_socket, protocol.MSG_END, b"", request_id)
+
+    reply = session.receive_reply(session.client_socket, request_id)
+
+    assert reply.status == protocol.STATUS_INVALID
+    assert reply.message == "Unknown compression codec 'bogus'"
+    assert os.listdir(root) == []
+    assert session.execute(["pwd"])[0].ok
@@ -0,0 +1,318 @@
+"""
+Recursive directory operations for du, find, cp -r and the tar streams of dl -r / ul -r.
+
+Trees are walked breadth first with os.scandir(). The scans of the next directories run ahead on a thread pool
+while the caller processes the current one, so a tree with millions of entries is read with many directory reads
+in flight instead of one stat() round trip at a time. Symbolic links are never followed; archives and copies hold
+directories and regular files only, anything else is reported as skipped. The paths in `exclude` (the server's
+hidden directories, see server.Namespace) are left out of every walk and refused as archive members.
+"""
+
+import fnmatch
+import os
+import shutil
+import tarfile
+from collections import deque, namedtuple
+
+import protocol
+
+# directories scanned ahead of the one the caller is processing
+WALK_PREFETCH = 64
+
+# file copies of cp -r running at once
+COPY_PREFETCH = 32
+
+# threads of the pool the scans and copies run on
+WORKERS = 8
+
+
+class Directory(namedtuple("Directory", "path files directories others error")):
+    """
+    One scanned directory: its '/' separated path relative to the root of the walk ('' for the root), lists of
+    (name, os.stat_result) for its regular files and sub directories, the names of other entries (links, devices,
+    entries that vanished) and the OSError if it could not be read.
+    """
+
+
+def scan(root, relative, exclude=frozenset()):
+    path = os.path.join(root, relative) if relative else root
+    files, directories, others = [], [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.path in exclude:
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append((entry.name, entry.stat(follow_symlinks=False)))
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append((entry.name, entry.stat(follow_symlinks=False)))
+                    else:
+                        others.append(entry.name)
+                except OSError:
+                    others.append(entry.name)
+    except OSError as e:
+        return Directory(relative, [], [], [], e)
+    files.sort()
+    directories.sort()
+    return Directory(relative, files, directories, others, None)
+
+
+def walk(root, executor, prefetch=WALK_PREFETCH, exclude=frozenset()):
+    """
+    Walks a directory tree breadth first, in the same order every time.
+    :param root: the directory to walk
+    :param executor: the thread pool the directories are scanned on
+    :param prefetch: maximum number of directories scanned ahead
+    :param exclude: set of absolute paths of entries to leave out, with everything below them
+    :return: generator of Directory tuples, the root first
+    :raises OSError: if root itself cannot be read
+    """
+
+    waiting = deque([""])
+    scanning = deque()
+    while waiting or scanning:
+        while waiting and len(scanning) < prefetch:
+            scanning.append(executor.submit(scan, root, waiting.popleft(), exclude))
+        directory = scanning.popleft().result()
+        if directory.error is not None and not directory.path:
+            raise directory.error
+        waiting.extend(f"{directory.path}/{name}" if directory.path else name for name, _ in directory.directories)
+        yield directory
+
+
+def disk_usage(root, executor, exclude=frozenset()):
+    """
+    Adds up the apparent size of the files in a tree.
+    :return: tuple of (totals, dict of top level directory name -> totals), totals being [bytes, files, directories]
+    """
+
+    totals = [0, 0, 0]
+    children = {}
+    for directory in walk(root, executor, exclude=exclude):
+        size = sum(stat_result.st_size for _, stat_result in directory.files)
+        counts = (size, len(directory.files), len(directory.directories))
+        targets = [totals]
+        if directory.path:
+            targets.append(children[directory.path.split("/", 1)[0]])
+        else:
+            for name, _ in directory.directories:
+                children[name] = [0, 0, 0]
+        for target in targets:
+            for index, count in enumerate(counts):
+                target[index] += count
+    return totals, children
+
+
+def find(root, executor, pattern=None, kind=None, exclude=frozenset()):
+    """
+    :param pattern: shell-style pattern the names must match, e.g. '*.csv', None for all entries
+    :param kind: 'f' for files only, 'd' for directories only, None for both
+    :return: generator of the '/' separated paths relative to root, directories with a trailing '/'
+    """
+
+    for directory in walk(root, executor, exclude=exclude):
+        prefix = f"{directory.path}/" if directory.path else ""
+        if kind != "f":
+            yield from (f"{prefix}{name}/" for name, _ in directory.directories
+                        if pattern is None or fnmatch.fnmatch(name, pattern))
+        if kind != "d":
+            yield from (f"{prefix}{name}" for name, _ in directory.files
+                        if pattern is None or fnmatch.fnmatch(name, pattern))
+
+
+def copy_tree(source, destination, executor, exclude=frozenset()):
+    """
+    Copies a tree like cp -r: the directories are created in walk order and the files are copied on the executor,
+    with their modification times.
+    :param source: the directory to copy
+    :param destination: the new directory, it must not exist yet
+    :return: tuple of (files copied, bytes copied, list of errors)
+    """
+
+    errors = []
+    copying = deque()
+    copied_files = copied_bytes = 0
+
+    def finish_copy():
+        nonlocal copied_files, copied_bytes
+        name, size, future = copying.popleft()
+        try:
+            future.result()
+            copied_files += 1
+            copied_bytes += size
+        except OSError as e:
+            errors.append(f"{name}: {e.strerror}")
+
+    os.mkdir(destination)
+    for directory in walk(source, executor, exclude=exclude):
+        if directory.error is not None:
+            errors.append(f"{directory.path}: {directory.error.strerror}")
+            continue
+        target = os.path.join(destination, directory.path) if directory.path else destination
+        for name, _ in directory.directories:
+            os.mkdir(os.path.join(target, name))
+        for name, stat_result in directory.files:
+            if len(copying) >= COPY_PREFETCH:
+                finish_copy()
+            copying.append((f"{directory.path}/{name}" if directory.path else name, stat_result.st_size,
+                            executor.submit(shutil.copy2, os.path.join(source, directory.path, name),
+                                            os.path.join(target, name))))
+        errors.extend(f"{directory.path}/{name}: skipped, not a regular file" if directory.path else
+                      f"{name}: skipped, not a regular file" for name in directory.others)
+    while copying:
+        finish_copy()
+    return copied_files, copied_bytes, errors
+
+
+class SizedFile:
+    """
+    Reads exactly `size` bytes of a file for its archive member, padded with zeros if the file shrank after its
+    header was written; a short member would corrupt the rest of the stream.
+    """
+
+    def __init__(self, file, size):
+        self.file = file
+        self.remaining = size
+        self.shrunk = False
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        data = self.file.read(size)
+        if len(data) < size:
+            self.shrunk = True
+            data += bytes(size - len(data))
+        self.remaining -= size
+        return data
+
+
+def archive_member(name, stat_result, directory=False):
+    member = tarfile.TarInfo(name)
+    member.type = tarfile.DIRTYPE if directory else tarfile.REGTYPE
+    member.size = 0 if directory else stat_result.st_size
+    member.mode = stat_result.st_mode & 0o7777
+    # whole seconds, a fractional mtime would cost a PAX header per member
+    member.mtime = int(stat_result.st_mtime)
+    return member
+
+
+def send_archive(active_socket, root, name, request_id, executor, compressor=None, checksum=None,
+                 exclude=frozenset()):
+    """
+    Sends a directory tree as one tar stream: a MSG_TRANSFER frame with archive=tar, the archive in MSG_DATA frames
+    and a MSG_END frame. The members are named '<name>/<relative path>'.
+    :param root: the directory to send
+    :param name: the name of the top directory in the archive
+    :param compressor: a StreamCompressor for the stream, or None
+    :param checksum: a hash object for the checksum of the stream in its MSG_END frame, see protocol.new_checksum()
+    :return: tuple of (files sent, the FrameWriter with the byte counts, list of errors)
+    """
+
+    writer = protocol.FrameWriter(active_socket, request_id, {"archive": "tar", "name": name}, compressor,
+                                  checksum=checksum)
+    errors = []
+    files = 0
+    with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT, bufsize=protocol.CHUNK_SIZE) as archive:
+        archive.addfile(archive_member(name, os.stat(root), directory=True))
+        for directory in walk(root, executor, exclude=exclude):
+            prefix = f"{name}/{directory.path}" if directory.path else name
+            if directory.error is not None:
+                errors.append(f"{prefix}: {directory.error.strerror}")
+            for entry, stat_result in directory.directories:
+                archive.addfile(archive_member(f"{prefix}/{entry}", stat_result, directory=True))
+            for entry, _ in directory.files:
+                try:
+                    file = open(os.path.join(root, directory.path, entry), 'rb')
+                except OSError as e:
+                    errors.append(f"{prefix}/{entry}: {e.strerror}")
+                    continue
+                with file:
+                    # the size at the time the file is read, it may have changed since the scan
+                    member = archive_member(f"{prefix}/{entry}", os.fstat(file.fileno()))
+                    content = SizedFile(file, member.size)
+                    archive.addfile(member, content)
+                if content.shrunk:
+                    errors.append(f"{prefix}/{entry}: changed while it was being sent")
+                files += 1
+            errors.extend(f"{prefix}/{entry}: skipped, not a regular file" for entry in directory.others)
+    writer.close()
+    return files, writer, errors
+
+
+def extract_member(archive, member, destination, checked_directories, exclude=frozenset()):
+    """
+    Creates one directory or regular file of an archive below destination. Every parent directory is resolved
+    once, so a symbolic link already in destination cannot redirect the member outside of it, and files are opened
+    without following a link in their own place.
+    :param checked_directories: set of the relative parent directories resolved so far, shared by the members
+    :param exclude: set of absolute real paths no member may be or be below
+    :raises ValueError: if the member would end up outside of destination or in an excluded directory
+    """
+
+    relative = protocol.safe_relative_path(member.name)
+    parent = os.path.dirname(relative)
+    if parent not in checked_directories:
+        real_destination = os.path.realpath(destination)
+        real_parent = os.path.realpath(os.path.join(destination, parent))
+        if os.path.commonpath([real_destination, real_parent]) != real_destination:
+            raise ValueError(f"Unsafe path '{member.name}'")
+        if any(os.path.commonpath([excluded, real_parent]) == excluded for excluded in exclude):
+            raise ValueError(f"Unsafe path '{member.name}'")
+        os.makedirs(real_parent, exist_ok=True)
+        checked_directories.add(parent)
+
+    path = os.path.join(destination, relative)
+    if exclude and os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path)) in exclude:
+        raise ValueError(f"Unsafe path '{member.name}'")
+    if member.isdir():
+        os.makedirs(path, exist_ok=True)
+        return
+    # a new file rather than a truncated one, the old one may be a link to a file of the dedup store
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_NOFOLLOW", 0),
+                         member.mode & 0o777)
+    with os.fdopen(descriptor, 'wb') as file:
+        shutil.copyfileobj(archive.extractfile(member), file, protocol.CHUNK_SIZE)
+    os.utime(path, (member.mtime, member.mtime))
+
+
+def receive_archive(active_socket, request_id, destination, decompressor=None, checksum=None, exclude=frozenset()):
+    """
+    Unpacks a tar stream sent by send_archive() into destination while it arrives. Only directories and regular
+    files with safe relative names are created, other members are skipped; existing files are overwritten.
+    The MSG_TRANSFER frame must already have been read by the caller.
+    :param checksum: a hash object to check the stream against the checksum in its MSG_END frame. The members are
+        unpacked before the checksum arrives, a mismatch is reported as an error.
+    :return: tuple of (files received, the FrameReader with the byte counts, list of errors)
+    """
+
+    reader = protocol.FrameReader(active_socket, request_id, decompressor, checksum)
+    errors = []
+    files = 0
+    checked_directories = set()
+    try:
+        try:
+            with tarfile.open(fileobj=reader, mode="r|", bufsize=protocol.CHUNK_SIZE) as archive:
+                for member in archive:
+                    if not (member.isfile() or member.isdir()):
+                        errors.append(f"{member.name}: skipped, not a regular file")
+                        continue
+                    try:
+                        extract_member(archive, member, destination, checked_directories, exclude)
+                    except ValueError as e:
+                        errors.append(str(e))
+                        continue
+                    except OSError as e:
+                        errors.append(f"{member.name}: {e.strerror}")
+                        continue
+                    files += member.isfile()
+        except tarfile.TarError as e:
+            errors.append(f"Invalid archive: {e}")
+        finally:
+            reader.drain()
+    except protocol.IntegrityError as e:
+        errors.append(str(e))
+    return files, reader, errors